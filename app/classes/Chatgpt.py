@@ -1,7 +1,54 @@
 from enum import Enum
+from typing import List, Optional
+
+from pydantic import BaseModel, Field
 
 
 class ChatGptModelEnum(str, Enum):
     gpt_3_5_turbo = "gpt-3.5-turbo"
     gpt_4 = "gpt-4"
     # Add more models as needed
+
+
+class ChatAnswer(BaseModel):
+    message: str
+    model: str
+    cached: bool = False  # served from the response cache
+    usage: Optional[dict] = None  # token usage reported by the API, None for cached answers
+    shared: bool = False  # answered by a concurrent identical request
+
+
+class CachePolicy(BaseModel):
+    enabled: bool = True
+    ttl: int = 3600  # seconds an answer is kept in Redis
+    local_ttl: int = 300  # seconds an answer is kept in the in-process LRU
+
+
+class ChatTurn(BaseModel):
+    role: str  # "user" or "assistant"
+    content: str
+    tokens: int
+
+
+class ChatSession(BaseModel):
+    session_id: str
+    model: str
+    tokens: int  # tokens of the stored turns and the summary
+    summary: Optional[str] = None  # summary of the turns trimmed to fit the context budget
+    turns: List[ChatTurn] = []
+
+
+class ChatBatchRequest(BaseModel):
+    questions: List[str] = Field(..., min_length=1)
+    model: ChatGptModelEnum = ChatGptModelEnum.gpt_3_5_turbo
+    concurrency: Optional[int] = Field(None, ge=1)  # upstream calls in flight, capped by the server setting
+    cache: bool = True
+
+
+class ChatBatchResult(BaseModel):
+    index: int  # position of the question in the request
+    success: bool
+    message: Optional[str] = None
+    cached: bool = False
+    error: Optional[str] = None
+    usage: Optional[dict] = None  # token usage reported by the API
@@ -1,6 +1,8 @@
-from typing import Optional
+from datetime import datetime
+from enum import Enum
+from typing import List, Optional
 
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field
 
 
 class SmtpModel(BaseModel):
@@ -10,6 +12,7 @@ class SmtpModel(BaseModel):
     user: Optional[str] = None
     password: Optional[str] = None
     system_email: Optional[EmailStr] = None
+    security: Optional[str] = None  # "starttls", "ssl" or "none", chosen by port when not set
 
 
 class WhatsappModel(BaseModel):
@@ -30,3 +33,56 @@ class MessagesConfigModel(BaseModel):
     smtp: Optional[SmtpModel] = None
     whatsapp: Optional[WhatsappModel] = None
     sms: Optional[SmsModel] = None
+
+
+class EmailSentModel(BaseModel):
+    id: Optional[str] = Field(default=None, alias="_id")  # mapping MongoDB's '_id'
+    subject: Optional[str] = None
+    body: Optional[str] = None
+    to_emails: List[str] = []
+    attachments: List[str] = []
+    sent_at: Optional[datetime] = None  # missing on records saved before sent_at was introduced
+
+    @classmethod
+    def from_mongo(cls, data: dict):
+        if "_id" in data:
+            data["_id"] = str(data["_id"])  # Convert MongoDB ObjectId to string
+        return cls(**data)
+
+    class Config:
+        populate_by_name = True
+
+
+class EmailHistoryPage(BaseModel):
+    items: List[EmailSentModel]
+    next_cursor: Optional[str] = None  # pass back as `cursor` to fetch the next page, None on the last page
+
+
+class ChannelEnum(str, Enum):
+    email = "email"
+    whatsapp = "whatsapp"
+    sms = "sms"
+
+
+class OutgoingMessage(BaseModel):
+    channel: ChannelEnum
+    to: List[str]  # email addresses for the email channel, phone numbers otherwise
+    body: str
+    subject: Optional[str] = None  # only used by the email channel
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "channel": "sms",
+                "to": ["+1234567890"],
+                "body": "Your verification code is 123456",
+            }
+        }
+
+
+class DispatchResult(BaseModel):
+    channel: ChannelEnum
+    to: List[str]
+    success: bool
+    provider_id: Optional[str] = None  # message id returned by the provider, if any
+    error: Optional[str] = None
@@ -17,6 +17,8 @@ class UserBase(BaseModel):
     full_name: str  # User's full name
     disabled: Optional[bool] = None  # Optional field to disable the user
     role: Role = Role.user  # Default role
+    chat_concurrency_limit: Optional[int] = None  # Overrides the concurrent chat requests of the role
+    chat_token_quota: Optional[int] = None  # Overrides the rolling chat token quota of the role, 0 is unlimited
 
 class UpdateUser(BaseModel):
     username: Optional[str] = None  # Now optional
@@ -25,6 +27,8 @@ class UpdateUser(BaseModel):
     disabled: Optional[bool] = None  # Remains optional
     role: Optional[Role] = Role.user  # Optional, with a default value if not provided
     password: Optional[str] = None
+    chat_concurrency_limit: Optional[int] = None
+    chat_token_quota: Optional[int] = None
 
 class UserCreate(UserBase):
     password: Optional[str]  # Password field for user creation
@@ -4,9 +4,11 @@ from starlette.status import HTTP_403_FORBIDDEN, HTTP_401_UNAUTHORIZED
 from app.classes.Permissions import RolePermissions, HTTPMethodPermissions
 from app.components.auth.jwt_token_handler import get_jwt_username
 from app.components.logger import logger
+from app.components.server_timing import timed
 from app.db.mongoClient import async_database
 
 
+@timed("permissions")
 async def check_permissions(request: Request, username: str = Depends(get_jwt_username)):
     """
     Check if the user has the required permissions to access the route.
@@ -15,11 +17,11 @@ async def check_permissions(request: Request, username: str = Depends(get_jwt_us
         user_collection = async_database.users
         user = await user_collection.find_one({"username": username})
         if not user:
-            logger.error(f"User not found: {username}")
+            logger.error("User not found: %s", username)
             raise HTTPException(status_code=HTTP_401_UNAUTHORIZED, detail="User not found.")
 
         if user.get("disabled", False):
-            logger.warning(f"Access denied for disabled account: {username}")
+            logger.warning("Access denied for disabled account: %s", username)
             raise HTTPException(status_code=HTTP_403_FORBIDDEN, detail="Account is disabled.")
 
         user_role = user.get("role")
@@ -30,11 +32,30 @@ async def check_permissions(request: Request, username: str = Depends(get_jwt_us
         # Check if the user's role includes the required permission
         user_permissions = RolePermissions.role_permissions_map.get(user_role, [])
         if required_permission not in user_permissions:
-            logger.warning(f"Permission denied: {username} attempted to {request.method}")
+            logger.warning("Permission denied: %s attempted to %s", username, request.method)
             raise HTTPException(status_code=HTTP_403_FORBIDDEN,
                                 detail="You don't have permission to perform this action.")
-        logger.info(f"Permission granted: {username} accessed {request.url.path} with method {request.method}")
+        # Logged on every request: lazy formatting, and sampled by `log_sample_rates` ("permission_granted")
+        logger.info("Permission granted: %s accessed %s with method %s", username, request.url.path, request.method,
+                    extra={"event": "permission_granted"})
+        request.state.user = user  # saves routes another lookup of the user
     except HTTPException as e:
         # Log the error and re-raise the exception
-        logger.error(f"Error during permission check for user {username}: {str(e.detail)}")
+        logger.error("Error during permission check for user %s: %s", username, e.detail)
         raise
+
+
+def require_role(*roles: str):
+    """
+    Dependency allowing only users with one of the given roles, on top of `check_permissions`.
+    Usage: `dependencies=[Depends(require_role("owner", "admin"))]`
+    """
+
+    async def dependency(request: Request, _=Depends(check_permissions)):
+        user = request.state.user
+        if user.get("role") not in roles:
+            logger.warning("Role denied: %s attempted to access %s", user.get("username"), request.url.path)
+            raise HTTPException(status_code=HTTP_403_FORBIDDEN,
+                                detail="You don't have permission to perform this action.")
+
+    return dependency
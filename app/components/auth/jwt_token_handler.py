@@ -5,6 +5,9 @@ import jwt
 from dotenv import load_dotenv
 from fastapi import HTTPException, Header, Request
 
+from app.components.logger import bind_log_context
+from app.components.server_timing import timed
+
 # from app.db.mongoClient import database
 
 load_dotenv()
@@ -49,6 +52,7 @@ async def create_jwt_access_token(request: Request, data: dict, expires_delta: t
     return encoded_jwt
 
 
+@timed("auth")
 async def get_jwt_secret_key(request: Request, api_key: str = Header(...)):
     redis_client = request.app.state.redis
 
@@ -106,6 +110,7 @@ async def get_jwt_username(api_key: str = Header(...)):
         username = payload.get("sub", None)
         if not username:
             raise HTTPException(status_code=401, detail="Invalid JWT token: Username missing")
+        bind_log_context(user=username)  # the user of every record logged for this request
         return username
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid JWT token")
\ No newline at end of file
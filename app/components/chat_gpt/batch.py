@@ -0,0 +1,59 @@
+import asyncio
+import os
+from typing import AsyncIterator, List
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+
+from app.classes.Chatgpt import ChatBatchResult
+from app.components.logger import logger
+
+load_dotenv()  # loading environment variables
+
+CHATGPT_BATCH_CONCURRENCY = int(os.getenv("chatgpt_batch_concurrency", 8))  # default upstream calls in flight
+CHATGPT_BATCH_MAX_CONCURRENCY = int(os.getenv("chatgpt_batch_max_concurrency", 32))  # cap for requested values
+CHATGPT_BATCH_MAX_ITEMS = int(os.getenv("chatgpt_batch_max_items", 1000))
+
+
+async def answer_question(service, index: int, question: str, model: str, read_cache: bool) -> ChatBatchResult:
+    """
+    Answer one question of a batch. Failed upstream calls are already retried by the `UpstreamGuard` of the
+    service, within its retry budget, so a failure here is final.
+    """
+    try:
+        answer = await service.ask(question, model, read_cache=read_cache, write_cache=read_cache)
+        return ChatBatchResult(index=index, success=True, message=answer.message, cached=answer.cached,
+                               usage=answer.usage)
+    except HTTPException as e:
+        logger.warning(f"Batch question {index} failed: {e.detail}")
+        return ChatBatchResult(index=index, success=False, error=e.detail)
+    except Exception as e:  # noqa
+        logger.warning(f"Batch question {index} failed: {e}")
+        return ChatBatchResult(index=index, success=False, error="Unable to fetch response.")
+
+
+async def run_batch(service, questions: List[str], model: str, concurrency: int = CHATGPT_BATCH_CONCURRENCY,
+                    read_cache: bool = True) -> AsyncIterator[ChatBatchResult]:
+    """
+    Answer all questions with at most `concurrency` upstream calls in flight, yielding each result as soon
+    as it is ready, so in completion order. Results carry the index of their question.
+
+    A fixed set of workers takes the questions one after the other, so a batch of thousands of questions
+    doesn't create thousands of tasks. Closing the generator cancels the remaining work.
+    """
+    concurrency = max(1, min(concurrency, CHATGPT_BATCH_MAX_CONCURRENCY, len(questions)))
+    pending = iter(enumerate(questions))
+    results: asyncio.Queue = asyncio.Queue()
+
+    async def worker():
+        for index, question in pending:
+            await results.put(await answer_question(service, index, question, model, read_cache))
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        for _ in questions:
+            yield await results.get()
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
@@ -1,35 +1,102 @@
+import asyncio
+import json
 import logging
 import os
+from contextlib import aclosing
+from typing import AsyncIterator, List, Optional, Set
 
 import httpx
 from dotenv import load_dotenv
 
+from app.classes.Chatgpt import ChatAnswer
+from app.components.chat_gpt.conversations import CHATGPT_SUMMARY_MAX_TOKENS, SUMMARY_PROMPT, ConversationStore
+from app.components.chat_gpt.resilience import UpstreamError, UpstreamGuard
+from app.components.chat_gpt.response_cache import ChatResponseCache, cache_key
+from app.components.chat_gpt.single_flight import SingleFlight
+
 load_dotenv()
 API_KEY = os.getenv("open_ai_secret_key")
+# Any OpenAI-compatible API, e.g. a proxy or the local mock of tests/mocks/openai.py
+OPEN_AI_BASE_URL = os.getenv("open_ai_base_url", "https://api.openai.com")
+
+# HTTP client settings, timeouts are in seconds. The read timeout has to cover a whole completion.
+OPEN_AI_CONNECT_TIMEOUT = float(os.getenv("open_ai_connect_timeout", 5))
+OPEN_AI_READ_TIMEOUT = float(os.getenv("open_ai_read_timeout", 60))
+OPEN_AI_WRITE_TIMEOUT = float(os.getenv("open_ai_write_timeout", 10))
+OPEN_AI_POOL_TIMEOUT = float(os.getenv("open_ai_pool_timeout", 5))  # waiting for a free pooled connection
+OPEN_AI_MAX_CONNECTIONS = int(os.getenv("open_ai_max_connections", 100))
+OPEN_AI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("open_ai_max_keepalive_connections", 20))
+OPEN_AI_KEEPALIVE_EXPIRY = float(os.getenv("open_ai_keepalive_expiry", 30))
+OPEN_AI_HTTP2 = os.getenv("open_ai_http2", "true").lower() == "true"
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def ask_chatgpt_with_context(gpt_question: str, model: str = "gpt-3.5-turbo"):
-    headers = {
-        "Authorization": f"Bearer {API_KEY}"
-    }
+def create_http_client(base_url: str = OPEN_AI_BASE_URL) -> httpx.AsyncClient:
+    """
+    Create the HTTP client shared by all chat calls.
+
+    The client is created once in the app lifespan and keeps its connections to the API alive,
+    so completions don't pay for a new TCP and TLS handshake every time. HTTP/2 multiplexes
+    concurrent completions over a few connections when the `h2` package is installed.
+    """
+    http2 = OPEN_AI_HTTP2
+    if http2:
+        try:
+            import h2  # noqa
+        except ImportError:
+            logger.warning("HTTP/2 is enabled for the OpenAI client but the 'h2' package is missing, using HTTP/1.1.")
+            http2 = False
+
+    return httpx.AsyncClient(
+        base_url=base_url,
+        headers={"Authorization": f"Bearer {API_KEY}"},
+        http2=http2,
+        timeout=httpx.Timeout(connect=OPEN_AI_CONNECT_TIMEOUT, read=OPEN_AI_READ_TIMEOUT,
+                              write=OPEN_AI_WRITE_TIMEOUT, pool=OPEN_AI_POOL_TIMEOUT),
+        limits=httpx.Limits(max_connections=OPEN_AI_MAX_CONNECTIONS,
+                            max_keepalive_connections=OPEN_AI_MAX_KEEPALIVE_CONNECTIONS,
+                            keepalive_expiry=OPEN_AI_KEEPALIVE_EXPIRY),
+    )
 
+
+async def request_chat_completion(client: httpx.AsyncClient, messages: List[dict], model: str,
+                                  guard: Optional[UpstreamGuard] = None, **options) -> dict:
+    """
+    Request a completion and return the response body. HTTP errors are raised to the caller.
+    :param guard: Sends the request with retries and a circuit breaker, errors are raised as `UpstreamError`.
+    :param options: Further request parameters, e.g. `max_tokens`.
+    """
     payload = {
         "model": model,
-        "messages": [
-            {"role": "user", "content": gpt_question}
-        ]
+        "messages": messages,
+        **options,
     }
+    if guard:
+        return await guard.post(client, "/v1/chat/completions", payload)
+    response = await client.post("/v1/chat/completions", json=payload)
+    response.raise_for_status()
+    return response.json()
+
+
+def completion_text(data: dict) -> str:
+    """
+    Join the content of all choices of a completion.
+    :raises UpstreamError: (502) When the completion has no choices or they are malformed.
+    """
+    try:
+        return ''.join(choice['message']['content'] for choice in data['choices'] if
+                       'message' in choice and choice['message'].get('content'))
+    except (KeyError, TypeError, AttributeError) as e:
+        logger.error(f"ChatGPT sent a malformed completion: {e!r}")
+        raise UpstreamError(502, "ChatGPT sent a malformed response.", False) from e
 
+
+async def ask_chatgpt_with_context(client: httpx.AsyncClient, gpt_question: str, model: str = "gpt-3.5-turbo"):
     try:
-        with httpx.Client() as client:
-            response = client.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
-            response.raise_for_status()
-            data = response.json()
-            return ''.join(choice['message']['content'] for choice in data['choices'] if
-                           'message' in choice and 'content' in choice['message'])
+        data = await request_chat_completion(client, [{"role": "user", "content": gpt_question}], model)
+        return completion_text(data)
     except httpx.HTTPStatusError as e:
         logger.error(f"HTTP error occurred: {e}")
     except httpx.RequestError as e:
@@ -38,7 +105,165 @@ def ask_chatgpt_with_context(gpt_question: str, model: str = "gpt-3.5-turbo"):
         logger.error(f"An unexpected error occurred: {e}")
     return "Error: Unable to fetch response."
 
+
+async def stream_chat_completion(client: httpx.AsyncClient, messages: List[dict], model: str,
+                                 usage: dict = None, guard: Optional[UpstreamGuard] = None) -> AsyncIterator[str]:
+    """
+    Request a streamed completion and yield the content of each token as it arrives.
+
+    The upstream response is read inside `client.stream`, so closing or cancelling the generator
+    (e.g. when the client of the route disconnects) closes the upstream connection right away and
+    stops the completion. HTTP errors are raised to the caller, a chunk that is not valid JSON as an
+    `UpstreamError` (502).
+    :param usage: Filled with the token usage the API reports at the end of the stream.
+    :param guard: Opens the stream with retries and a circuit breaker, see `UpstreamGuard.stream`.
+    """
+    payload = {
+        "model": model,
+        "messages": messages,
+        "stream": True,
+    }
+    if usage is not None:
+        payload["stream_options"] = {"include_usage": True}
+
+    opener = guard.stream(client, "/v1/chat/completions", payload) if guard else \
+        client.stream("POST", "/v1/chat/completions", json=payload)
+    async with opener as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue  # blank separators and keep-alive comments
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            try:
+                chunk = json.loads(data)
+                if not isinstance(chunk, dict):
+                    raise ValueError("the chunk is not an object")
+            except ValueError as e:
+                logger.error(f"Malformed chunk in the ChatGPT stream: {data[:200]!r}")
+                raise UpstreamError(502, "ChatGPT sent a malformed response.", False) from e
+            if usage is not None and chunk.get("usage"):
+                usage.update(chunk["usage"])
+            for choice in chunk.get("choices") or []:
+                content = choice.get("delta", {}).get("content")
+                if content:
+                    yield content
+
+
+def stream_chatgpt_with_context(client: httpx.AsyncClient, gpt_question: str, model: str = "gpt-3.5-turbo",
+                                usage: dict = None, guard: Optional[UpstreamGuard] = None) -> AsyncIterator[str]:
+    """Stream the answer to a single question, see `stream_chat_completion`."""
+    return stream_chat_completion(client, [{"role": "user", "content": gpt_question}], model, usage, guard)
+
+
+class ChatGptService:
+    """
+    Entry point of the chat routes.
+
+    Holds the shared HTTP client and the response cache, and decides per request whether an answer
+    can come from the cache, must be fetched upstream, and may be stored afterwards. Concurrent
+    identical questions that miss the cache share a single upstream call. Questions asked within a
+    conversation session bypass both, their answer depends on the history. All upstream calls go
+    through the `UpstreamGuard`, so failures reach the routes as `UpstreamError` with a status code.
+    """
+
+    def __init__(self, http_client: httpx.AsyncClient, cache: Optional[ChatResponseCache] = None,
+                 single_flight: Optional[SingleFlight] = None, conversations: Optional[ConversationStore] = None,
+                 guard: Optional[UpstreamGuard] = None):
+        self.http_client = http_client
+        self.guard = guard or UpstreamGuard()
+        self.cache = cache
+        self.single_flight = single_flight or SingleFlight(mode="off")
+        self.conversations = conversations
+        self._background: Set[asyncio.Task] = set()
+
+    async def ask(self, question: str, model: str, read_cache: bool = True, write_cache: bool = True) -> ChatAnswer:
+        """
+        Answer a single question. Upstream failures are raised as `UpstreamError`.
+        :param read_cache: Look the answer up in the cache before calling the API.
+        :param write_cache: Store a fresh answer in the cache.
+        """
+        model = getattr(model, "value", model)
+        if self.cache and read_cache:
+            answer, _ = await self.cache.get(model, question)
+            if answer is not None:
+                return ChatAnswer(message=answer, model=model, cached=True)
+
+        async def fetch() -> ChatAnswer:
+            data = await request_chat_completion(self.http_client, [{"role": "user", "content": question}], model,
+                                                 self.guard)
+            fresh = ChatAnswer(message=completion_text(data), model=model, usage=data.get("usage"))
+            if self.cache and write_cache:
+                await self.cache.set(model, question, fresh.message)
+            return fresh
+
+        # A forced refresh (no cache read) must not be answered by a request that is already running
+        if read_cache:
+            return await self.single_flight.do(cache_key(model, question), fetch)
+        return await fetch()
+
+    def stream(self, question: str, model: str, usage: dict = None) -> AsyncIterator[str]:
+        """Stream the tokens of an answer, see `stream_chat_completion`."""
+        return stream_chatgpt_with_context(self.http_client, question, getattr(model, "value", model), usage,
+                                           self.guard)
+
+    async def converse(self, username: str, session_id: str, question: str, model: str) -> ChatAnswer:
+        """
+        Answer a question within a conversation session and add both to the session.
+        Upstream failures are raised as `UpstreamError` and leave the session unchanged.
+        """
+        model = getattr(model, "value", model)
+        messages, _ = await self.conversations.context(username, session_id, question, model)
+        data = await request_chat_completion(self.http_client, messages, model, self.guard)
+        answer = ChatAnswer(message=completion_text(data), model=model, usage=data.get("usage"))
+        await self._remember(username, session_id, model, question, answer.message)
+        return answer
+
+    async def stream_conversation(self, username: str, session_id: str, question: str, model: str,
+                                  usage: dict = None) -> AsyncIterator[str]:
+        """
+        Stream the answer to a question within a conversation session. The exchange is added to the
+        session once the answer is complete; an interrupted answer is not kept.
+        """
+        model = getattr(model, "value", model)
+        messages, _ = await self.conversations.context(username, session_id, question, model)
+        tokens = []
+        async with aclosing(stream_chat_completion(self.http_client, messages, model, usage, self.guard)) as upstream:
+            async for token in upstream:
+                tokens.append(token)
+                yield token
+        await self._remember(username, session_id, model, question, "".join(tokens))
+
+    async def _remember(self, username: str, session_id: str, model: str, question: str, answer: str):
+        tokens = await self.conversations.append(username, session_id, model, question, answer)
+        if self.conversations.needs_compaction(tokens, model):
+            # Summarizing costs another completion, so it runs after the answer has been returned
+            task = asyncio.create_task(self.conversations.compact(
+                username, session_id, model, lambda transcript: self.summarize(transcript, model)))
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+
+    async def summarize(self, transcript: str, model: str) -> str:
+        data = await request_chat_completion(
+            self.http_client,
+            [{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": transcript}],
+            model, self.guard, max_tokens=CHATGPT_SUMMARY_MAX_TOKENS,
+        )
+        return completion_text(data)
+
+    async def aclose(self):
+        """Wait for running session compactions, call before closing the HTTP client."""
+        if self._background:
+            await asyncio.gather(*self._background, return_exceptions=True)
+
+
+async def main():
+    async with create_http_client() as client:
+        question = "Which nation founded Jerusalem and has the strongest connection with it throughout known history?"
+        print(await ask_chatgpt_with_context(client, question))
+
+
 # Example usage
 if __name__ == "__main__":
-    question = "Which nation founded Jerusalem and has the strongest connection with it throughout known history?"
-    print(ask_chatgpt_with_context(question))
+    asyncio.run(main())
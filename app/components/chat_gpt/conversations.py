@@ -0,0 +1,211 @@
+import json
+import os
+import secrets
+import time
+from functools import lru_cache
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from redis.exceptions import RedisError
+
+from app.classes.Chatgpt import ChatSession, ChatTurn
+from app.components.logger import logger
+from app.components.startup import release_leader_lock
+
+load_dotenv()  # loading environment variables
+
+CHATGPT_SESSION_TTL = int(os.getenv("chatgpt_session_ttl", 86400))  # seconds an idle session is kept
+# Prompt tokens a session may send per model as JSON, e.g. {"gpt-4": 6000}
+CHATGPT_CONTEXT_BUDGETS = os.getenv("chatgpt_context_budgets", '{"gpt-3.5-turbo": 3000, "gpt-4": 6000}')
+CHATGPT_CONTEXT_DEFAULT_BUDGET = int(os.getenv("chatgpt_context_default_budget", 3000))
+# Compaction shrinks a session to this share of its budget, so it runs once every few turns and not every turn
+CHATGPT_CONTEXT_TRIM_RATIO = float(os.getenv("chatgpt_context_trim_ratio", 0.75))
+CHATGPT_SESSION_SUMMARIZE = os.getenv("chatgpt_session_summarize", "true").lower() == "true"
+CHATGPT_SUMMARY_MAX_TOKENS = int(os.getenv("chatgpt_summary_max_tokens", 300))
+
+MESSAGE_OVERHEAD_TOKENS = 4  # role and separators the API adds to every message
+ROLES = {"u": "user", "a": "assistant"}
+SUMMARY_PROMPT = ("Summarize the conversation below in a few sentences. Keep names, facts, decisions and open "
+                  "questions that later messages may refer to.")
+
+
+def load_context_budgets() -> Dict[str, int]:
+    try:
+        return {model: int(budget) for model, budget in json.loads(CHATGPT_CONTEXT_BUDGETS).items()}
+    except (ValueError, AttributeError) as e:
+        logger.error(f"Ignoring invalid chatgpt_context_budgets: {e}")
+        return {}
+
+
+@lru_cache(maxsize=16)
+def _encoding(model: str):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str, model: str) -> int:
+    """
+    Tokens of a message. Uses tiktoken when it is installed, otherwise estimates four characters per token.
+    """
+    encoding = _encoding(model)
+    tokens = len(encoding.encode(text)) if encoding else len(text) // 4 + 1
+    return tokens + MESSAGE_OVERHEAD_TOKENS
+
+
+class ConversationStore:
+    """
+    Conversation sessions in Redis.
+
+    A session is a hash `chatgpt:session:<username>:<id>` holding the model, the running token count and
+    the summary of trimmed turns, plus a list `...:turns` of compact `[role, tokens, content]` entries.
+    Tokens are counted once when a turn is added, so building a prompt never re-tokenizes the history.
+    Keys include the username, so a session can only be read by the user who created it.
+    """
+
+    def __init__(self, redis_client, budgets: Dict[str, int] = None, ttl: int = CHATGPT_SESSION_TTL,
+                 summarize: bool = CHATGPT_SESSION_SUMMARIZE):
+        self.redis = redis_client
+        self.budgets = budgets if budgets is not None else load_context_budgets()
+        self.ttl = ttl
+        self.summarize = summarize
+
+    @staticmethod
+    def _keys(username: str, session_id: str) -> Tuple[str, str]:
+        key = f"chatgpt:session:{username}:{session_id}"
+        return key, f"{key}:turns"
+
+    def budget(self, model: str) -> int:
+        return self.budgets.get(model, CHATGPT_CONTEXT_DEFAULT_BUDGET)
+
+    async def get(self, username: str, session_id: str) -> Optional[ChatSession]:
+        key, turns_key = self._keys(username, session_id)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            meta, turns = await pipe.hgetall(key).lrange(turns_key, 0, -1).execute()
+        if not meta:
+            return None
+        return ChatSession(
+            session_id=session_id,
+            model=meta.get("model", ""),
+            tokens=int(meta.get("tokens", 0)) + int(meta.get("summary_tokens", 0)),
+            summary=meta.get("summary") or None,
+            turns=[ChatTurn(role=ROLES[role], content=content, tokens=tokens)
+                   for role, tokens, content in map(json.loads, turns)],
+        )
+
+    async def delete(self, username: str, session_id: str) -> bool:
+        return bool(await self.redis.delete(*self._keys(username, session_id)))
+
+    async def context(self, username: str, session_id: str, question: str, model: str) -> Tuple[List[dict], int]:
+        """
+        Messages to send for a new question: the summary, the latest turns that fit the budget of the model,
+        then the question. Turns over the budget are left out here and removed for good by `compact`.
+        :return: The messages and their token count.
+        """
+        session = await self.get(username, session_id)
+        budget = self.budget(model)
+        used = count_tokens(question, model)
+        messages = [{"role": "user", "content": question}]
+        if session is None:
+            return messages, used
+
+        summary_message = None
+        if session.summary:
+            summary_message = {"role": "system", "content": f"Summary of the conversation so far: {session.summary}"}
+            used += count_tokens(summary_message["content"], model)
+
+        kept = []
+        for turn in reversed(session.turns):
+            if used + turn.tokens > budget:
+                break
+            used += turn.tokens
+            kept.append({"role": turn.role, "content": turn.content})
+        kept.reverse()
+        while kept and kept[0]["role"] == "assistant":  # start with a question, not half an exchange
+            used -= session.turns[len(session.turns) - len(kept)].tokens
+            kept.pop(0)
+
+        return ([summary_message] if summary_message else []) + kept + messages, used
+
+    async def append(self, username: str, session_id: str, model: str, question: str, answer: str) -> int:
+        """
+        Add a question and its answer to the session.
+        :return: The tokens of the session now, its turns and its summary.
+        """
+        key, turns_key = self._keys(username, session_id)
+        turns = [("u", count_tokens(question, model), question), ("a", count_tokens(answer, model), answer)]
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(turns_key, *(json.dumps(turn, separators=(",", ":")) for turn in turns))
+            pipe.hset(key, mapping={"model": model, "updated": int(time.time())})
+            pipe.hincrby(key, "tokens", sum(tokens for _, tokens, _ in turns))
+            pipe.expire(key, self.ttl)
+            pipe.expire(turns_key, self.ttl)
+            pipe.hget(key, "summary_tokens")
+            results = await pipe.execute()
+        return int(results[2]) + int(results[5] or 0)
+
+    async def compact(self, username: str, session_id: str, model: str,
+                      summarize: Callable[[str], Awaitable[str]] = None):
+        """
+        Remove the oldest turns until the session fits `chatgpt_context_trim_ratio` of its budget. When
+        summarizing is enabled the removed turns are folded into the session summary with `summarize`.
+        Only one compaction per session runs at a time. When summarizing fails the turns are dropped and
+        the previous summary is kept.
+        """
+        key, turns_key = self._keys(username, session_id)
+        lock_key, lock_token = f"{key}:compacting", secrets.token_hex(8)
+        if not await self.redis.set(lock_key, lock_token, nx=True, ex=120):
+            return
+        try:
+            session = await self.get(username, session_id)
+            if session is None:
+                return
+            previous_summary_tokens = int(await self.redis.hget(key, "summary_tokens") or 0)
+            target = int(self.budget(model) * CHATGPT_CONTEXT_TRIM_RATIO)
+            tokens, dropped = session.tokens, []
+            for turn in session.turns:
+                if tokens <= target:
+                    break
+                tokens -= turn.tokens
+                dropped.append(turn)
+            if len(dropped) < len(session.turns) and session.turns[len(dropped)].role == "assistant":
+                tokens -= session.turns[len(dropped)].tokens
+                dropped.append(session.turns[len(dropped)])
+            if not dropped:
+                return
+
+            summary, summary_tokens = session.summary, previous_summary_tokens
+            if summarize and self.summarize:
+                transcript = "\n".join(f"{turn.role}: {turn.content}" for turn in dropped)
+                if session.summary:
+                    transcript = f"Earlier summary: {session.summary}\n{transcript}"
+                try:
+                    summary = await summarize(transcript)
+                    summary_tokens = count_tokens(summary, model)
+                except Exception as e:  # noqa
+                    logger.warning(f"Summarizing chat session {session_id} failed, dropping the turns: {e}")
+
+            async with self.redis.pipeline(transaction=True) as pipe:
+                # New turns are only ever appended, so the dropped ones are still at the head of the list
+                pipe.ltrim(turns_key, len(dropped), -1)
+                pipe.hincrby(key, "tokens", -sum(turn.tokens for turn in dropped))
+                pipe.hset(key, mapping={"summary": summary or "", "summary_tokens": summary_tokens})
+                await pipe.execute()
+            logger.info(f"Chat session {session_id} compacted: {len(dropped)} turns removed")
+        except RedisError as e:
+            logger.warning(f"Compacting chat session {session_id} failed: {e}")
+        finally:
+            try:
+                # The lock may have expired during a slow summary and been taken by another compaction
+                await release_leader_lock(self.redis, lock_token, lock_key)
+            except RedisError as e:
+                logger.warning(f"Releasing the compaction lock of chat session {session_id} failed: {e}")
+
+    def needs_compaction(self, tokens: int, model: str) -> bool:
+        """:param tokens: Tokens of the session including its summary, as returned by `append`."""
+        return tokens > self.budget(model)
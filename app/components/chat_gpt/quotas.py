@@ -0,0 +1,147 @@
+import json
+import os
+import secrets
+import time
+from typing import Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from redis.exceptions import RedisError
+
+from app.components.logger import logger
+
+load_dotenv()  # loading environment variables
+
+# Per role as JSON. A concurrency limit or token quota of 0 means unlimited.
+CHATGPT_CONCURRENCY_LIMITS = os.getenv("chatgpt_concurrency_limits", '{"owner": 0, "admin": 8, "user": 2}')
+CHATGPT_TOKEN_QUOTAS = os.getenv("chatgpt_token_quotas", '{"owner": 0, "admin": 1000000, "user": 100000}')
+CHATGPT_QUOTA_WINDOW = int(os.getenv("chatgpt_quota_window", 86400))  # seconds of the rolling token window
+CHATGPT_QUOTA_BUCKET = int(os.getenv("chatgpt_quota_bucket", 3600))  # seconds per usage bucket of the window
+CHATGPT_LEASE_TTL = int(os.getenv("chatgpt_lease_ttl", 300))  # seconds before a slot of a crashed worker is freed
+
+
+def load_role_limits(value: str, name: str) -> Dict[str, int]:
+    try:
+        return {role: int(limit) for role, limit in json.loads(value).items()}
+    except (ValueError, AttributeError) as e:
+        logger.error(f"Ignoring invalid {name}: {e}")
+        return {}
+
+
+class ChatLimiter:
+    """
+    Concurrency limits and rolling token quotas of the chat routes, shared by all workers through Redis.
+
+    Running requests of a user are leases in the sorted set `chatgpt:inflight:<username>`, scored by
+    their start time, so leases of a worker that died expire after `chatgpt_lease_ttl` seconds.
+    Token use is added to one hash per `chatgpt_quota_bucket` seconds, `chatgpt:usage:<bucket>`, holding
+    `tokens:<username>` and `requests:<username>`; the usage of the window is the sum of its buckets.
+
+    Limits come from the role of the user, unless the user document sets `chat_concurrency_limit` or
+    `chat_token_quota`. Redis errors are logged and let the request through.
+    """
+
+    def __init__(self, redis_client, concurrency_limits: Dict[str, int] = None, token_quotas: Dict[str, int] = None,
+                 window: int = CHATGPT_QUOTA_WINDOW, bucket: int = CHATGPT_QUOTA_BUCKET,
+                 lease_ttl: int = CHATGPT_LEASE_TTL):
+        self.redis = redis_client
+        self.concurrency_limits = concurrency_limits if concurrency_limits is not None else \
+            load_role_limits(CHATGPT_CONCURRENCY_LIMITS, "chatgpt_concurrency_limits")
+        self.token_quotas = token_quotas if token_quotas is not None else \
+            load_role_limits(CHATGPT_TOKEN_QUOTAS, "chatgpt_token_quotas")
+        self.window = window
+        self.bucket = bucket
+        self.lease_ttl = lease_ttl
+
+    def limits(self, user: dict) -> Tuple[int, int]:
+        """Concurrency limit and token quota of a user document."""
+        role = user.get("role")
+        concurrency = user.get("chat_concurrency_limit")
+        quota = user.get("chat_token_quota")
+        return (self.concurrency_limits.get(role, 0) if concurrency is None else concurrency,
+                self.token_quotas.get(role, 0) if quota is None else quota)
+
+    def _buckets(self) -> List[str]:
+        current = int(time.time()) // self.bucket
+        return [f"chatgpt:usage:{bucket}" for bucket in range(current - self.window // self.bucket + 1, current + 1)]
+
+    async def acquire(self, user: dict) -> Optional[str]:
+        """
+        Check the token quota and take a concurrency slot for a chat request of the user, before the upstream
+        call. Raises a 429 when the user is over either limit.
+        :return: The lease to hand back to `release`.
+        """
+        username = user["username"]
+        concurrency, quota = self.limits(user)
+        try:
+            if quota:
+                usage = await self.usage(username)
+                if usage["tokens"] >= quota:
+                    raise HTTPException(status_code=429, detail="Chat token quota exceeded.",
+                                        headers={"Retry-After": str(self.bucket - int(time.time()) % self.bucket)})
+            if not concurrency:
+                return None
+
+            key, lease, now = f"chatgpt:inflight:{username}", secrets.token_hex(8), time.time()
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.zremrangebyscore(key, "-inf", now - self.lease_ttl)
+                pipe.zadd(key, {lease: now})
+                pipe.zcard(key)
+                pipe.expire(key, self.lease_ttl)
+                running = (await pipe.execute())[2]
+            if running > concurrency:
+                await self.redis.zrem(key, lease)
+                raise HTTPException(status_code=429, detail=f"At most {concurrency} chat requests at a time.",
+                                    headers={"Retry-After": "1"})
+            return lease
+        except RedisError as e:
+            logger.warning(f"Chat limits of {username} could not be checked: {e}")
+            return None
+
+    async def release(self, username: str, lease: Optional[str]):
+        if lease is None:
+            return
+        try:
+            await self.redis.zrem(f"chatgpt:inflight:{username}", lease)
+        except RedisError as e:
+            logger.warning(f"Chat slot of {username} could not be released: {e}")
+
+    async def record(self, username: str, tokens: int, requests: int = 1):
+        """Add the tokens reported by the API to the usage of the user."""
+        key = self._buckets()[-1]
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.hincrby(key, f"tokens:{username}", tokens)
+                pipe.hincrby(key, f"requests:{username}", requests)
+                pipe.expire(key, self.window + self.bucket)
+                await pipe.execute()
+        except RedisError as e:
+            logger.warning(f"Chat usage of {username} could not be recorded: {e}")
+
+    async def usage(self, username: str) -> dict:
+        """Tokens and requests of the user within the rolling window."""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key in self._buckets():
+                pipe.hmget(key, f"tokens:{username}", f"requests:{username}")
+            buckets = await pipe.execute()
+        return {"username": username,
+                "tokens": sum(int(tokens or 0) for tokens, _ in buckets),
+                "requests": sum(int(requests or 0) for _, requests in buckets)}
+
+    async def in_flight(self, username: str) -> int:
+        key = f"chatgpt:inflight:{username}"
+        return await self.redis.zcount(key, time.time() - self.lease_ttl, "+inf")
+
+    async def usage_report(self, top: int = 50) -> List[dict]:
+        """The users with the highest token use within the window."""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key in self._buckets():
+                pipe.hgetall(key)
+            buckets = await pipe.execute()
+
+        totals: Dict[str, Dict[str, int]] = {}
+        for bucket in buckets:
+            for field, value in bucket.items():
+                kind, username = field.split(":", 1)
+                totals.setdefault(username, {"username": username, "tokens": 0, "requests": 0})[kind] += int(value)
+        return sorted(totals.values(), key=lambda usage: usage["tokens"], reverse=True)[:top]
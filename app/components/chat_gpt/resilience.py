@@ -0,0 +1,315 @@
+import asyncio
+import os
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, Optional
+
+import httpx
+from dotenv import load_dotenv
+from fastapi import HTTPException
+
+from app.components.logger import logger
+
+load_dotenv()  # loading environment variables
+
+OPEN_AI_BREAKER_FAILURES = int(os.getenv("open_ai_breaker_failures", 5))  # consecutive failures opening a circuit
+OPEN_AI_BREAKER_RESET = float(os.getenv("open_ai_breaker_reset", 30))  # seconds before a probe request
+OPEN_AI_MAX_RETRIES = int(os.getenv("open_ai_max_retries", 2))
+OPEN_AI_RETRY_BACKOFF = float(os.getenv("open_ai_retry_backoff", 0.5))  # seconds, doubled per retry
+OPEN_AI_RETRY_BACKOFF_MAX = float(os.getenv("open_ai_retry_backoff_max", 8))
+# Retries may add at most this share of the requests of the last `open_ai_retry_budget_window` seconds
+OPEN_AI_RETRY_BUDGET_RATIO = float(os.getenv("open_ai_retry_budget_ratio", 0.2))
+OPEN_AI_RETRY_BUDGET_MIN = int(os.getenv("open_ai_retry_budget_min", 3))  # retries always allowed per window
+OPEN_AI_RETRY_BUDGET_WINDOW = float(os.getenv("open_ai_retry_budget_window", 10))
+OPEN_AI_HEDGE = os.getenv("open_ai_hedge", "false").lower() == "true"
+OPEN_AI_HEDGE_PERCENTILE = float(os.getenv("open_ai_hedge_percentile", 95))
+OPEN_AI_HEDGE_MIN_DELAY = float(os.getenv("open_ai_hedge_min_delay", 1))  # seconds
+LATENCY_SAMPLES = 200  # latencies per model kept for the hedge delay
+LATENCY_MIN_SAMPLES = 20  # no hedging before this many samples
+
+
+class UpstreamError(HTTPException):
+    """An upstream failure as the HTTP error of the route. `retryable` tells callers whether trying again may help."""
+
+    def __init__(self, status_code: int, detail: str, retryable: bool, headers: Dict[str, str] = None):
+        super().__init__(status_code=status_code, detail=detail, headers=headers)
+        self.retryable = retryable
+
+
+def upstream_error(error: Exception) -> UpstreamError:
+    """Map an httpx error of the upstream call to the status code the client gets."""
+    if isinstance(error, UpstreamError):
+        return error
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        if status == 429:
+            headers = {"Retry-After": error.response.headers["retry-after"]} \
+                if "retry-after" in error.response.headers else None
+            return UpstreamError(429, "ChatGPT is rate limited, try again later.", True, headers)
+        if status >= 500:
+            return UpstreamError(502, "ChatGPT returned an error.", True)
+        return UpstreamError(502, "ChatGPT rejected the request.", False)
+    if isinstance(error, httpx.TimeoutException):
+        return UpstreamError(504, "ChatGPT did not answer in time.", True)
+    if isinstance(error, httpx.RequestError):
+        return UpstreamError(502, "ChatGPT could not be reached.", True)
+    return UpstreamError(502, "Unable to fetch response.", False)
+
+
+class CircuitBreaker:
+    """
+    Opens after `failures` consecutive failed calls and rejects calls for `reset_timeout` seconds. Then one
+    probe call is let through: success closes the circuit, failure opens it again. A probe that ends without
+    an outcome (cancelled, or an unexpected error) is abandoned, and the next call probes instead. `clock`
+    returns the current time in seconds, `time.monotonic` unless replaced by a test.
+    """
+
+    def __init__(self, failures: int = OPEN_AI_BREAKER_FAILURES, reset_timeout: float = OPEN_AI_BREAKER_RESET,
+                 clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failures
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if self.clock() - self.opened_at >= self.reset_timeout else "open"
+
+    def retry_after(self) -> int:
+        return max(1, int(self.reset_timeout - (self.clock() - self.opened_at)) + 1) if self.opened_at else 0
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def success(self):
+        self.failures, self.opened_at, self.probing = 0, None, False
+
+    def abandon_probe(self):
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self.probing:
+                logger.warning(f"ChatGPT circuit opened after {self.failures} failures")
+            self.opened_at, self.probing = self.clock(), False
+
+
+class RetryBudget:
+    """
+    Caps retries at `ratio` of the requests made within the last `window` seconds, plus `minimum`, so
+    retries can't multiply the load on an upstream that is already failing.
+    """
+
+    def __init__(self, ratio: float = OPEN_AI_RETRY_BUDGET_RATIO, minimum: int = OPEN_AI_RETRY_BUDGET_MIN,
+                 window: float = OPEN_AI_RETRY_BUDGET_WINDOW):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.window = window
+        self.requests: Deque[float] = deque()
+        self.retries: Deque[float] = deque()
+
+    def _expire(self, now: float):
+        for events in (self.requests, self.retries):
+            while events and events[0] < now - self.window:
+                events.popleft()
+
+    def record_request(self):
+        self.requests.append(time.monotonic())
+
+    def try_retry(self) -> bool:
+        now = time.monotonic()
+        self._expire(now)
+        if len(self.retries) >= self.minimum + self.ratio * len(self.requests):
+            return False
+        self.retries.append(now)
+        return True
+
+
+class LatencyTracker:
+    """Latencies of the latest successful calls, for the hedge delay."""
+
+    def __init__(self, samples: int = LATENCY_SAMPLES):
+        self.samples: Deque[float] = deque(maxlen=samples)
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, percent: float) -> Optional[float]:
+        if len(self.samples) < LATENCY_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+class UpstreamGuard:
+    """
+    Resilience layer of the ChatGPT calls.
+
+    Every model has its own circuit breaker and latency history. Failed calls (connection errors,
+    timeouts, 429 and 5xx) are retried with jittered exponential backoff while the shared retry budget
+    allows it; a 429 with Retry-After waits as long as asked. With hedging enabled, a call still running
+    after the p95 latency of its model gets a second, parallel attempt and the first answer wins.
+    Failures end as an `UpstreamError` carrying the status code for the client.
+    """
+
+    def __init__(self, max_retries: int = OPEN_AI_MAX_RETRIES, budget: RetryBudget = None, hedge: bool = OPEN_AI_HEDGE,
+                 breaker_factory: Callable[[], CircuitBreaker] = CircuitBreaker):
+        self.max_retries = max_retries
+        self.budget = budget or RetryBudget()
+        self.hedge = hedge
+        self.breaker_factory = breaker_factory
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.latencies: Dict[str, LatencyTracker] = {}
+        self.counters = {"calls": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "rejected": 0, "failures": 0}
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        if model not in self.breakers:
+            self.breakers[model] = self.breaker_factory()
+        return self.breakers[model]
+
+    def _check_breaker(self, model: str) -> bool:
+        """:return: Whether the call is the probe of a half-open circuit."""
+        breaker = self.breaker(model)
+        probe = breaker.state == "half_open"
+        if not breaker.allow():
+            self.counters["rejected"] += 1
+            raise UpstreamError(503, "ChatGPT is unavailable, try again later.", True,
+                                {"Retry-After": str(breaker.retry_after())})
+        return probe
+
+    def _backoff(self, attempt: int, error: UpstreamError) -> float:
+        retry_after = (error.headers or {}).get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), OPEN_AI_RETRY_BACKOFF_MAX)
+        return random.uniform(0, min(OPEN_AI_RETRY_BACKOFF * 2 ** attempt, OPEN_AI_RETRY_BACKOFF_MAX))
+
+    async def _retrying(self, model: str, attempt_call: Callable[[], Awaitable]):
+        """Run `attempt_call` until it succeeds, retries are used up or the error is final."""
+        attempt = 0
+        while True:
+            probe = self._check_breaker(model)
+            self.budget.record_request()
+            self.counters["calls"] += 1
+            try:
+                return await attempt_call()
+            except (httpx.HTTPError, UpstreamError) as e:
+                error = upstream_error(e)
+                if error.retryable:
+                    self.breaker(model).failure()
+                else:
+                    self.breaker(model).success()  # the API answered, the request itself was refused
+                self.counters["failures"] += 1
+                if not error.retryable or attempt >= self.max_retries or not self.budget.try_retry():
+                    logger.error(f"ChatGPT call failed after {attempt + 1} attempts: {e}")
+                    raise error from e
+            except BaseException:
+                if probe:
+                    self.breaker(model).abandon_probe()  # otherwise the circuit stays open for good
+                raise
+            delay = self._backoff(attempt, error)
+            attempt += 1
+            self.counters["retries"] += 1
+            logger.warning(f"Retrying ChatGPT call in {delay:.2f}s ({error.detail})")
+            await asyncio.sleep(delay)
+
+    async def post(self, client: httpx.AsyncClient, url: str, payload: dict) -> dict:
+        """
+        POST a request and return the response body, with retries, hedging and the circuit breaker. A body that
+        is not JSON or has no `choices` is a failed call, raised as `UpstreamError` (502).
+        """
+        model = payload.get("model", "")
+
+        async def send() -> dict:
+            started = time.monotonic()
+            response = await client.post(url, json=payload)
+            response.raise_for_status()
+            try:
+                data = response.json()
+                if not isinstance(data["choices"], list):
+                    raise TypeError("choices is not a list")
+            except (ValueError, KeyError, TypeError) as e:
+                # Counted as a failure of the API like a 5xx, a garbled answer may be transient
+                logger.error(f"ChatGPT sent a malformed response: {e!r}")
+                raise UpstreamError(502, "ChatGPT sent a malformed response.", True) from e
+            self.breaker(model).success()
+            self.latencies.setdefault(model, LatencyTracker()).add(time.monotonic() - started)
+            return data
+
+        async def attempt() -> dict:
+            delay = self.hedge_delay(model)
+            return await (self._hedged(send, delay) if delay is not None else send())
+
+        return await self._retrying(model, attempt)
+
+    def hedge_delay(self, model: str) -> Optional[float]:
+        if not self.hedge or model not in self.latencies:
+            return None
+        p95 = self.latencies[model].percentile(OPEN_AI_HEDGE_PERCENTILE)
+        return None if p95 is None else max(p95, OPEN_AI_HEDGE_MIN_DELAY)
+
+    async def _hedged(self, send: Callable[[], Awaitable[dict]], delay: float) -> dict:
+        first = asyncio.ensure_future(send())
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done or not self.budget.try_retry():
+            return await first
+
+        self.counters["hedges"] += 1
+        second = asyncio.ensure_future(send())
+        pending = {first, second}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.counters["hedge_wins"] += 1
+                        return task.result()
+            return await first  # both failed, raise the error of the original attempt
+        finally:
+            for task in pending:
+                task.cancel()
+
+    @asynccontextmanager
+    async def stream(self, client: httpx.AsyncClient, url: str, payload: dict) -> AsyncIterator[httpx.Response]:
+        """
+        Open a streamed response. Opening is retried like `post`; once the body is being read, errors are
+        raised to the caller because the tokens already sent can't be taken back.
+        """
+        model = payload.get("model", "")
+
+        async def open_stream() -> httpx.Response:
+            response = await client.send(client.build_request("POST", url, json=payload), stream=True)
+            if response.is_error:
+                await response.aread()
+                await response.aclose()
+                response.raise_for_status()
+            self.breaker(model).success()
+            return response
+
+        response = await self._retrying(model, open_stream)
+        try:
+            yield response
+        finally:
+            await response.aclose()
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "hedging": self.hedge,
+            "models": {model: {"circuit": breaker.state, "consecutive_failures": breaker.failures,
+                               "hedge_delay": self.hedge_delay(model)}
+                       for model, breaker in self.breakers.items()},
+        }
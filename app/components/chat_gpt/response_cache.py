@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from dotenv import load_dotenv
+from redis.exceptions import RedisError
+
+from app.classes.Chatgpt import CachePolicy, ChatGptModelEnum
+from app.components.logger import logger
+
+load_dotenv()  # loading environment variables
+
+CHATGPT_CACHE_TTL = int(os.getenv("chatgpt_cache_ttl", 3600))  # seconds in Redis
+CHATGPT_CACHE_LOCAL_TTL = int(os.getenv("chatgpt_cache_local_ttl", 300))  # seconds in the in-process LRU
+CHATGPT_CACHE_LOCAL_SIZE = int(os.getenv("chatgpt_cache_local_size", 1024))  # answers kept per worker
+# Per-model overrides as JSON, e.g. {"gpt-4": {"ttl": 86400}, "gpt-3.5-turbo": {"enabled": false}}
+CHATGPT_CACHE_POLICIES = os.getenv("chatgpt_cache_policies", "{}")
+
+
+def load_cache_policies() -> Dict[str, CachePolicy]:
+    """Default policy for every model, updated with the overrides of `chatgpt_cache_policies`."""
+    try:
+        overrides = json.loads(CHATGPT_CACHE_POLICIES)
+    except json.JSONDecodeError as e:
+        logger.error(f"Ignoring invalid chatgpt_cache_policies: {e}")
+        overrides = {}
+
+    return {
+        model.value: CachePolicy(ttl=CHATGPT_CACHE_TTL, local_ttl=CHATGPT_CACHE_LOCAL_TTL,
+                                 **overrides.get(model.value, {}))
+        for model in ChatGptModelEnum
+    }
+
+
+def normalize_question(question: str) -> str:
+    """Questions differing only in case or whitespace share a cache entry."""
+    return " ".join(question.split()).casefold()
+
+
+def cache_key(model: str, question: str) -> str:
+    digest = hashlib.sha256(normalize_question(question).encode("utf-8")).hexdigest()
+    return f"chatgpt:answer:{model}:{digest}"
+
+
+class LocalLRUCache:
+    """Small in-process LRU with a TTL per entry, in front of Redis."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: str, ttl: int):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ChatResponseCache:
+    """
+    Two-tier cache of ChatGPT answers keyed by model and normalized question.
+
+    Lookups go to the in-process LRU first and to Redis second, so repeated questions are answered
+    without an upstream call and, most of the time, without a network round trip. Redis errors are
+    logged and treated as misses; the cache never fails a chat request.
+    """
+
+    def __init__(self, redis_client, local_size: int = CHATGPT_CACHE_LOCAL_SIZE,
+                 policies: Dict[str, CachePolicy] = None):
+        self.redis = redis_client
+        self.local = LocalLRUCache(local_size)
+        self.policies = policies or load_cache_policies()
+        self.counters = {"local_hits": 0, "redis_hits": 0, "misses": 0, "writes": 0, "bypasses": 0, "errors": 0}
+
+    def policy(self, model: str) -> CachePolicy:
+        return self.policies.get(model) or CachePolicy(enabled=False)
+
+    async def get(self, model: str, question: str) -> Tuple[Optional[str], str]:
+        """
+        Look up an answer.
+        :return: The answer (or None) and where it was found: "local", "redis" or "miss".
+        """
+        policy = self.policy(model)
+        if not policy.enabled:
+            self.counters["bypasses"] += 1
+            return None, "bypass"
+
+        key = cache_key(model, question)
+        answer = self.local.get(key)
+        if answer is not None:
+            self.counters["local_hits"] += 1
+            return answer, "local"
+
+        try:
+            answer = await self.redis.get(key)
+        except RedisError as e:
+            self.counters["errors"] += 1
+            logger.warning(f"ChatGPT cache lookup failed: {e}")
+            answer = None
+
+        if answer is not None:
+            self.counters["redis_hits"] += 1
+            self.local.set(key, answer, policy.local_ttl)
+            return answer, "redis"
+
+        self.counters["misses"] += 1
+        return None, "miss"
+
+    async def set(self, model: str, question: str, answer: str):
+        policy = self.policy(model)
+        if not policy.enabled:
+            return
+
+        key = cache_key(model, question)
+        self.local.set(key, answer, policy.local_ttl)
+        try:
+            await self.redis.set(key, answer, ex=policy.ttl)
+            self.counters["writes"] += 1
+        except RedisError as e:
+            self.counters["errors"] += 1
+            logger.warning(f"ChatGPT cache write failed: {e}")
+
+    def stats(self) -> dict:
+        hits = self.counters["local_hits"] + self.counters["redis_hits"]
+        lookups = hits + self.counters["misses"]
+        return {
+            **self.counters,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "local_entries": len(self.local),
+            "policies": {model: policy.model_dump() for model, policy in self.policies.items()},
+        }
@@ -0,0 +1,161 @@
+import asyncio
+import json
+import os
+import secrets
+import time
+from typing import Awaitable, Callable, Dict
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from redis.exceptions import RedisError
+
+from app.classes.Chatgpt import ChatAnswer
+from app.components.logger import logger
+
+load_dotenv()  # loading environment variables
+
+# "local" coalesces within a worker, "redis" also across workers, "off" disables coalescing
+CHATGPT_SINGLE_FLIGHT = os.getenv("chatgpt_single_flight", "local").lower()
+CHATGPT_SINGLE_FLIGHT_LOCK_TTL = float(os.getenv("chatgpt_single_flight_lock_ttl", 90))  # seconds
+CHATGPT_SINGLE_FLIGHT_WAIT = float(os.getenv("chatgpt_single_flight_wait", 90))  # seconds a follower waits
+CHATGPT_SINGLE_FLIGHT_RESULT_TTL = 5  # seconds the result stays readable for followers that subscribed late
+
+# Release the lock only if it is still ours
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical chat requests into a single upstream call.
+
+    Within a worker, the first caller for a key runs the call and every concurrent caller awaits the
+    same future. In "redis" mode the first worker to take the lock `chatgpt:flight:lock:<key>` is the
+    leader; the others subscribe to `chatgpt:flight:done:<key>` and receive its result, or run the call
+    themselves when the leader does not answer within `chatgpt_single_flight_wait` seconds, or its lock is gone
+    without an answer.
+    Answers handed to followers are marked `shared` and carry no token usage.
+
+    A follower holds a connection while it is subscribed: `pubsub_client` is the client the subscriptions use,
+    with a connection pool of its own (`AsyncRedisClient.get_pubsub_instance`), `redis_client` when not set.
+    """
+
+    def __init__(self, redis_client=None, mode: str = CHATGPT_SINGLE_FLIGHT,
+                 lock_ttl: float = CHATGPT_SINGLE_FLIGHT_LOCK_TTL, wait_timeout: float = CHATGPT_SINGLE_FLIGHT_WAIT,
+                 pubsub_client=None):
+        self.redis = redis_client
+        self.pubsub_client = pubsub_client or redis_client
+        self.mode = mode if mode in ("local", "redis") else "off"
+        self.lock_ttl = lock_ttl
+        self.wait_timeout = wait_timeout
+        self.counters = {"leaders": 0, "local_followers": 0, "remote_followers": 0, "fallbacks": 0}
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+    async def do(self, key: str, call: Callable[[], Awaitable[ChatAnswer]]) -> ChatAnswer:
+        if self.mode == "off":
+            return await call()
+
+        task = self._in_flight.get(key)
+        leader = task is None
+        if leader:
+            # The call runs in its own task, so a leader whose client disconnects doesn't cancel it for the others
+            task = asyncio.create_task(self._lead(key, call))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        else:
+            self.counters["local_followers"] += 1
+
+        answer = await asyncio.shield(task)
+        return answer if leader else answer.model_copy(update={"shared": True, "usage": None})
+
+    def _finish(self, key: str, task: asyncio.Task):
+        self._in_flight.pop(key, None)
+        if not task.cancelled():
+            task.exception()  # retrieved here in case every waiter went away
+
+    async def _lead(self, key: str, call: Callable[[], Awaitable[ChatAnswer]]) -> ChatAnswer:
+        if self.mode == "redis" and self.redis is not None:
+            return await self._do_distributed(key, call)
+        self.counters["leaders"] += 1
+        return await call()
+
+    async def _do_distributed(self, key: str, call: Callable[[], Awaitable[ChatAnswer]]) -> ChatAnswer:
+        lock_key, channel, result_key = (f"chatgpt:flight:lock:{key}", f"chatgpt:flight:done:{key}",
+                                         f"chatgpt:flight:result:{key}")
+        token = secrets.token_hex(8)
+        try:
+            leader = await self.redis.set(lock_key, token, nx=True, px=int(self.lock_ttl * 1000))
+        except RedisError as e:
+            logger.warning(f"Single-flight lock failed, calling upstream directly: {e}")
+            self.counters["fallbacks"] += 1
+            return await call()
+
+        if not leader:
+            answer = await self._wait_for_leader(lock_key, channel, result_key)
+            if answer is not None:
+                self.counters["remote_followers"] += 1
+                return answer
+            self.counters["fallbacks"] += 1
+            return await call()
+
+        self.counters["leaders"] += 1
+        outcome = None
+        try:
+            answer = await call()
+            outcome = {"ok": True, "answer": answer.model_dump()}
+            return answer
+        except HTTPException as e:
+            outcome = {"ok": False, "status": e.status_code, "detail": e.detail}
+            raise
+        except Exception:  # noqa
+            outcome = {"ok": False, "status": 502, "detail": "Unable to fetch response."}
+            raise
+        finally:
+            await self._share(lock_key, token, channel, result_key, outcome)
+
+    async def _share(self, lock_key: str, token: str, channel: str, result_key: str, outcome: dict = None):
+        """Hand the outcome to the waiting workers and release the lock."""
+        try:
+            if outcome is not None:
+                payload = json.dumps(outcome)
+                await self.redis.set(result_key, payload, ex=CHATGPT_SINGLE_FLIGHT_RESULT_TTL)
+                await self.redis.publish(channel, payload)
+            await self.redis.eval(RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+        except RedisError as e:
+            logger.warning(f"Single-flight result could not be shared: {e}")
+
+    async def _wait_for_leader(self, lock_key: str, channel: str, result_key: str):
+        pubsub = self.pubsub_client.pubsub()
+        try:
+            await pubsub.subscribe(channel)
+            # The leader may have finished before we subscribed
+            payload = await self.redis.get(result_key)
+            deadline = time.monotonic() + self.wait_timeout
+            while payload is None and time.monotonic() < deadline:
+                message = await pubsub.get_message(ignore_subscribe_messages=True,
+                                                   timeout=min(1.0, deadline - time.monotonic()))
+                if message is not None:
+                    payload = message["data"]
+                elif not await self.redis.exists(lock_key):
+                    # The leader released the lock without an outcome (cancelled) or its lock expired
+                    payload = await self.redis.get(result_key)
+                    break
+        except RedisError as e:
+            logger.warning(f"Waiting for the single-flight leader failed: {e}")
+            return None
+        finally:
+            await pubsub.aclose()
+
+        if payload is None:
+            return None
+        outcome = json.loads(payload)
+        if not outcome["ok"]:
+            raise HTTPException(status_code=outcome["status"], detail=outcome["detail"])
+        return ChatAnswer(**outcome["answer"]).model_copy(update={"shared": True, "usage": None})
+
+    def stats(self) -> dict:
+        return {"mode": self.mode, "in_flight": len(self._in_flight), **self.counters}
@@ -7,6 +7,7 @@ from dotenv import load_dotenv
 
 from app.classes.User import UserCreate
 from app.components.logger import logger
+from app.components.message_dispatcher.email_history import create_email_history_indexes
 from app.db.mongoClient import async_database
 from app.routers.users import create_user
 
@@ -30,11 +31,15 @@ async def check_key_not_expired(redis_client, key):
 async def create_indexes():
     await async_database.users.create_index("email", unique=True)
     await async_database.users.create_index("username", unique=True)
+    await create_email_history_indexes()
 
 async def create_owner():
     # Fetch owner's email and username from environment variables
     owner_email = os.getenv("owner_email")
     owner_username = os.getenv("owner_username")
+    if not owner_email or not owner_username:
+        logger.warning("owner_email or owner_username is not set, no owner account created.")
+        return
 
     # Assuming async_database.users is your collection from an async database
     user_collection = async_database.users
@@ -66,8 +71,6 @@ async def create_owner():
     except pymongo.errors.DuplicateKeyError:
         logger.info("Owner already exists, skipping creation.")
 
-    logger.info("Owner created successfully.")
-
 
 async def initialize_message_settings():
     settings_collection = async_database.settings  # Assuming a collection named 'settings'
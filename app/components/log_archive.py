@@ -0,0 +1,279 @@
+"""
+Compression and retention of the daily log files, and a reader searching them.
+
+`DailyRotatingFileHandler` writes `logs/YYYY-MM/fastapi_YYYY-MM-DD.log`. Once a day is over, `LogArchiver`
+compresses its file (gzip, or zstd when `zstandard` is installed) and removes the oldest days beyond the
+retention. Both run in a worker thread, the event loop only schedules them. With several workers writing
+the same log tree (`uvicorn --workers N`) a lock file lets one of them archive at a time.
+
+Compressed and plain days are read the same way, streamed line by line without unpacking them to disk:
+
+    python -m app.components.log_archive grep "Permission denied" --since 2024-05-01 --until 2024-05-31
+    python -m app.components.log_archive archive
+"""
+import argparse
+import asyncio
+import gzip
+import io
+import os
+import re
+import shutil
+import time
+from contextlib import contextmanager, suppress
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from typing import IO, Iterator, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from app.components.logger import base_log_dir, handler, logger
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, gzip is always available
+    zstandard = None
+
+load_dotenv()  # loading environment variables
+
+LOG_COMPRESSION = os.getenv("log_compression", "gzip").lower()  # "gzip", "zstd" or "off"
+LOG_RETENTION_DAYS = int(os.getenv("log_retention_days", 30))  # days of logs kept, 0 keeps every day
+LOG_MAX_TOTAL_MB = float(os.getenv("log_max_total_mb", 0))  # size budget of the log tree, 0 is unlimited
+LOG_ARCHIVE_INTERVAL = float(os.getenv("log_archive_interval", 600))  # seconds between two runs
+LOG_ARCHIVE_MIN_AGE = 60  # seconds a closed file stays untouched, records queued before midnight may still arrive
+LOG_ARCHIVE_LOCK = ".archive.lock"  # in the log directory, held during a run
+LOG_ARCHIVE_LOCK_STALE = 3600  # seconds after which the lock of a worker that died during a run is taken over
+
+EXTENSIONS = {".gz": "gzip", ".zst": "zstd", "": None}
+
+
+@dataclass
+class LogFile:
+    day: date
+    path: str
+    size: int
+
+
+@dataclass
+class ArchiveResult:
+    compressed: List[str] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+    bytes_saved: int = 0
+    bytes_removed: int = 0
+
+
+def _parse_day(filename: str, base_filename: str) -> Optional[Tuple[date, str]]:
+    """The day and compression extension of `<base>_YYYY-MM-DD.log[.gz|.zst]`, None for other files."""
+    match = re.fullmatch(rf"{re.escape(base_filename)}_(\d{{4}}-\d{{2}}-\d{{2}})\.log(\.gz|\.zst)?", filename)
+    if not match:
+        return None
+    try:
+        return datetime.strptime(match.group(1), "%Y-%m-%d").date(), match.group(2) or ""
+    except ValueError:
+        return None
+
+
+def log_files(dir_name: str = base_log_dir, base_filename: str = handler.base_filename) -> List[LogFile]:
+    """Every daily log file of the tree, plain or compressed, oldest first."""
+    files = []
+    for root, _, names in os.walk(dir_name):
+        for name in names:
+            parsed = _parse_day(name, base_filename)
+            if parsed is not None:
+                path = os.path.join(root, name)
+                files.append(LogFile(parsed[0], path, os.path.getsize(path)))
+    return sorted(files, key=lambda log_file: (log_file.day, log_file.path))
+
+
+def compress_file(path: str, method: str) -> str:
+    """
+    Compress a log file next to itself and remove the original.
+    The result is written to a temporary name first, so an interrupted run leaves the plain file intact.
+    """
+    if method == "zstd":
+        target = f"{path}.zst"
+        with open(path, "rb") as source, open(f"{target}.tmp", "wb") as destination:
+            zstandard.ZstdCompressor(level=9).copy_stream(source, destination)
+    else:
+        target = f"{path}.gz"
+        with open(path, "rb") as source, gzip.open(f"{target}.tmp", "wb", compresslevel=6) as destination:
+            shutil.copyfileobj(source, destination, 1024 * 1024)
+    os.replace(f"{target}.tmp", target)
+    os.remove(path)
+    return target
+
+
+@contextmanager
+def archive_lock(dir_name: str) -> Iterator[bool]:
+    """
+    Take the lock file of an archive run, created with O_EXCL so only one process gets it.
+    Yields whether this process holds it; the others skip the run.
+    """
+    path = os.path.join(dir_name, LOG_ARCHIVE_LOCK)
+    with suppress(FileNotFoundError):
+        if time.time() - os.path.getmtime(path) > LOG_ARCHIVE_LOCK_STALE:
+            os.remove(path)
+    try:
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        with suppress(FileNotFoundError):
+            os.remove(path)
+
+
+def _compression() -> Optional[str]:
+    if LOG_COMPRESSION == "off":
+        return None
+    if LOG_COMPRESSION == "zstd" and zstandard is None:
+        logger.warning("log_compression is zstd but zstandard is not installed, using gzip")
+        return "gzip"
+    return "zstd" if LOG_COMPRESSION == "zstd" else "gzip"
+
+
+def archive_logs(dir_name: str = base_log_dir, base_filename: str = handler.base_filename,
+                 compression: Optional[str] = "gzip", retention_days: int = LOG_RETENTION_DAYS,
+                 max_total_bytes: int = int(LOG_MAX_TOTAL_MB * 1024 * 1024), today: date = None) -> ArchiveResult:
+    """
+    Compress the closed days and remove the days beyond the retention: older than `retention_days`, then
+    the oldest ones while the tree is larger than `max_total_bytes`. Today's file is never touched.
+    Nothing is done while another process archives the same tree. Blocking, run it in a worker thread.
+    """
+    with archive_lock(dir_name) as locked:
+        if not locked:
+            logger.info("Log archive skipped, another worker is archiving %s", dir_name)
+            return ArchiveResult()
+        return _archive_logs(dir_name, base_filename, compression, retention_days, max_total_bytes,
+                             today or date.today())
+
+
+def _archive_logs(dir_name: str, base_filename: str, compression: Optional[str], retention_days: int,
+                  max_total_bytes: int, today: date) -> ArchiveResult:
+    result = ArchiveResult()
+    for log_file in log_files(dir_name, base_filename):
+        if (compression is None or log_file.day >= today or not log_file.path.endswith(".log")
+                or time.time() - os.path.getmtime(log_file.path) < LOG_ARCHIVE_MIN_AGE):
+            continue
+        compressed = compress_file(log_file.path, compression)
+        result.compressed.append(compressed)
+        result.bytes_saved += log_file.size - os.path.getsize(compressed)
+
+    files = log_files(dir_name, base_filename)
+    total = sum(log_file.size for log_file in files)
+    oldest_kept = today - timedelta(days=retention_days - 1) if retention_days > 0 else date.min
+    for log_file in files:
+        if log_file.day >= today:
+            break
+        if log_file.day >= oldest_kept and (not max_total_bytes or total <= max_total_bytes):
+            continue
+        os.remove(log_file.path)
+        total -= log_file.size
+        result.removed.append(log_file.path)
+        result.bytes_removed += log_file.size
+
+    for root, directories, names in os.walk(dir_name, topdown=False):
+        if root != dir_name and not directories and not names:
+            os.rmdir(root)  # a month without days left
+    return result
+
+
+def open_log_file(path: str) -> IO[str]:
+    """Open a plain or compressed log file for reading text, decompressing while it is read."""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError(f"zstandard is needed to read {path}")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True),
+                                encoding="utf-8", errors="replace")
+    return open(path, encoding="utf-8", errors="replace")
+
+
+def read_logs(since: date = None, until: date = None, dir_name: str = base_log_dir,
+              base_filename: str = handler.base_filename) -> Iterator[Tuple[date, str]]:
+    """Stream the lines of the days from `since` to `until` (both included), oldest first."""
+    for log_file in log_files(dir_name, base_filename):
+        if (since and log_file.day < since) or (until and log_file.day > until):
+            continue
+        with open_log_file(log_file.path) as lines:
+            for line in lines:
+                yield log_file.day, line.rstrip("\n")
+
+
+def grep_logs(pattern: str, since: date = None, until: date = None, ignore_case: bool = False,
+              limit: int = None, dir_name: str = base_log_dir,
+              base_filename: str = handler.base_filename) -> Iterator[Tuple[date, str]]:
+    """Stream the lines matching the regular expression `pattern`, stopping after `limit` matches."""
+    regex = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+    matches = 0
+    for day, line in read_logs(since, until, dir_name, base_filename):
+        if regex.search(line):
+            yield day, line
+            matches += 1
+            if limit and matches >= limit:
+                return
+
+
+class LogArchiver:
+    """Background job compressing closed log days and enforcing the retention, every `interval` seconds."""
+
+    def __init__(self, interval: float = LOG_ARCHIVE_INTERVAL):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._task is None and (_compression() or LOG_RETENTION_DAYS > 0 or LOG_MAX_TOTAL_MB > 0):
+            self._task = asyncio.create_task(self._run())
+
+    async def run_once(self) -> ArchiveResult:
+        result = await asyncio.to_thread(archive_logs, compression=_compression())
+        if result.compressed or result.removed:
+            logger.info("Log archive: %s days compressed (%s bytes saved), %s days removed (%s bytes)",
+                        len(result.compressed), result.bytes_saved, len(result.removed), result.bytes_removed)
+        return result
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:  # noqa, the next run tries again
+                logger.error("Log archive failed: %r", e, exc_info=e)
+            await asyncio.sleep(self.interval)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+log_archiver = LogArchiver()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search and archive the daily log files")
+    commands = parser.add_subparsers(dest="command", required=True)
+    grep = commands.add_parser("grep", help="print the lines matching a regular expression")
+    grep.add_argument("pattern")
+    grep.add_argument("--since", type=date.fromisoformat, help="first day, YYYY-MM-DD")
+    grep.add_argument("--until", type=date.fromisoformat, help="last day, YYYY-MM-DD")
+    grep.add_argument("-i", "--ignore-case", action="store_true")
+    grep.add_argument("--limit", type=int, help="stop after this many matches")
+    commands.add_parser("archive", help="compress closed days and apply the retention now")
+    args = parser.parse_args()
+
+    if args.command == "grep":
+        for day, line in grep_logs(args.pattern, args.since, args.until, args.ignore_case, args.limit):
+            print(f"{day} {line}")
+    else:
+        result = archive_logs(compression=_compression())
+        print(f"{len(result.compressed)} days compressed, {len(result.removed)} days removed")
+
+
+if __name__ == "__main__":
+    main()
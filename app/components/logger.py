@@ -1,60 +1,256 @@
+import atexit
+import json
 import logging
 import os
-from datetime import datetime
-from logging.handlers import BaseRotatingHandler
+import queue
+import random
+import time
+import zlib
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+from logging.handlers import BaseRotatingHandler, QueueHandler, QueueListener
+
+from dotenv import load_dotenv
+
+load_dotenv()  # loading environment variables
+
+LOG_FORMAT = os.getenv("log_format", "json")  # "json": one JSON object per line, "text": plain lines as before
+LOG_QUEUE_SIZE = int(os.getenv("log_queue_size", 100000))  # records waiting for the writer, newer ones are dropped
+LOG_BATCH_SIZE = int(os.getenv("log_batch_size", 256))  # records written between two flushes
+# Share of INFO and DEBUG records kept, by event or logger name, e.g. {"permission_granted": 0.01}
+DEFAULT_SAMPLE_RATES = {"permission_granted": 0.1, "user_list": 0.1, "request": 0.1}
+
+# Fields of the request being handled, set by RequestContextMiddleware and added to every record logged for it
+log_context: ContextVar[dict] = ContextVar("log_context")
+
+
+def _sample_rates() -> dict:
+    try:
+        return {**DEFAULT_SAMPLE_RATES, **json.loads(os.getenv("log_sample_rates", "{}"))}
+    except (TypeError, ValueError) as e:
+        logging.getLogger(__name__).error("Ignoring invalid log_sample_rates: %s", e)
+        return dict(DEFAULT_SAMPLE_RATES)
+
+
+def bind_log_context(**fields):
+    """Add fields, e.g. the user, to the records of the request being handled."""
+    context = log_context.get(None)
+    if context is not None:
+        context.update(fields)
 
 
 class DailyRotatingFileHandler(BaseRotatingHandler):
     """Rotating file handler that rotates the file every day."""
 
-    def __init__(self, dir_name, base_filename, encoding=None):
+    def __init__(self, dir_name, base_filename, encoding=None, buffered=False):
         """
         :param dir_name: Directory to store monthly folders
+        :param buffered: Leave flushing to the caller, e.g. once per batch of records
         """
         self.dir_name = dir_name  # Directory to store monthly folders
         self.base_filename = base_filename  # Base name for log files
         self.encoding = encoding
+        self.buffered = buffered
         self.current_date = None
+        self.rollover_at = None  # timestamp of the next midnight
         filename = self._get_filename()  # Initial filename
         os.makedirs(os.path.dirname(filename), exist_ok=True)  # Ensure directory exists
         BaseRotatingHandler.__init__(self, filename, 'a', encoding, delay=True)
 
-    def _get_filename(self):
-        """Generate a filename based on the current date."""
-        now = datetime.now()
+    def _get_filename(self, timestamp=None):
+        """Generate a filename based on the date of the timestamp (default: now)."""
+        now = datetime.fromtimestamp(timestamp) if timestamp is not None else datetime.now()
         month_dir = now.strftime('%Y-%m')  # Format: YYYY-MM
         date_str = now.strftime('%Y-%m-%d')  # Format: YYYY-MM-DD
         self.current_date = date_str
+        next_midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+        self.rollover_at = next_midnight.timestamp()
         filename = f"{self.base_filename}_{date_str}.log"
         full_path = os.path.join(self.dir_name, month_dir, filename)
         return full_path
 
     def shouldRollover(self, record):  # noqa
-        """Determine if we should rollover to a new file."""
-        now = datetime.now().strftime('%Y-%m-%d')
-        return self.current_date != now  # True if the date has changed
+        """Determine if we should rollover to a new file: the record was created after midnight."""
+        return record.created >= self.rollover_at
+
+    def doRollover(self, timestamp=None):  # noqa
+        """Roll over to the log file of the timestamp (default: now)."""
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        self.baseFilename = os.path.abspath(self._get_filename(timestamp))
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+
+    def emit(self, record):
+        try:
+            if self.shouldRollover(record):
+                self.doRollover(record.created)
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+            if not self.buffered:
+                self.flush()
+        except Exception:  # noqa
+            self.handleError(record)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Queue handler that leaves all formatting to the listener thread.
+
+    The stock `QueueHandler.prepare` formats every record in the calling thread so it can be pickled;
+    records here never leave the process, so the caller only pays for putting the record on the queue.
+    A `queue.SimpleQueue` is the cheapest to put on; when more than `max_size` records are waiting,
+    new ones are dropped and counted instead of growing the queue or blocking the event loop.
+    """
+
+    def __init__(self, log_queue, max_size=LOG_QUEUE_SIZE):
+        super().__init__(log_queue)
+        self.max_size = max_size
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        if self.queue.qsize() >= self.max_size:
+            self.dropped += 1
+            return
+        self.queue.put_nowait(record)
+
+
+class RequestContextFilter(logging.Filter):
+    """
+    Copies the fields of the current request onto the record: request id, user, method, route and the
+    time since the request started. Runs in the calling thread, where the request context is known.
+    """
+
+    def filter(self, record):
+        context = log_context.get(None)
+        if context is not None:
+            record.request_id = context["request_id"]
+            record.user = context.get("user")
+            record.method = context["method"]
+            route = context["scope"].get("route")  # the route template once the request is routed
+            record.route = route.path if route is not None else context["scope"]["path"]
+            record.duration_ms = round((time.perf_counter() - context["started"]) * 1000, 2)
+        return True
+
 
-    def doRollover(self):  # noqa
-        """Roll over to a new log file."""
-        self.stream.close()
-        self.baseFilename = self._get_filename()
-        self.stream = self._open()
+class SamplingFilter(logging.Filter):
+    """
+    Keeps only a share of the INFO and DEBUG records of high-volume events; warnings and errors are always kept.
 
+    The rate is looked up by the `event` of the record (`extra={"event": ...}`), then by the logger name.
+    Within a request, the decision depends on the request id only, so a sampled request keeps all its lines.
+    """
 
-# Create base 'logs' directory if it doesn't exist
-base_log_dir = 'logs'
+    def __init__(self, rates: dict = None):
+        super().__init__()
+        self.rates = _sample_rates() if rates is None else rates
+        self.dropped = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        rate = self.rates.get(getattr(record, "event", None), self.rates.get(record.name))
+        if rate is None or rate >= 1:
+            return True
+        request_id = getattr(record, "request_id", None)
+        if request_id is not None:
+            keep = zlib.crc32(request_id.encode()) / 0xFFFFFFFF < rate
+        else:
+            keep = random.random() < rate
+        if not keep:
+            self.dropped += 1
+        return keep
+
+
+# Attributes every LogRecord has, anything else was passed as `extra` and is written as a field
+_RECORD_ATTRIBUTES = set(logging.LogRecord("", 0, "", 0, "", None, None).__dict__) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object: time, level, logger, message and the extra fields."""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class BatchingQueueListener(QueueListener):
+    """
+    Queue listener writing records in batches: it takes every record already waiting (up to `batch_size`),
+    hands them to the handlers and flushes the handlers once per batch instead of once per record.
+    """
+
+    def __init__(self, log_queue, *handlers, batch_size=LOG_BATCH_SIZE, respect_handler_level=True):
+        super().__init__(log_queue, *handlers, respect_handler_level=respect_handler_level)
+        self.batch_size = batch_size
+
+    def _monitor(self):
+        stop = False
+        while not stop:
+            batch = [self.dequeue(True)]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.dequeue(False))
+                except queue.Empty:
+                    break
+
+            for record in batch:
+                if record is self._sentinel:
+                    stop = True
+                else:
+                    self.handle(record)
+            for handler in self.handlers:
+                try:
+                    handler.flush()
+                except (OSError, ValueError):  # e.g. a console closed at exit, the writer keeps running
+                    pass
+
+
+# Create the base log directory if it doesn't exist, log_dir defaults to 'logs' in the working directory
+base_log_dir = os.getenv("log_dir", "logs")
 if not os.path.exists(base_log_dir):
     os.makedirs(base_log_dir)
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Use the custom handler
-handler = DailyRotatingFileHandler(base_log_dir, 'fastapi', encoding='utf-8')
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')  # noqa
+# The console and the daily file are written by a background thread. Log calls only put the record on
+# a queue, so the request path never waits for formatting or file I/O.
+# The filters run before the record is queued: the request fields are only known in the calling thread,
+# and sampled-out records cost nothing more.
+log_queue = queue.SimpleQueue()
+queue_handler = DeferredQueueHandler(log_queue)
+queue_handler.addFilter(RequestContextFilter())
+queue_handler.addFilter(SamplingFilter())
+
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(logging.BASIC_FORMAT))
+
+# Use the custom handler, for the records of this logger only as before
+handler = DailyRotatingFileHandler(base_log_dir, 'fastapi', encoding='utf-8', buffered=True)
+formatter = JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')  # noqa
 handler.setFormatter(formatter)
-logger.addHandler(handler)
+handler.addFilter(logging.Filter(logger.name))
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, handlers=[queue_handler], force=True)
+
+listener = BatchingQueueListener(log_queue, console_handler, handler)
+listener.start()
+atexit.register(listener.stop)  # writes what is still queued
 
 # Ensure that logging of each log level gets propagated to the root logger
 logger.propagate = True
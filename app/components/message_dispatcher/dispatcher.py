@@ -0,0 +1,216 @@
+import asyncio
+import os
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from bson import ObjectId
+from dotenv import load_dotenv
+from fastapi import HTTPException
+
+from app.classes.Messages import ChannelEnum, DispatchResult, OutgoingMessage
+from app.components.logger import logger
+from app.db.mongoClient import async_database
+
+load_dotenv()  # loading environment variables
+
+MESSAGE_CONFIG_TTL = float(os.getenv("message_config_ttl", 30))  # seconds a channel reuses the loaded settings
+
+# mongo connection
+config_collection = async_database.settings
+
+
+class RateLimiter:
+    """Token bucket limiting how many messages per second a channel hands to its provider."""
+
+    def __init__(self, rate: float, burst: Optional[int] = None):
+        """
+        :param rate: Messages per second, 0 disables the limit.
+        :param burst: How many messages may be sent at once after an idle period, defaults to `rate`.
+        """
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int = 1):
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                # A batch larger than the bucket is let through once the bucket is full and leaves a debt
+                # that the following callers wait for, so the average rate is kept either way
+                needed = min(tokens, self.capacity)
+                if self._tokens >= needed:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((needed - self._tokens) / self.rate)
+
+
+class MessageChannel(ABC):
+    """
+    Base class of a message provider.
+
+    Messages handed to `send` are queued and picked up by `pool_size` workers. Each worker collects up
+    to `batch_size` messages (waiting at most `batch_window` seconds for the batch to fill up), waits
+    for the rate limiter and passes the batch to `deliver_batch`. Subclasses own their connection pool
+    and implement `deliver_batch` and `close_pool`. When the provider settings change, `close_pool` is called
+    while other workers may still be delivering: it must let their batches finish on the old connections.
+    """
+
+    channel: ChannelEnum
+    config_key: str  # key of the provider settings in the settings document
+
+    def __init__(self, rate_limit: float = None, pool_size: int = None, batch_size: int = None,
+                 batch_window: float = None):
+        prefix = self.config_key
+        self.rate_limiter = RateLimiter(rate_limit if rate_limit is not None
+                                        else float(os.getenv(f"{prefix}_rate_limit", 10)))
+        self.pool_size = pool_size or int(os.getenv(f"{prefix}_pool_size", 4))
+        self.batch_size = batch_size or int(os.getenv(f"{prefix}_batch_size", 20))
+        self.batch_window = batch_window if batch_window is not None \
+            else float(os.getenv(f"{prefix}_batch_window_ms", 50)) / 1000
+        self.sent = 0
+        self.failed = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._config: Optional[dict] = None
+        self._config_loaded_at = 0.0
+
+    async def get_config(self) -> dict:
+        """Provider settings from MongoDB, reloaded every `message_config_ttl` seconds."""
+        if self._config is None or time.monotonic() - self._config_loaded_at > MESSAGE_CONFIG_TTL:
+            settings = await config_collection.find_one({"_id": ObjectId("65fdaaca4f94194ff730d3be")})
+            config = (settings or {}).get(self.config_key) or {}
+            if self._config is not None and config != self._config:
+                # Credentials or host changed, connections of the old settings can't be reused
+                await self.close_pool()
+            self._config = config
+            self._config_loaded_at = time.monotonic()
+        return self._config
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.pool_size)]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self._queue is not None:
+            # Nobody is going to deliver what is left, release the callers
+            while not self._queue.empty():
+                message, future = self._queue.get_nowait()
+                if not future.done():
+                    future.set_result(self._result(message, error="Dispatcher stopped"))
+        await self.close_pool()
+
+    async def send(self, message: OutgoingMessage) -> DispatchResult:
+        config = await self.get_config()
+        if not config.get("active"):
+            raise HTTPException(status_code=400, detail=f"The {self.channel.value} channel is not active.")
+        if not self._workers:
+            raise HTTPException(status_code=503, detail=f"The {self.channel.value} channel is not running.")
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((message, future))
+        return await future
+
+    async def _next_batch(self, batch: List[Tuple[OutgoingMessage, asyncio.Future]]):
+        """Fill `batch` with the queued messages, it keeps the ones already taken if the worker is cancelled."""
+        batch.append(await self._queue.get())
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+    async def _worker(self):
+        while True:
+            batch: List[Tuple[OutgoingMessage, asyncio.Future]] = []
+            try:
+                await self._next_batch(batch)
+                await self.rate_limiter.acquire(len(batch))
+                messages = [message for message, _ in batch]
+                try:
+                    results = await self.deliver_batch(await self.get_config(), messages)
+                except Exception as e:  # noqa
+                    logger.error(f"Failed to deliver a batch of {len(batch)} {self.channel.value} messages: {e}")
+                    results = [self._result(message, error=str(e)) for message in messages]
+
+                for (_, future), result in zip(batch, results):
+                    if result.success:
+                        self.sent += 1
+                    else:
+                        self.failed += 1
+                    if not future.done():
+                        future.set_result(result)
+            finally:
+                # Cancelled by stop() while collecting, rate limited or delivering: the messages taken from the
+                # queue are in no result, release their callers
+                for message, future in batch:
+                    if not future.done():
+                        future.set_result(self._result(message, error="Dispatcher stopped"))
+
+    def _result(self, message: OutgoingMessage, provider_id: str = None, error: str = None) -> DispatchResult:
+        return DispatchResult(channel=self.channel, to=message.to, success=error is None,
+                              provider_id=provider_id, error=error)
+
+    @abstractmethod
+    async def deliver_batch(self, config: dict, messages: List[OutgoingMessage]) -> List[DispatchResult]:
+        """Deliver the messages and return one result per message, in the same order."""
+
+    async def close_pool(self):
+        """Close the connections held by the provider, the ones in use once their batch is done."""
+
+    def stats(self) -> dict:
+        return {
+            "channel": self.channel.value,
+            "running": bool(self._workers),
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "sent": self.sent,
+            "failed": self.failed,
+        }
+
+
+class MessageDispatcher:
+    """Single entry point for sending messages over any of the registered channels."""
+
+    def __init__(self, channels: Iterable[MessageChannel]):
+        self.channels: Dict[ChannelEnum, MessageChannel] = {channel.channel: channel for channel in channels}
+
+    async def start(self):
+        for channel in self.channels.values():
+            await channel.start()
+        logger.info(f"Message dispatcher started with channels: {', '.join(c.value for c in self.channels)}.")
+
+    async def stop(self):
+        await asyncio.gather(*(channel.stop() for channel in self.channels.values()))
+
+    async def send(self, message: OutgoingMessage) -> DispatchResult:
+        channel = self.channels.get(message.channel)
+        if channel is None:
+            raise HTTPException(status_code=400, detail=f"Unsupported channel: {message.channel}")
+        return await channel.send(message)
+
+    async def send_many(self, messages: List[OutgoingMessage]) -> List[DispatchResult]:
+        """Send several messages concurrently, the results keep the order of the messages."""
+        async def send_one(message: OutgoingMessage) -> DispatchResult:
+            try:
+                return await self.send(message)
+            except HTTPException as e:
+                return DispatchResult(channel=message.channel, to=message.to, success=False, error=e.detail)
+
+        return list(await asyncio.gather(*(send_one(message) for message in messages)))
+
+    def stats(self) -> List[dict]:
+        return [channel.stats() for channel in self.channels.values()]
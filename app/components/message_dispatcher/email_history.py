@@ -0,0 +1,281 @@
+import asyncio
+import os
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Deque, List, Optional
+
+from dotenv import load_dotenv
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from app.components.logger import logger
+from app.db.mongoClient import async_mdb_client
+
+load_dotenv()  # loading environment variables
+
+EMAIL_HISTORY_BATCH_SIZE = int(os.getenv("email_history_batch_size", 100))  # flush once this many records wait
+EMAIL_HISTORY_FLUSH_INTERVAL = float(os.getenv("email_history_flush_interval", 2.0))  # seconds between flushes
+EMAIL_HISTORY_MAX_PENDING = int(os.getenv("email_history_max_pending", 10000))  # upper bound of the buffer
+EMAIL_HISTORY_RETRY_DELAY = float(os.getenv("email_history_retry_delay", 1.0))  # seconds before retrying a batch
+
+# Retention of the sent-email history: "ttl" lets MongoDB expire old records, "archive" moves them to
+# emails_sent_archive, "off" keeps everything. Records older than email_history_retention_days are affected.
+EMAIL_HISTORY_RETENTION_MODE = os.getenv("email_history_retention_mode", "ttl").lower()
+EMAIL_HISTORY_RETENTION_DAYS = int(os.getenv("email_history_retention_days", 90))
+EMAIL_HISTORY_ARCHIVE_INTERVAL = float(os.getenv("email_history_archive_interval", 3600))  # seconds between runs
+EMAIL_HISTORY_ARCHIVE_BATCH_SIZE = int(os.getenv("email_history_archive_batch_size", 1000))
+
+TTL_INDEX_NAME = "sent_at_ttl"
+
+# mongo connection
+emails_collection = async_mdb_client.messages.emails_sent
+archive_collection = async_mdb_client.messages.emails_sent_archive
+
+
+class EmailHistoryBuffer:
+    """
+    Write-behind buffer for sent-email records.
+
+    Records are collected in memory and written with a single `insert_many` call once `batch_size`
+    records are waiting or `flush_interval` seconds have passed, whichever comes first. The buffer is
+    flushed one last time when it is stopped. A batch whose write fails as a whole (e.g. a lost
+    connection) is retried once after `retry_delay` seconds; the number of records that could not be
+    written is kept in `failed`.
+    """
+
+    def __init__(self, collection, batch_size: int = EMAIL_HISTORY_BATCH_SIZE,
+                 flush_interval: float = EMAIL_HISTORY_FLUSH_INTERVAL, max_pending: int = EMAIL_HISTORY_MAX_PENDING,
+                 retry_delay: float = EMAIL_HISTORY_RETRY_DELAY):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.retry_delay = retry_delay
+        self.written = 0  # records stored in MongoDB
+        self.failed = 0  # records dropped or rejected by MongoDB
+        self._pending: Deque[dict] = deque()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        """Start the background flush task."""
+        if self.running:
+            return
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Email history buffer started (batch_size={self.batch_size}, "
+                    f"flush_interval={self.flush_interval}s).")
+
+    async def add(self, record: dict):
+        """
+        Queue a record for writing.
+        When the buffer is not running (e.g. in scripts), the record is written immediately instead.
+        """
+        if not self.running:
+            await self.collection.insert_one(record)
+            self.written += 1
+            return
+
+        if len(self._pending) >= self.max_pending:
+            # The database is not keeping up; drop the oldest record rather than growing without bound.
+            self._pending.popleft()
+            self.failed += 1
+            logger.warning("Email history buffer is full, the oldest record was dropped.")
+
+        self._pending.append(record)
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self) -> int:
+        """
+        Write all pending records with `insert_many`.
+        :return: The number of records that failed to be written in this flush.
+        """
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+
+        async with self._flush_lock:
+            failed = 0
+            while self._pending:
+                batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+                failed += await self._write_batch(batch)
+            self.failed += failed
+            return failed
+
+    async def _write_batch(self, batch: List[dict]) -> int:
+        """
+        Insert a batch, retrying once when the whole call fails.
+        :return: The number of records of the batch that could not be written.
+        """
+        retried = False
+        while True:
+            try:
+                result = await self.collection.insert_many(batch, ordered=False)
+                self.written += len(result.inserted_ids)
+                return 0
+            except BulkWriteError as e:
+                errors = e.details.get("writeErrors", [])
+                # insert_many gave the records their _id, on a retry the duplicates are the records
+                # the failed attempt managed to write
+                duplicates = sum(1 for error in errors if error.get("code") == 11000) if retried else 0
+                batch_failed = len(errors) - duplicates
+                self.written += e.details.get("nInserted", len(batch) - len(errors)) + duplicates
+                if batch_failed:
+                    logger.error(f"Failed to save {batch_failed} of {len(batch)} email records: {e}")
+                return batch_failed
+            except PyMongoError as e:
+                if retried:
+                    logger.error(f"Failed to save {len(batch)} email records: {e}")
+                    return len(batch)
+                logger.warning(f"Failed to save {len(batch)} email records, retrying once: {e}")
+                retried = True
+                await asyncio.sleep(self.retry_delay)
+            except Exception as e:  # noqa, e.g. InvalidDocument for a record BSON can't encode, the same again
+                logger.error(f"Failed to save {len(batch)} email records: {e!r}", exc_info=e)
+                return len(batch)
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:  # noqa, the writer must keep running or the history piles up in memory
+                logger.error(f"Email history flush failed: {e!r}", exc_info=e)
+
+    async def stop(self) -> dict:
+        """
+        Stop the background task and flush whatever is still pending.
+        :return: A summary with the number of written and failed records.
+        """
+        if self._task is not None:
+            # Let the current flush finish instead of cancelling it halfway through a write.
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+
+        await self.flush()
+        summary = {"written": self.written, "failed": self.failed}
+        if self.failed:
+            logger.error(f"Email history buffer stopped, {self.failed} records failed to be saved.")
+        else:
+            logger.info(f"Email history buffer stopped, {self.written} records saved.")
+        return summary
+
+
+async def create_email_history_indexes():
+    """
+    Indexes used to look up the sending history by recipient, subject and time.
+    `_id` is part of the keys because the history is paged on (sent_at, _id).
+    """
+    await emails_collection.create_index([("to_emails", ASCENDING), ("sent_at", DESCENDING), ("_id", DESCENDING)])
+    await emails_collection.create_index([("sent_at", DESCENDING), ("_id", DESCENDING)])
+    await emails_collection.create_index([("subject", ASCENDING), ("sent_at", DESCENDING)])
+    await apply_email_history_ttl()
+
+
+async def apply_email_history_ttl():
+    """
+    Create, update or drop the TTL index on `sent_at` so that it matches the configured retention.
+    """
+    indexes = await emails_collection.index_information()
+    ttl_enabled = EMAIL_HISTORY_RETENTION_MODE == "ttl" and EMAIL_HISTORY_RETENTION_DAYS > 0
+
+    if not ttl_enabled:
+        if TTL_INDEX_NAME in indexes:
+            await emails_collection.drop_index(TTL_INDEX_NAME)
+            logger.info("Email history TTL index dropped.")
+        return
+
+    expire_after = EMAIL_HISTORY_RETENTION_DAYS * 24 * 60 * 60
+    existing = indexes.get(TTL_INDEX_NAME)
+    if existing is None:
+        await emails_collection.create_index([("sent_at", ASCENDING)], name=TTL_INDEX_NAME,
+                                             expireAfterSeconds=expire_after)
+        logger.info(f"Email history TTL index created, records expire after {EMAIL_HISTORY_RETENTION_DAYS} days.")
+    elif existing.get("expireAfterSeconds") != expire_after:
+        # Changing the expiry of an existing TTL index requires collMod, create_index would fail
+        await emails_collection.database.command(
+            "collMod", emails_collection.name,
+            index={"name": TTL_INDEX_NAME, "expireAfterSeconds": expire_after},
+        )
+        logger.info(f"Email history TTL updated, records expire after {EMAIL_HISTORY_RETENTION_DAYS} days.")
+
+
+async def archive_email_history(older_than: datetime, batch_size: int = EMAIL_HISTORY_ARCHIVE_BATCH_SIZE) -> int:
+    """
+    Move history records sent before `older_than` into the archive collection.
+    Records are copied before they are deleted, so an interrupted run never loses data.
+    :return: The number of archived records.
+    """
+    archived = 0
+    while True:
+        batch = await emails_collection.find({"sent_at": {"$lt": older_than}}) \
+            .sort("sent_at", ASCENDING).limit(batch_size).to_list(length=batch_size)
+        if not batch:
+            return archived
+
+        try:
+            await archive_collection.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # Duplicates are records copied by a previous, interrupted run
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+
+        result = await emails_collection.delete_many({"_id": {"$in": [record["_id"] for record in batch]}})
+        archived += result.deleted_count
+
+
+class EmailHistoryArchiver:
+    """
+    Background job that periodically moves old history records to the archive collection.
+    Only used when email_history_retention_mode is "archive".
+    """
+
+    def __init__(self, retention_days: int = EMAIL_HISTORY_RETENTION_DAYS,
+                 interval: float = EMAIL_HISTORY_ARCHIVE_INTERVAL):
+        self.retention_days = retention_days
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._task is None and EMAIL_HISTORY_RETENTION_MODE == "archive" and self.retention_days > 0:
+            await archive_collection.create_index([("sent_at", DESCENDING)])
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"Email history archival started, records older than {self.retention_days} days "
+                        f"are archived every {self.interval}s.")
+
+    async def _run(self):
+        while True:
+            try:
+                archived = await archive_email_history(datetime.utcnow() - timedelta(days=self.retention_days))
+                if archived:
+                    logger.info(f"Archived {archived} email history records.")
+            except Exception as e:  # noqa, the next run tries again
+                logger.error(f"Email history archival failed: {e!r}", exc_info=e)
+            await asyncio.sleep(self.interval)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+email_history = EmailHistoryBuffer(emails_collection)
+email_history_archiver = EmailHistoryArchiver()
@@ -1,20 +1,24 @@
 import smtplib
+from contextlib import suppress
+from datetime import datetime
 from email import encoders
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from typing import List
+from typing import List, Optional
 
-from aiosmtplib import SMTP, SMTPException
+from aiosmtplib import SMTP, SMTPException, SMTPServerDisconnected
 from bson import ObjectId
 from fastapi import UploadFile, HTTPException
 
+from app.classes.Messages import ChannelEnum, DispatchResult, OutgoingMessage
 from app.components.logger import logger
-from app.db.mongoClient import async_mdb_client, async_database
+from app.components.message_dispatcher.dispatcher import MessageChannel
+from app.components.message_dispatcher.email_history import email_history
+from app.db.mongoClient import async_database
 
 # mongo connection
 config_collection = async_database.settings
-emails_collection = async_mdb_client.messages.emails_sent
 
 
 async def get_config_data(config_key: str):
@@ -25,6 +29,28 @@ async def get_config_data(config_key: str):
     return config.get(config_key)
 
 
+async def open_smtp_connection(smtp_config: dict) -> SMTP:
+    """
+    Connect and log in to the configured SMTP server.
+
+    The optional `security` setting selects "starttls", "ssl" or "none" (e.g. a local relay); without
+    it STARTTLS is used on port 587 and SSL on any other port. Servers without a configured user are
+    used without logging in.
+    """
+    security = smtp_config.get("security") or ("starttls" if smtp_config["port"] == 587 else "ssl")
+    smtp = SMTP(hostname=smtp_config["server"], port=smtp_config["port"])
+    if security == "starttls":
+        await smtp.connect(start_tls=True)
+    elif security == "ssl":
+        # SSL from the start for port 465 or other SSL ports
+        await smtp.connect(use_tls=True)
+    else:
+        await smtp.connect(use_tls=False, start_tls=False)
+    if smtp_config.get("user"):
+        await smtp.login(smtp_config["user"], smtp_config["password"])
+    return smtp
+
+
 async def send_email_and_save(subject: str, body: str, to_emails: List[str], files: List[UploadFile] = []):  # noqa
     smtp_config = await get_config_data("smtp")
     smtp = None  # Declare smtp here
@@ -46,14 +72,7 @@ async def send_email_and_save(subject: str, body: str, to_emails: List[str], fil
         msg.attach(part)
 
     try:
-        smtp = SMTP(hostname=smtp_config["server"], port=smtp_config["port"])
-        if smtp_config["port"] == 587:
-            await smtp.connect(start_tls=True)
-        else:
-            # Assuming SSL from the start for port 465 or other SSL ports
-            await smtp.connect(use_tls=True)
-
-        await smtp.login(smtp_config["user"], smtp_config["password"])
+        smtp = await open_smtp_connection(smtp_config)
         await smtp.send_message(msg)
 
         logger.info("Email sent successfully.")
@@ -61,7 +80,8 @@ async def send_email_and_save(subject: str, body: str, to_emails: List[str], fil
         logger.error(f"Failed to send email. Error: {e}")
         raise
     finally:
-        await smtp.quit()
+        if smtp is not None:
+            await smtp.quit()
 
     # Save email details in MongoDB after successful sending
     email_data = {
@@ -69,12 +89,95 @@ async def send_email_and_save(subject: str, body: str, to_emails: List[str], fil
         "body": body,
         "to_emails": to_emails,
         "attachments": [file.filename for file in files],
+        "sent_at": datetime.utcnow(),
     }
-    await emails_collection.insert_one(email_data)
-    logger.info("Email data saved successfully in MongoDB.")
+    await email_history.add(email_data)  # written in batches by the history buffer
+    logger.info("Email data queued for saving in MongoDB.")
     return {"message": "Email sent and saved successfully"}
 
 
+class SmtpChannel(MessageChannel):
+    """
+    Email channel of the message dispatcher.
+
+    Authenticated SMTP connections are kept in a pool of up to `pool_size` connections, and all the
+    messages of a batch are sent over the same connection instead of logging in once per email. When the
+    settings change, the connections in use are closed at the end of their batch instead of going back to
+    the pool.
+    """
+
+    channel = ChannelEnum.email
+    config_key = "smtp"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._idle: List[SMTP] = []
+        self._generation = 0  # incremented by close_pool, older connections are not pooled again
+
+    async def _acquire(self, config: dict) -> SMTP:
+        while self._idle:
+            smtp = self._idle.pop()
+            if smtp.is_connected:
+                return smtp
+        return await open_smtp_connection(config)
+
+    def _release(self, smtp: SMTP, generation: int):
+        if smtp.is_connected and generation == self._generation and len(self._idle) < self.pool_size:
+            self._idle.append(smtp)
+        else:
+            smtp.close()
+
+    async def deliver_batch(self, config: dict, messages: List[OutgoingMessage]) -> List[DispatchResult]:
+        results = []
+        smtp: Optional[SMTP] = None
+        generation = self._generation
+        try:
+            for message in messages:
+                msg = MIMEMultipart()
+                msg['Subject'] = message.subject or ""
+                msg['From'] = config["system_email"]
+                msg['To'] = ', '.join(message.to)
+                msg.attach(MIMEText(message.body, 'plain'))
+                try:
+                    if smtp is None:
+                        smtp = await self._acquire(config)
+                    try:
+                        await smtp.send_message(msg)
+                    except SMTPServerDisconnected:
+                        # Pooled connections may have been closed by the server while idle
+                        dropped, smtp = smtp, None
+                        with suppress(SMTPException):
+                            await dropped.quit()
+                        dropped.close()
+                        smtp = await open_smtp_connection(config)
+                        await smtp.send_message(msg)
+                except SMTPException as e:
+                    results.append(self._result(message, error=f"Failed to send email: {e}"))
+                    continue
+
+                results.append(self._result(message))
+                await email_history.add({
+                    "subject": message.subject,
+                    "body": message.body,
+                    "to_emails": message.to,
+                    "attachments": [],
+                    "sent_at": datetime.utcnow(),
+                })
+        finally:
+            if smtp is not None:
+                self._release(smtp, generation)
+        return results
+
+    async def close_pool(self):
+        self._generation += 1
+        idle, self._idle = self._idle, []
+        for smtp in idle:
+            try:
+                await smtp.quit()
+            except SMTPException:
+                smtp.close()
+
+
 async def test_email_connection():
     smtp_config = await get_config_data("smtp")
     smtp = None  # Declare smtp here
@@ -86,12 +189,7 @@ async def test_email_connection():
     msg.attach(MIMEText("This is a test email to verify SMTP configuration.", 'plain'))
 
     try:
-        smtp = SMTP(hostname=smtp_config["server"], port=smtp_config["port"])
-        if smtp_config["port"] == 587:
-            await smtp.connect(start_tls=True)
-        else:
-            await smtp.connect(use_tls=True)  # For SSL from the beginning without STARTTLS
-        await smtp.login(smtp_config["user"], smtp_config["password"])
+        smtp = await open_smtp_connection(smtp_config)
         await smtp.send_message(msg)
 
         # If email sent successfully, update 'active' to True
@@ -112,7 +210,8 @@ async def test_email_connection():
         return {"message": f"Failed to send test email. SMTP status set to inactive. Error: {str(e)}"}
 
     finally:
-        await smtp.quit()
+        if smtp is not None:
+            await smtp.quit()
 
 
 async def main():
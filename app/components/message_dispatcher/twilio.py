@@ -0,0 +1,114 @@
+import asyncio
+import os
+from abc import abstractmethod
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from dotenv import load_dotenv
+
+from app.classes.Messages import ChannelEnum, DispatchResult, OutgoingMessage
+from app.components.message_dispatcher.dispatcher import MessageChannel
+
+load_dotenv()  # loading environment variables
+
+# Base URL of the Twilio compatible API, point it to a local mock server to test without sending real messages
+TWILIO_API_BASE_URL = os.getenv("twilio_api_base_url", "https://api.twilio.com")
+
+
+class TwilioChannel(MessageChannel):
+    """
+    Channel delivering messages through the Twilio Messages API.
+
+    Every channel owns an `httpx.AsyncClient` whose connection limit matches the number of workers,
+    so connections are kept alive and reused between batches. The API accepts one recipient per
+    request, the requests of a batch are sent concurrently. When the settings change, new batches get a new
+    client and the old one is closed by the last batch still using it.
+    """
+
+    address_prefix = ""  # Twilio addresses WhatsApp numbers as "whatsapp:+123..."
+
+    def __init__(self, *args, base_url: str = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.base_url = base_url or os.getenv(f"{self.config_key}_api_base_url", TWILIO_API_BASE_URL)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._batches: Dict[httpx.AsyncClient, int] = {}  # client: batches being delivered with it
+
+    @abstractmethod
+    def credentials(self, config: dict) -> Tuple[str, str]:
+        """Account SID and auth token taken from the channel settings."""
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                limits=httpx.Limits(max_connections=self.pool_size * self.batch_size,
+                                    max_keepalive_connections=self.pool_size * self.batch_size),
+                timeout=httpx.Timeout(10.0, connect=5.0),
+            )
+        return self._client
+
+    async def _send_one(self, client: httpx.AsyncClient, config: dict, auth: Tuple[str, str], to: str, body: str) -> str:
+        response = await client.post(
+            f"/2010-04-01/Accounts/{auth[0]}/Messages.json",
+            auth=auth,
+            data={
+                "From": f"{self.address_prefix}{config['from_number']}",
+                "To": f"{self.address_prefix}{to}",
+                "Body": body,
+            },
+        )
+        response.raise_for_status()
+        return response.json().get("sid", "")
+
+    async def _deliver(self, client: httpx.AsyncClient, config: dict, auth: Tuple[str, str],
+                       message: OutgoingMessage) -> DispatchResult:
+        try:
+            sids = await asyncio.gather(*(self._send_one(client, config, auth, to, message.body) for to in message.to))
+            return self._result(message, provider_id=",".join(sids))
+        except httpx.HTTPStatusError as e:
+            return self._result(message, error=f"{self.channel.value} provider returned {e.response.status_code}")
+        except httpx.RequestError as e:
+            return self._result(message, error=f"{self.channel.value} provider is unreachable: {e}")
+
+    async def deliver_batch(self, config: dict, messages: List[OutgoingMessage]) -> List[DispatchResult]:
+        auth = self.credentials(config)
+        client = self._get_client()
+        self._batches[client] = self._batches.get(client, 0) + 1
+        try:
+            return list(await asyncio.gather(*(self._deliver(client, config, auth, message) for message in messages)))
+        finally:
+            self._batches[client] -= 1
+            if not self._batches[client]:
+                del self._batches[client]
+                if client is not self._client:  # replaced while this batch was running
+                    await client.aclose()
+
+    async def close_pool(self):
+        client, self._client = self._client, None
+        if client is not None and client not in self._batches:
+            await client.aclose()
+
+
+class WhatsappChannel(TwilioChannel):
+    channel = ChannelEnum.whatsapp
+    config_key = "whatsapp"
+    address_prefix = "whatsapp:"
+
+    def credentials(self, config: dict) -> Tuple[str, str]:
+        return config["account_sid"], config["auth_token"]
+
+
+class SmsChannel(TwilioChannel):
+    """SMS over Twilio, the `api_key` setting holds "<account_sid>:<auth_token>"."""
+
+    channel = ChannelEnum.sms
+    config_key = "sms"
+
+    def credentials(self, config: dict) -> Tuple[str, str]:
+        provider = (config.get("provider") or "").lower()
+        if provider != "twilio":
+            raise ValueError(f"Unsupported SMS provider: {config.get('provider')}")
+        account_sid, _, auth_token = (config.get("api_key") or "").partition(":")
+        if not auth_token:
+            raise ValueError("The SMS api_key must have the form <account_sid>:<auth_token>")
+        return account_sid, auth_token
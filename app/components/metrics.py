@@ -0,0 +1,258 @@
+"""
+Prometheus metrics of the API, served by `/metrics`.
+
+- http_request_duration_seconds: latency histogram per method, route template and status (its `_count` is
+  the request count), and http_requests_in_flight.
+- redis_command_duration_seconds: latency per Redis command, recorded by `InstrumentedRedis`.
+- redis_pool_checkout_seconds: wait for a connection of the Redis pool, and redis_pool_connections in use,
+  idle and at most.
+- mongodb_command_duration_seconds: latency per MongoDB command and collection, recorded by
+  `MongoCommandMetrics`, a pymongo command listener.
+- mongodb_pool_checkout_seconds: wait for a connection of the MongoDB pool, and mongodb_pool_connections
+  open and in use per server, recorded by `MongoPoolMetrics`, a pymongo pool listener.
+- event_loop_lag_seconds: how late a timer fires on the event loop, sampled by `EventLoopLagMonitor`.
+
+Recording a value is a lock and an addition, a few microseconds per request.
+
+With several workers (`uvicorn --workers N`) the workers share one port, so a scrape reaches one of them.
+Set PROMETHEUS_MULTIPROC_DIR to a directory of the host (emptied before the workers start): every worker
+then writes its values to files there and /metrics serves the sum over all workers. The gauges add up
+the values of the running workers; a worker removes its gauge files when it shuts down.
+"""
+import asyncio
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+from dotenv import load_dotenv
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Gauge, Histogram, generate_latest, multiprocess
+from pymongo import monitoring
+from starlette.responses import Response
+
+from app.components import server_timing
+
+load_dotenv()  # loading environment variables
+
+LOOP_LAG_INTERVAL = float(os.getenv("metrics_loop_lag_interval", 0.5))  # seconds between two lag samples
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")  # read by prometheus_client as well
+if PROMETHEUS_MULTIPROC_DIR:
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)  # before the first metric opens its file there
+
+# Database calls are mostly sub-millisecond, requests to ChatGPT take seconds
+DB_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5)
+REQUEST_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+REQUEST_DURATION = Histogram("http_request_duration_seconds", "HTTP request latency",
+                             ["method", "route", "status"], buckets=REQUEST_BUCKETS)
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests being handled", multiprocess_mode="livesum")
+REDIS_DURATION = Histogram("redis_command_duration_seconds", "Redis command latency", ["command"],
+                           buckets=DB_BUCKETS)
+REDIS_POOL_CHECKOUT = Histogram("redis_pool_checkout_seconds", "Wait for a connection of the Redis pool",
+                                buckets=DB_BUCKETS)
+REDIS_POOL_CONNECTIONS = Gauge("redis_pool_connections", "Connections of the Redis pool", ["state"],
+                               multiprocess_mode="livesum")
+MONGODB_DURATION = Histogram("mongodb_command_duration_seconds", "MongoDB command latency",
+                             ["command", "collection", "status"], buckets=DB_BUCKETS)
+MONGODB_POOL_CHECKOUT = Histogram("mongodb_pool_checkout_seconds", "Wait for a connection of the MongoDB pool",
+                                  ["status"], buckets=DB_BUCKETS)
+MONGODB_POOL_CONNECTIONS = Gauge("mongodb_pool_connections", "Connections of the MongoDB pool",
+                                 ["address", "state"], multiprocess_mode="livesum")
+LOOP_LAG = Histogram("event_loop_lag_seconds", "Delay of a timer on the event loop",
+                     buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5))
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request by method, route template and status."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status_code = 500  # when the app fails before answering
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            route = scope.get("route")
+            # Unmatched paths share one label, so scanners can't create a series per URL
+            REQUEST_DURATION.labels(scope["method"], route.path if route is not None else "unmatched",
+                                    str(status_code)).observe(time.perf_counter() - started)
+
+
+def observe_redis(command: str, seconds: float):
+    REDIS_DURATION.labels(command).observe(seconds)
+    server_timing.record("redis", seconds)
+
+
+_redis_pool_stats: Optional[Callable[[], dict]] = None  # written on checkout and release with several workers
+
+
+def observe_redis_checkout(seconds: float):
+    REDIS_POOL_CHECKOUT.observe(seconds)
+    refresh_redis_pool()
+
+
+def refresh_redis_pool():
+    if _redis_pool_stats is not None:
+        for state, value in _redis_pool_stats().items():
+            REDIS_POOL_CONNECTIONS.labels(state).set(value)
+
+
+def track_redis_pool(stats: Callable[[], dict]):
+    """
+    Report redis_pool_connections from `stats` (in_use, idle, max). They are read at every scrape, or with
+    several workers, where the scrape is answered by another process, written whenever they change.
+    """
+    global _redis_pool_stats
+    if PROMETHEUS_MULTIPROC_DIR:
+        _redis_pool_stats = stats
+        refresh_redis_pool()
+        return
+    for state in ("in_use", "idle", "max"):
+        REDIS_POOL_CONNECTIONS.labels(state).set_function(lambda state=state: stats()[state])
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """
+    Records the duration of every MongoDB command. Register it with `event_listeners=[...]` on the client.
+    The collection is only part of the started event, it is kept until the command finishes.
+    """
+
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        self._collections[(event.connection_id, event.request_id)] = \
+            collection if isinstance(collection, str) else event.database_name
+
+    def _observe(self, event, status: str):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        MONGODB_DURATION.labels(event.command_name, collection, status).observe(event.duration_micros / 1e6)
+        # Motor runs the command with the context of the request, so it counts for its Server-Timing
+        server_timing.record("mongo", event.duration_micros / 1e6)
+
+    def succeeded(self, event):
+        self._observe(event, "ok")
+
+    def failed(self, event):
+        self._observe(event, "error")
+
+
+mongo_command_metrics = MongoCommandMetrics()
+
+
+class MongoPoolMetrics(monitoring.ConnectionPoolListener):
+    """
+    Records the wait for a pooled connection and the connections open and in use per server. Register it
+    with `event_listeners=[...]` on the client. A checkout starts and ends on the same driver thread, the
+    start time is kept per thread.
+    """
+
+    def __init__(self):
+        self._checkouts = {}  # (address, thread): start of the checkout
+
+    @staticmethod
+    def _connections(address, state: str) -> Gauge:
+        return MONGODB_POOL_CONNECTIONS.labels(f"{address[0]}:{address[1]}", state)
+
+    def _checkout_done(self, event, status: str):
+        started = self._checkouts.pop((event.address, threading.get_ident()), None)
+        if started is not None:
+            MONGODB_POOL_CHECKOUT.labels(status).observe(time.perf_counter() - started)
+
+    def connection_check_out_started(self, event):
+        self._checkouts[(event.address, threading.get_ident())] = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        self._checkout_done(event, "ok")
+        self._connections(event.address, "in_use").inc()
+
+    def connection_check_out_failed(self, event):
+        self._checkout_done(event, "failed")
+
+    def connection_checked_in(self, event):
+        self._connections(event.address, "in_use").dec()
+
+    def connection_created(self, event):
+        self._connections(event.address, "open").inc()
+
+    def connection_closed(self, event):
+        self._connections(event.address, "open").dec()
+
+    # The pool events without a metric
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+
+mongo_pool_metrics = MongoPoolMetrics()
+
+
+class EventLoopLagMonitor:
+    """Background task measuring how late a periodic timer fires on the event loop."""
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            LOOP_LAG.observe(max(0.0, time.perf_counter() - expected))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+loop_lag_monitor = EventLoopLagMonitor()
+
+
+def metrics_response() -> Response:
+    """The current value of every metric, in the Prometheus text format, summed over the workers if several."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry, PROMETHEUS_MULTIPROC_DIR)
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+def remove_worker_metrics():
+    """Remove the gauge files of this worker when it shuts down, so the sums only cover running workers."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(os.getpid(), PROMETHEUS_MULTIPROC_DIR)
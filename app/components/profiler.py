@@ -0,0 +1,162 @@
+"""
+Sampling profiler of the running worker, to find CPU hotspots in production without redeploying.
+
+A background thread looks at the stacks of the other threads (`sys._current_frames()`) every few
+milliseconds and counts them. Nothing is traced in between, so the profiled code runs at full speed; the
+cost is one stack walk per sample. The result is in the folded format, one `frame;frame;frame count` line
+per stack, which flamegraph.pl and speedscope read as is.
+
+- `GET /debug/profile?seconds=10`: profile the event loop (and, with `all_threads=true`, the worker threads)
+  for that long, behind `verify_credentials` like `/docs`.
+- `X-Profile: <profile_token>` on any request: profile the event loop while that request runs. The response
+  gets an `X-Profile-Id`, the profile is kept in Redis for an hour and read with `GET /debug/profile/{id}`.
+  Other requests handled at the same time show up in it too.
+"""
+import asyncio
+import os
+import secrets
+import sys
+import threading
+import uuid
+from collections import Counter
+from typing import Iterable, Optional
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+
+from app.components.logger import logger
+
+load_dotenv()  # loading environment variables
+
+PROFILE_INTERVAL = float(os.getenv("profile_interval_ms", 5)) / 1000  # seconds between two samples
+PROFILE_MAX_SECONDS = float(os.getenv("profile_max_seconds", 60))  # longest profile of /debug/profile
+PROFILE_TOKEN = os.getenv("profile_token")  # value of the X-Profile header, per-request profiling is off without it
+PROFILE_TTL = 3600  # seconds a per-request profile is kept in Redis
+
+# Leaf frames of threads waiting for work or I/O, left out unless idle time is asked for
+IDLE_FILES = ("selectors.py", "threading.py", "queue.py")
+
+
+def _label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ",")
+
+
+class SamplingProfiler:
+    """Counts the stacks of the sampled threads every `interval` seconds, from a thread of its own."""
+
+    def __init__(self, interval: float = PROFILE_INTERVAL, thread_ids: Optional[Iterable[int]] = None,
+                 idle: bool = False):
+        """
+        :param thread_ids: Threads to sample, every thread when None
+        :param idle: Keep the samples of threads waiting in selectors, locks and queues
+        """
+        self.interval = interval
+        self.thread_ids = set(thread_ids) if thread_ids is not None else None
+        self.idle = idle
+        self.stacks = Counter()
+        self.samples = 0
+        self._labels = {}  # code object: frame label, formatted once
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _frame_label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = _label(code)
+        return label
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():  # noqa
+                if thread_id == own_id or (self.thread_ids is not None and thread_id not in self.thread_ids):
+                    continue
+                if not self.idle and frame.f_code.co_filename.endswith(IDLE_FILES):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._frame_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def folded(self) -> str:
+        """The stacks in the folded format, most frequent first."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+_profiling = asyncio.Lock()  # one profile at a time, two profilers would sample each other's overhead
+
+
+async def profile(seconds: float, interval: float = PROFILE_INTERVAL, all_threads: bool = False,
+                  idle: bool = False) -> str:
+    """Profile the worker for `seconds` while it keeps serving requests, and return the folded stacks."""
+    if _profiling.locked():
+        raise HTTPException(status_code=409, detail="A profile is already running.")
+    async with _profiling:
+        profiler = SamplingProfiler(interval, None if all_threads else [threading.get_ident()], idle)
+        profiler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            await asyncio.to_thread(profiler.stop)
+        logger.info("Profiled the worker for %ss: %s samples", seconds, profiler.samples)
+        return profiler.folded()
+
+
+async def get_profile(redis_client, profile_id: str) -> str:
+    folded = await redis_client.get(f"profile:{profile_id}")
+    if folded is None:
+        raise HTTPException(status_code=404, detail="Profile not found or expired.")
+    return folded
+
+
+def has_profile_token(scope) -> bool:
+    """Whether the HTTP request carries `X-Profile: <profile_token>`, always False without a profile_token."""
+    if scope["type"] != "http" or not PROFILE_TOKEN:
+        return False
+    for name, value in scope["headers"]:
+        if name == b"x-profile":
+            return secrets.compare_digest(value, PROFILE_TOKEN.encode())
+    return False
+
+
+class ProfileMiddleware:
+    """ASGI middleware profiling the requests that carry `X-Profile: <profile_token>`."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not has_profile_token(scope) or _profiling.locked():
+            return await self.app(scope, receive, send)
+
+        profile_id = uuid.uuid4().hex
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), (b"x-profile-id", profile_id.encode())]
+            await send(message)
+
+        async with _profiling:
+            profiler = SamplingProfiler(thread_ids=[threading.get_ident()])
+            profiler.start()
+            try:
+                await self.app(scope, receive, send_with_profile_id)
+            finally:
+                await asyncio.to_thread(profiler.stop)
+                try:
+                    await scope["app"].state.redis.set(f"profile:{profile_id}", profiler.folded(), ex=PROFILE_TTL)
+                except Exception as e:  # noqa
+                    logger.warning("Profile %s could not be saved: %s", profile_id, e)
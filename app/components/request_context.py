@@ -0,0 +1,46 @@
+import logging
+import time
+import uuid
+
+from app.components.logger import log_context, logger
+
+
+class RequestContextMiddleware:
+    """
+    ASGI middleware giving every HTTP request a log context: a request id (taken from the `X-Request-ID` header
+    or generated), the method, the route and the start time. Every record logged while the request is handled
+    carries these fields. The id is returned in the `X-Request-ID` response header, and one `request` line
+    with the status and duration is logged at the end (sampled like the other high-volume events).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+                break
+        request_id = request_id or uuid.uuid4().hex
+        context = {"request_id": request_id, "user": None, "method": scope["method"], "scope": scope,
+                   "started": time.perf_counter()}
+        token = log_context.set(context)
+        status_code = 500  # when the app fails before answering
+
+        async def send_with_request_id(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message["headers"] = [*message.get("headers", []), (b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            logger.log(logging.WARNING if status_code >= 500 else logging.INFO, "%s %s %s", scope["method"],
+                       scope["path"], status_code, extra={"event": "request", "status": status_code})
+            log_context.reset(token)
@@ -0,0 +1,192 @@
+"""
+Per-request timing: where the time of a request went, sent in the `Server-Timing` response header and logged
+for slow requests.
+
+`ServerTimingMiddleware` gives every request a `ServerTiming`, which collects:
+- the route phases measured by `TimedAPIRoute`: "deps" (request parsing and dependencies), "handler" (the
+  endpoint) and "serialize" (response validation and encoding),
+- the dependencies decorated with `timed`, e.g. "auth" and "permissions",
+- the Redis and MongoDB calls made for the request, as a total and a count per backend.
+
+Browsers show the header in the network panel, e.g. `deps;dur=3.1, redis;dur=0.4;desc="2 calls", total;dur=9.8`.
+The timings tell a caller how long the database calls behind a response took, e.g. whether a username
+exists, so the header is off by default. With server_timing "token" it is sent to the requests carrying the
+`X-Profile: <profile_token>` header of the profiler, with "on" to every request.
+"""
+import asyncio
+import functools
+import os
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+from fastapi.routing import APIRoute
+
+from app.components.logger import logger
+from app.components.profiler import has_profile_token
+
+load_dotenv()  # loading environment variables
+
+SERVER_TIMING = os.getenv("server_timing", "off").lower()  # send the Server-Timing header: "off", "token" or "on"
+SLOW_REQUEST_MS = float(os.getenv("slow_request_ms", 1000))  # log requests slower than this, 0 is off
+
+STREAMING_TYPES = (b"text/event-stream", b"application/x-ndjson")
+
+
+class ServerTiming:
+    """Durations of the phases of one request, each with the number of times it was recorded."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: Dict[str, List[float]] = {}  # name: [seconds, count]
+        self.endpoint_started: Optional[float] = None
+        self.endpoint_finished: Optional[float] = None
+        self._lock = threading.Lock()  # MongoDB calls are recorded from Motor's worker threads
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            phase = self.phases.setdefault(name, [0.0, 0])
+            phase[0] += seconds
+            phase[1] += 1
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def summary(self) -> Dict[str, float]:
+        """Milliseconds per phase."""
+        return {name: round(seconds * 1000, 2) for name, (seconds, _) in self.phases.items()}
+
+    def header(self) -> str:
+        entries = []
+        for name, (seconds, count) in self.phases.items():
+            entry = f"{name};dur={seconds * 1000:.2f}"
+            if count > 1:
+                entry += f';desc="{count} calls"'
+            entries.append(entry)
+        entries.append(f"total;dur={self.elapsed() * 1000:.2f}")
+        return ", ".join(entries)
+
+
+server_timing: ContextVar[Optional[ServerTiming]] = ContextVar("server_timing", default=None)
+
+
+def record(name: str, seconds: float):
+    """Add a duration to the request being handled, if any."""
+    timing = server_timing.get()
+    if timing is not None:
+        timing.add(name, seconds)
+
+
+def timed(name: str):
+    """Decorator recording the duration of an async dependency or function as the phase `name`."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
+
+
+class TimedAPIRoute(APIRoute):
+    """
+    Route splitting its time into "deps", "handler" and "serialize". The endpoint is wrapped to mark when it
+    starts and ends; everything before is parsing and dependencies, everything after is the response.
+    Use it with `APIRouter(route_class=TimedAPIRoute)`.
+    """
+
+    def get_route_handler(self):
+        endpoint = self.dependant.call
+        if asyncio.iscoroutinefunction(endpoint):
+            @functools.wraps(endpoint)
+            async def timed_endpoint(*args, **kwargs):
+                timing = server_timing.get()
+                if timing is not None:
+                    timing.endpoint_started = time.perf_counter()
+                try:
+                    return await endpoint(*args, **kwargs)
+                finally:
+                    if timing is not None:
+                        timing.endpoint_finished = time.perf_counter()
+        else:
+            @functools.wraps(endpoint)
+            def timed_endpoint(*args, **kwargs):
+                timing = server_timing.get()
+                if timing is not None:
+                    timing.endpoint_started = time.perf_counter()
+                try:
+                    return endpoint(*args, **kwargs)
+                finally:
+                    if timing is not None:
+                        timing.endpoint_finished = time.perf_counter()
+
+        self.dependant.call = timed_endpoint
+        handler = super().get_route_handler()
+
+        async def timed_handler(request):
+            timing = server_timing.get()
+            if timing is None:
+                return await handler(request)
+            started = time.perf_counter()
+            try:
+                return await handler(request)
+            finally:
+                finished = time.perf_counter()
+                if timing.endpoint_started is None:  # a dependency failed
+                    timing.add("deps", finished - started)
+                else:
+                    timing.add("deps", timing.endpoint_started - started)
+                    timing.add("handler", (timing.endpoint_finished or finished) - timing.endpoint_started)
+                    timing.add("serialize", finished - (timing.endpoint_finished or finished))
+
+        return timed_handler
+
+
+class ServerTimingMiddleware:
+    """
+    ASGI middleware collecting the timing of every HTTP request. It adds the `Server-Timing` header when
+    server_timing allows it and logs the requests slower than slow_request_ms with their phases. Streamed
+    responses are judged on the time until the response started.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        timing = ServerTiming()
+        token = server_timing.set(timing)
+        response_started = None
+        streaming = False
+        send_header = SERVER_TIMING == "on" or SERVER_TIMING == "token" and has_profile_token(scope)
+
+        async def send_with_timing(message):
+            nonlocal response_started, streaming
+            if message["type"] == "http.response.start":
+                response_started = timing.elapsed()
+                headers = message.get("headers", [])
+                streaming = any(name == b"content-type" and value.startswith(STREAMING_TYPES)
+                                for name, value in headers)
+                if send_header:
+                    message["headers"] = [*headers, (b"server-timing", timing.header().encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            server_timing.reset(token)
+            elapsed = response_started if streaming and response_started is not None else timing.elapsed()
+            if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+                logger.warning("Slow request: %s %s took %.0fms (%s)", scope["method"], scope["path"],
+                               elapsed * 1000, timing.header(),
+                               extra={"event": "slow_request", "phases": timing.summary()})
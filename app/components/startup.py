@@ -0,0 +1,165 @@
+"""
+Startup of the workers: independent steps run concurrently, the one-time bootstrap is done by a single worker.
+
+`run_steps` starts its steps at the same time and reports every failure with the name of its step. When a
+critical step fails the startup stops with a `StartupError` naming the failed steps, rather than a worker
+serving requests without its database; the failures of the other steps are logged and the worker starts.
+
+With several workers (`uvicorn --workers N`, several containers) the bootstrap (indexes, owner account,
+message settings) is done by one of them, the leader: the first worker to set the lock:bootstrap key in Redis
+(SET NX with an expiry of bootstrap_lock_ttl seconds). The other workers skip it. After a successful bootstrap
+the key is left to expire, so the workers starting at the same time don't repeat it; after a failure it is
+released and the next worker to start tries again. The outcome of the last bootstrap is kept in
+bootstrap:status.
+
+The other workers wait for that outcome before serving requests, the unique indexes must exist by then: they
+poll bootstrap:status until the leader wrote it, for at most bootstrap_wait_timeout seconds. When the leader
+failed a critical step, or wrote nothing in time (it may have crashed), they stop with a `StartupError` as
+well; restarted, one of them becomes the next leader once the lock is released or expired.
+"""
+import asyncio
+import json
+import os
+import socket
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Awaitable, Callable, List, Optional
+
+from dotenv import load_dotenv
+from redis.exceptions import WatchError
+
+from app.components.logger import logger
+
+load_dotenv()  # loading environment variables
+
+BOOTSTRAP_LOCK_KEY = "lock:bootstrap"
+BOOTSTRAP_STATUS_KEY = "bootstrap:status"
+BOOTSTRAP_LOCK_TTL = int(os.getenv("bootstrap_lock_ttl", 120))  # seconds, longer than a bootstrap takes
+BOOTSTRAP_WAIT_TIMEOUT = float(os.getenv("bootstrap_wait_timeout", BOOTSTRAP_LOCK_TTL))  # seconds
+BOOTSTRAP_POLL_INTERVAL = 0.1  # seconds between two reads of the bootstrap status by the waiting workers
+
+
+class StartupError(RuntimeError):
+    """Critical startup steps failed, the worker cannot serve requests."""
+
+
+@dataclass
+class Step:
+    name: str
+    run: Callable[[], Awaitable[Any]]
+    critical: bool = True  # a failure stops the startup
+
+
+@dataclass
+class StepResult:
+    name: str
+    duration: float
+    error: Optional[BaseException] = None
+    critical: bool = True
+
+
+async def _run_step(step: Step) -> StepResult:
+    started = time.perf_counter()
+    try:
+        await step.run()
+    except Exception as e:  # noqa
+        duration = time.perf_counter() - started
+        logger.error("Startup step %s failed after %.0fms: %r", step.name, duration * 1000, e, exc_info=e,
+                     extra={"event": "startup_step_failed", "step": step.name, "critical": step.critical})
+        return StepResult(step.name, duration, e, step.critical)
+    return StepResult(step.name, time.perf_counter() - started, critical=step.critical)
+
+
+async def run_steps(*steps: Step) -> List[StepResult]:
+    """
+    Run the steps concurrently and wait for all of them, also when some fail.
+    :raises StartupError: When a critical step failed.
+    """
+    results = await asyncio.gather(*(_run_step(step) for step in steps))
+    logger.info("Startup steps done: %s", ", ".join(
+        f"{result.name} {result.duration * 1000:.0f}ms{' (failed)' if result.error else ''}" for result in results))
+    failed = [result.name for result in results if result.error is not None and result.critical]
+    if failed:
+        raise StartupError(f"Critical startup steps failed: {', '.join(failed)}")
+    return results
+
+
+async def acquire_leader_lock(redis_client, key: str = BOOTSTRAP_LOCK_KEY,
+                              ttl: int = BOOTSTRAP_LOCK_TTL) -> Optional[str]:
+    """Take the lock if no other worker holds it. :return: The token of the lock, None when it is taken."""
+    token = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    if await redis_client.set(key, token, ex=ttl, nx=True):
+        return token
+    return None
+
+
+async def release_leader_lock(redis_client, token: str, key: str = BOOTSTRAP_LOCK_KEY) -> bool:
+    """Delete the lock if it is still ours; it may have expired and been taken by another worker meanwhile."""
+    async with redis_client.pipeline() as pipe:
+        try:
+            await pipe.watch(key)  # the delete fails if the key changes after the check
+            if await pipe.get(key) != token:
+                await pipe.unwatch()
+                return False
+            pipe.multi()
+            pipe.delete(key)
+            await pipe.execute()
+            return True
+        except WatchError:
+            return False
+
+
+async def wait_for_bootstrap(redis_client, leader: Optional[str],
+                             timeout: float = BOOTSTRAP_WAIT_TIMEOUT) -> Optional[dict]:
+    """
+    Wait for the leader to write the status of its bootstrap.
+    :param leader: The token of the leader, None when its lock is already gone and there is nothing to wait for.
+    :return: The status of the bootstrap, None without leader.
+    :raises StartupError: When a critical step of the leader failed, or it wrote no status within the timeout.
+    """
+    if leader is None:
+        return None
+    deadline = time.monotonic() + timeout
+    while True:
+        status = json.loads(await redis_client.get(BOOTSTRAP_STATUS_KEY) or "null")
+        if status is not None and status.get("worker") == leader:
+            if status.get("error"):
+                raise StartupError(f"Bootstrap failed in the worker {leader}: {status['error']}")
+            return status
+        if time.monotonic() >= deadline:
+            raise StartupError(f"No bootstrap status from the worker {leader} after {timeout:.0f}s")
+        await asyncio.sleep(BOOTSTRAP_POLL_INTERVAL)
+
+
+async def bootstrap(redis_client, *steps: Step) -> bool:
+    """
+    Run the one-time bootstrap steps if this worker becomes the leader, else wait for the leader to run them.
+    :return: Whether this worker ran them.
+    :raises StartupError: When a critical bootstrap step failed, here or in the leader.
+    """
+    token = await acquire_leader_lock(redis_client)
+    if token is None:
+        leader = await redis_client.get(BOOTSTRAP_LOCK_KEY)
+        logger.info("Bootstrap skipped, done by the worker %s", leader)
+        await wait_for_bootstrap(redis_client, leader)
+        return False
+
+    logger.info("Bootstrap by this worker (%s): %s", token, ", ".join(step.name for step in steps))
+    status = {"worker": token, "at": datetime.utcnow().isoformat(timespec="seconds")}
+    try:
+        results = await run_steps(*steps)
+    except StartupError as e:
+        await redis_client.set(BOOTSTRAP_STATUS_KEY, json.dumps({**status, "status": "failed", "error": str(e)}))
+        await release_leader_lock(redis_client, token)
+        raise
+
+    failed = [result.name for result in results if result.error is not None]
+    await redis_client.set(BOOTSTRAP_STATUS_KEY, json.dumps({
+        **status, "status": "failed" if failed else "ok", "failed": failed,
+        "durations_ms": {result.name: round(result.duration * 1000, 1) for result in results},
+    }))
+    if failed:
+        await release_leader_lock(redis_client, token)  # the next worker to start tries again
+    return True
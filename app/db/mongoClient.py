@@ -1,10 +1,32 @@
+"""
+MongoDB client of the app. The pool and timeouts come from the environment:
+
+- mongodb_max_pool_size, mongodb_min_pool_size: connections per server; the minimum is opened at startup
+  by `warm_mongodb_pool` and kept open, so the first requests don't pay for new connections.
+- mongodb_max_idle_time_ms: idle connections older than this are closed (down to the minimum).
+- mongodb_wait_queue_timeout_ms: how long an operation waits for a free connection, 0 waits forever.
+- mongodb_server_selection_timeout_ms, mongodb_connect_timeout_ms, mongodb_socket_timeout_ms (0 is none).
+- mongodb_read_preference: primary, primaryPreferred, secondary, secondaryPreferred or nearest.
+- mongodb_secondary_read_preference, mongodb_max_staleness_seconds: where the listings and history reads
+  go, see `secondary_reads`. The staleness is at least 90 seconds, -1 is no limit.
+- mongodb_compressors: wire compression, in order of preference; zstd needs `zstandard` and snappy needs
+  `python-snappy`, the ones not installed are left out.
+
+The wait for a pooled connection is in /metrics (mongodb_pool_checkout_seconds, mongodb_pool_connections).
+"""
 import asyncio
+import importlib.util
 import os
+from typing import List
+from urllib.parse import quote_plus
 
 from dotenv import load_dotenv
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection
+from pymongo.read_preferences import ReadPreference, make_read_preference, read_pref_mode_from_name
 
 from app.components.logger import logger
+from app.components.metrics import mongo_command_metrics, mongo_pool_metrics
+from app.db.mongoMonitoring import slow_query_listener
 
 load_dotenv()  # loading environment variables
 
@@ -13,22 +35,95 @@ MONGODB_PASS = os.getenv("mongodb_password")
 MONGODB_SERVER = os.getenv("mongodb_server")
 MONGODB_PORT = os.getenv("mongodb_port")
 
-MONGODB_CONNECTION_STRING = f"mongodb://{MONGODB_USER}:{MONGODB_PASS}@{MONGODB_SERVER}:{MONGODB_PORT}"
+MONGODB_MAX_POOL_SIZE = int(os.getenv("mongodb_max_pool_size", 100))
+MONGODB_MIN_POOL_SIZE = int(os.getenv("mongodb_min_pool_size", 10))
+MONGODB_MAX_IDLE_TIME_MS = int(os.getenv("mongodb_max_idle_time_ms", 300000))
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("mongodb_wait_queue_timeout_ms", 10000))
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("mongodb_server_selection_timeout_ms", 5000))
+MONGODB_CONNECT_TIMEOUT_MS = int(os.getenv("mongodb_connect_timeout_ms", 5000))
+MONGODB_SOCKET_TIMEOUT_MS = int(os.getenv("mongodb_socket_timeout_ms", 30000))
+MONGODB_READ_PREFERENCE = os.getenv("mongodb_read_preference", "primary")
+MONGODB_COMPRESSORS = os.getenv("mongodb_compressors", "zstd,snappy")
+MONGODB_SECONDARY_READ_PREFERENCE = os.getenv("mongodb_secondary_read_preference", "secondaryPreferred")
+MONGODB_MAX_STALENESS_SECONDS = int(os.getenv("mongodb_max_staleness_seconds", 90))
+
+# Package each compressor needs, zlib is part of Python
+COMPRESSOR_PACKAGES = {"zstd": "zstandard", "snappy": "snappy", "zlib": None}
+
+# Quoted, the credentials may contain characters with a meaning in a URL
+MONGODB_CONNECTION_STRING = (f"mongodb://{quote_plus(str(MONGODB_USER))}:{quote_plus(str(MONGODB_PASS))}"
+                             f"@{MONGODB_SERVER}:{MONGODB_PORT}")
+
+
+def available_compressors(names: str) -> List[str]:
+    """The compressors of the comma separated list whose package is installed, in the same order."""
+    compressors = []
+    for name in filter(None, (name.strip() for name in names.split(","))):
+        if name not in COMPRESSOR_PACKAGES:
+            logger.warning("Unknown MongoDB compressor %s, left out", name)
+        elif COMPRESSOR_PACKAGES[name] is None or importlib.util.find_spec(COMPRESSOR_PACKAGES[name]):
+            compressors.append(name)
+    return compressors
+
+
+def read_preference(mode: str, max_staleness: int = -1):
+    """A read preference from its name; the max staleness, in seconds, doesn't apply to primary."""
+    if mode == "primary":
+        return ReadPreference.PRIMARY
+    return make_read_preference(read_pref_mode_from_name(mode), None, max_staleness)
+
+
+SECONDARY_READS = read_preference(MONGODB_SECONDARY_READ_PREFERENCE, MONGODB_MAX_STALENESS_SECONDS)
+
+
+def secondary_reads(collection: AsyncIOMotorCollection) -> AsyncIOMotorCollection:
+    """
+    The collection with its reads sent to the secondaries, by default to a secondary at most
+    mongodb_max_staleness_seconds behind the primary, or the primary when none is. For the admin listings,
+    history and analytics, which can show data a little behind. Not for the reads of authentication and
+    permissions, nor for reads that must see a write just made, they stay on the primary.
+    """
+    return collection.with_options(read_preference=SECONDARY_READS)
+
 
 # Asynchronous MongoDB connection
 async_connection_string = f'{MONGODB_CONNECTION_STRING}'  # This can be the same as the synchronous connection string
-async_mdb_client = AsyncIOMotorClient(async_connection_string)  # setting mongodb client for asynchronous operations
+# setting mongodb client for asynchronous operations, the listeners time every command and connection checkout
+# for /metrics and log the slow commands
+async_mdb_client = AsyncIOMotorClient(
+    async_connection_string,
+    maxPoolSize=MONGODB_MAX_POOL_SIZE,
+    minPoolSize=MONGODB_MIN_POOL_SIZE,
+    maxIdleTimeMS=MONGODB_MAX_IDLE_TIME_MS,
+    waitQueueTimeoutMS=MONGODB_WAIT_QUEUE_TIMEOUT_MS or None,
+    serverSelectionTimeoutMS=MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+    connectTimeoutMS=MONGODB_CONNECT_TIMEOUT_MS,
+    socketTimeoutMS=MONGODB_SOCKET_TIMEOUT_MS or None,
+    readPreference=MONGODB_READ_PREFERENCE,
+    compressors=available_compressors(MONGODB_COMPRESSORS) or None,
+    event_listeners=[mongo_command_metrics, mongo_pool_metrics, slow_query_listener],
+)
+slow_query_listener.client = async_mdb_client.delegate  # the synchronous client explaining slow queries
 async_database = async_mdb_client['fastapi_db']  # database name in mongodb for asynchronous operations
 
 
-# Function to validate connection
+# Function to validate connection, raises when MongoDB cannot be reached
 async def validate_mongodb_connection():
     try:
         # Attempt to count documents in a specific collection, e.g., 'test_collection'
         count = await async_database['test_collection'].count_documents({})
         print(f"Connection Successful! Found {count} documents in 'test_collection'.")
     except Exception as e:
-        logger.info(f"Connection to MongoDB failed: {e}")
+        logger.error(f"Connection to MongoDB failed: {e}")
+        raise
+
+async def warm_mongodb_pool(size: int = MONGODB_MIN_POOL_SIZE):
+    """Open `size` connections at once, by running as many pings at the same time."""
+    if size <= 0:
+        return
+    await asyncio.gather(*(async_database.command("ping") for _ in range(size)))
+    logger.info("MongoDB pool warmed with %s connections", size)
+
 
 # Running the validation function
 if __name__ == "__main__":
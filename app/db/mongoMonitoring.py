@@ -0,0 +1,194 @@
+"""
+Slow-query log of the MongoDB client.
+
+`SlowQueryListener` is a pymongo command listener: every read and write command slower than
+mongo_slow_query_ms is logged with its collection, duration and the shape of its filter, the filter with
+the values replaced by "?", so queries differing only by their values group together:
+
+    Slow MongoDB find on users: 182ms, filter {"$or": [{"email": "?"}, {"username": "?"}]}
+
+The getMore commands fetching the next batches of a cursor are logged with the collection and filter shape of
+the find or aggregate that opened the cursor.
+
+With mongo_explain_slow=true the query plan of a slow query is fetched in the background (at most once per
+collection and shape every mongo_explain_interval seconds) and logged with the winning plan, e.g.
+`COLLSCAN` for a full collection scan or `FETCH <- IXSCAN {username: 1}`.
+
+The durations per command and collection for /metrics are recorded by `MongoCommandMetrics`.
+"""
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+
+from dotenv import load_dotenv
+from pymongo import monitoring
+from pymongo.errors import PyMongoError
+
+from app.components.logger import logger
+
+load_dotenv()  # loading environment variables
+
+MONGO_SLOW_QUERY_MS = float(os.getenv("mongo_slow_query_ms", 100))  # log commands slower than this, 0 is off
+MONGO_EXPLAIN_SLOW = os.getenv("mongo_explain_slow", "false").lower() == "true"  # log the plan of slow queries
+MONGO_EXPLAIN_INTERVAL = float(os.getenv("mongo_explain_interval", 300))  # seconds between two plans of a query
+
+# Commands with a filter, and where to find it in the command document
+FILTER_FIELDS = {"find": "filter", "count": "query", "distinct": "query", "findAndModify": "query",
+                 "update": "updates", "delete": "deletes", "aggregate": "pipeline"}
+EXPLAINABLE = {"find", "count", "distinct", "aggregate", "findAndModify", "update", "delete"}
+CURSOR_COMMANDS = {"find", "aggregate"}  # their cursors are read further by getMore
+CURSOR_TIMEOUT = 600  # seconds, the server closes the cursors idle for longer
+PRUNE_INTERVAL = 60  # seconds between two clean-ups of the abandoned cursors and the old explains
+
+
+def filter_shape(value: Any) -> Any:
+    """The filter with every value replaced by "?", keeping the fields and operators."""
+    if isinstance(value, dict):
+        return {key: filter_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        if value and all(isinstance(item, dict) for item in value):
+            return [filter_shape(item) for item in value]  # $or, $and, pipelines
+        return ["?"] if value else []  # the values of $in, $nin, $all
+    return "?"
+
+
+def command_shape(command_name: str, command: dict) -> Any:
+    """The shape of the filter of a command: the filter of find, the `q` of updates, the $match of pipelines."""
+    field = FILTER_FIELDS.get(command_name)
+    value = command.get(field) if field else None
+    if command_name in ("update", "delete") and value:
+        value = value[0].get("q")
+    elif command_name == "aggregate" and value:
+        value = [stage for stage in value if "$match" in stage or "$lookup" in stage] or [{"stages": len(value)}]
+    return filter_shape(value or {})
+
+
+def plan_summary(plan: dict) -> str:
+    """The stages of a winning plan from the root down, e.g. `FETCH <- IXSCAN {username: 1}`."""
+    plan = plan.get("queryPlan", plan)  # the slot-based engine nests the plan
+    stages = []
+    while plan:
+        stage = plan.get("stage", "?")
+        if "keyPattern" in plan:
+            stage += " " + json.dumps(plan["keyPattern"], default=str)
+        stages.append(stage)
+        plan = plan.get("inputStage") or (plan.get("inputStages") or [None])[0]
+    return " <- ".join(stages)
+
+
+class SlowQueryListener(monitoring.CommandListener):
+    """
+    Logs the commands slower than `threshold_ms` with their filter shape, and their query plan when `explain`
+    is on. Register it with `event_listeners=[...]` on the client; `client` is the pymongo client running
+    the explains.
+    """
+
+    def __init__(self, threshold_ms: float = MONGO_SLOW_QUERY_MS, explain: bool = MONGO_EXPLAIN_SLOW,
+                 explain_interval: float = MONGO_EXPLAIN_INTERVAL):
+        self.threshold_ms = threshold_ms
+        self.explain = explain
+        self.explain_interval = explain_interval
+        self.client = None
+        self.slow_queries = 0
+        # (connection, request id): (database, command name, command, cursor) of the running commands, the
+        # getMore commands with the find or aggregate of their cursor
+        self._commands = {}
+        self._cursors = {}  # (server, cursor id): (database, command name, command, last use) of the open cursors
+        self._explained = {}  # (collection, shape): time of its last explain
+        self._pruned_at = time.monotonic()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def started(self, event):
+        if not self.threshold_ms:
+            return
+        if event.command_name in FILTER_FIELDS:
+            self._commands[(event.connection_id, event.request_id)] = (
+                event.database_name, event.command_name, event.command, None)
+        elif event.command_name == "getMore":
+            # Measured as the find or aggregate that opened the cursor
+            cursor_key = (event.connection_id, event.command.get("getMore"))
+            cursor = self._cursors.get(cursor_key)
+            if cursor is not None:
+                self._commands[(event.connection_id, event.request_id)] = (*cursor[:3], cursor_key)
+        elif event.command_name == "killCursors":
+            for cursor_id in event.command.get("cursors", []):
+                self._cursors.pop((event.connection_id, cursor_id), None)
+
+    def succeeded(self, event):
+        self._finished(event, reply=event.reply)
+
+    def failed(self, event):
+        self._finished(event, reply=None)
+
+    def _finished(self, event, reply):
+        started = self._commands.pop((event.connection_id, event.request_id), None)
+        if started is None:
+            return
+        database, command_name, command, _ = started
+        now = time.monotonic()
+        if command_name in CURSOR_COMMANDS:
+            self._track_cursor(event, reply, started, now)
+        if now - self._pruned_at >= PRUNE_INTERVAL:
+            self._prune(now)
+        duration_ms = event.duration_micros / 1000
+        if duration_ms < self.threshold_ms:
+            return
+
+        collection = command.get(command_name)
+        shape = json.dumps(command_shape(command_name, command), default=str)
+        returned = None
+        if reply and "cursor" in reply:
+            returned = len(reply["cursor"].get("firstBatch", reply["cursor"].get("nextBatch", [])))
+        self.slow_queries += 1
+        fields = {"event": "slow_query", "command": event.command_name, "collection": collection,
+                  "filter_shape": shape, "query_ms": round(duration_ms, 2), "returned": returned,
+                  "failed": reply is None}
+        logger.warning("Slow MongoDB %s on %s: %.0fms, filter %s", event.command_name, collection, duration_ms,
+                       shape, extra=fields)
+
+        if self.explain and self.client is not None and command_name in EXPLAINABLE:
+            key = (collection, shape)
+            if now - self._explained.get(key, -self.explain_interval) >= self.explain_interval:
+                self._explained[key] = now
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mongo-explain")
+                # Not on the thread reporting the command, it would delay its result
+                self._executor.submit(self._explain, database, command_name, collection, shape, command)
+
+    def _track_cursor(self, event, reply, started: tuple, now: float):
+        """Remember the cursor left open by a find, aggregate or getMore, forget it once exhausted or failed."""
+        database, command_name, command, cursor_key = started
+        cursor_id = ((reply or {}).get("cursor") or {}).get("id", 0)
+        if cursor_id:
+            self._cursors[(event.connection_id, cursor_id)] = (database, command_name, command, now)
+        elif cursor_key is not None:
+            self._cursors.pop(cursor_key, None)
+
+    def _prune(self, now: float):
+        """Forget the cursors abandoned without killCursors and the explains older than explain_interval."""
+        self._pruned_at = now
+        self._cursors = {key: cursor for key, cursor in list(self._cursors.items())
+                         if now - cursor[3] < CURSOR_TIMEOUT}
+        self._explained = {key: explained_at for key, explained_at in list(self._explained.items())
+                           if now - explained_at < self.explain_interval}
+
+    def _explain(self, database: str, command_name: str, collection: str, shape: str, command: dict):
+        # Keep only the command itself, not the session and cluster fields the driver added
+        explained = {key: value for key, value in command.items()
+                     if not key.startswith(("$", "lsid", "txnNumber", "writeConcern"))}
+        try:
+            result = self.client[database].command("explain", explained, verbosity="queryPlanner")
+        except PyMongoError as e:
+            logger.warning("Explaining the slow MongoDB %s on %s failed: %s", command_name, collection, e)
+            return
+        planner = result.get("queryPlanner") or (result.get("stages") or [{}])[0].get("$cursor", {}).get(
+            "queryPlanner", {})
+        summary = plan_summary(planner.get("winningPlan", {}))
+        fields = {"event": "slow_query_plan", "collection": collection, "filter_shape": shape, "plan": summary}
+        logger.warning("Plan of the slow MongoDB %s on %s with filter %s: %s", command_name, collection, shape,
+                       summary, extra=fields)
+
+
+slow_query_listener = SlowQueryListener()
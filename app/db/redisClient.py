@@ -1,10 +1,143 @@
+"""
+Redis client of the app, built from REDIS_URL (redis_url in .env) with a bounded connection pool.
+
+The pool holds up to redis_max_connections connections and a command waits up to redis_pool_timeout
+seconds for a free one, instead of failing at once when all are busy. Connecting gives up after
+redis_connect_timeout seconds, a command after redis_socket_timeout seconds. A command failing with a
+timeout or a dropped connection is retried redis_retries times with a short backoff. A write whose reply was
+lost may have been applied already, so the commands that must not run twice are not retried: the increments,
+SET NX (a replay finds its own key and reports the lock as taken), PUBLISH and scripts, and the pipelines
+containing any of them. Idle connections are checked with a PING every redis_health_check_interval seconds
+before being used. The replies are parsed by hiredis when it is installed (`pip install redis[hiredis]`).
+
+The pub/sub subscriptions have a pool of their own, of up to redis_pubsub_max_connections connections
+(`AsyncRedisClient.get_pubsub_instance`): a subscriber holds its connection for as long as it listens, and many
+of them must not leave the other commands waiting for a connection.
+
+Without a URL, localhost, redis and 0.0.0.0 are tried in turn. The pool usage and the wait for a connection
+are in /metrics (redis_pool_connections, redis_pool_checkout_seconds).
+"""
+import os
+import time
+from contextvars import ContextVar
+from typing import Sequence
+
 import redis.asyncio as aioredis
+from dotenv import load_dotenv
+from redis.asyncio.client import Pipeline
+from redis.asyncio.connection import BlockingConnectionPool, DefaultParser
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialBackoff
 
 from app.components.logger import logger
+from app.components.metrics import observe_redis, observe_redis_checkout, refresh_redis_pool, track_redis_pool
+
+load_dotenv()  # loading environment variables
+
+REDIS_URL = os.getenv("REDIS_URL") or os.getenv("redis_url")  # e.g. redis://redis:6379/0, set by docker-compose
+REDIS_FALLBACK_HOSTS = ['localhost', 'redis', '0.0.0.0']  # tried in turn without a URL
+REDIS_MAX_CONNECTIONS = int(os.getenv("redis_max_connections", 50))
+REDIS_POOL_TIMEOUT = float(os.getenv("redis_pool_timeout", 5))  # seconds waiting for a free connection
+REDIS_CONNECT_TIMEOUT = float(os.getenv("redis_connect_timeout", 2))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("redis_socket_timeout", 5))  # seconds for the reply of a command
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("redis_health_check_interval", 30))
+REDIS_RETRIES = int(os.getenv("redis_retries", 2))
+REDIS_PUBSUB_MAX_CONNECTIONS = int(os.getenv("redis_pubsub_max_connections", 50))
+
+# Commands applied twice when replayed after a lost reply
+NOT_REPLAYABLE = {"INCR", "INCRBY", "INCRBYFLOAT", "DECR", "DECRBY", "HINCRBY", "HINCRBYFLOAT", "ZINCRBY",
+                  "LPUSH", "RPUSH", "PUBLISH", "EVAL", "EVALSHA"}
+
+_no_retry: ContextVar[bool] = ContextVar("redis_no_retry", default=False)  # the running command is not replayable
+
+
+def is_replayable(args: Sequence) -> bool:
+    """Whether the command gives the same outcome when sent twice, and can be retried."""
+    name = str(args[0]).upper()
+    if name == "SET":
+        return not any(str(arg).upper() == "NX" for arg in args[3:])  # after the key and the value
+    return name not in NOT_REPLAYABLE
+
+
+class InstrumentedPipeline(Pipeline):
+    """Pipeline recording the duration of every `execute` as the command "PIPELINE"."""
+
+    async def execute(self, raise_on_error: bool = True):
+        started = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            observe_redis("PIPELINE", time.perf_counter() - started)
+
+    async def _disconnect_raise_reset(self, conn, error: Exception):
+        if all(is_replayable(args) for args, _ in self.command_stack):
+            return await super()._disconnect_raise_reset(conn, error)
+        await conn.disconnect()
+        await self.reset()
+        raise error
+
+
+class InstrumentedRedis(aioredis.StrictRedis):
+    """Redis client recording the duration of every command in the redis_command_duration_seconds metric."""
+
+    async def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        no_retry = _no_retry.set(not is_replayable(args))
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            _no_retry.reset(no_retry)
+            observe_redis(str(args[0]).upper(), time.perf_counter() - started)
+
+    async def _disconnect_raise(self, conn, error: Exception):
+        """Called between two attempts of a command, raising ends the retries."""
+        if not _no_retry.get():
+            return await super()._disconnect_raise(conn, error)
+        await conn.disconnect()
+        raise error
+
+    def pipeline(self, transaction: bool = True, shard_hint=None) -> InstrumentedPipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class InstrumentedConnectionPool(BlockingConnectionPool):
+    """Pool recording how long a command waits for its connection, a new connection included."""
+
+    async def get_connection(self, command_name, *keys, **options):
+        started = time.perf_counter()
+        try:
+            return await super().get_connection(command_name, *keys, **options)
+        finally:
+            observe_redis_checkout(time.perf_counter() - started)
+
+    async def release(self, connection):
+        await super().release(connection)
+        refresh_redis_pool()
+
+    def stats(self) -> dict:
+        """Connections in use, idle in the pool, and the most the pool opens."""
+        return {"in_use": len(self._in_use_connections), "idle": len(self._available_connections),  # noqa
+                "max": self.max_connections}
+
+
+def create_connection_pool(url: str) -> InstrumentedConnectionPool:
+    return InstrumentedConnectionPool.from_url(
+        url,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT,
+        socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+        socket_timeout=REDIS_SOCKET_TIMEOUT,
+        socket_keepalive=True,
+        health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+        retry_on_timeout=True,
+        retry=Retry(ExponentialBackoff(cap=0.5, base=0.01), REDIS_RETRIES),
+        decode_responses=True,
+    )
 
 
 class AsyncRedisClient:
     _instance = None
+    _pubsub_instance = None
 
     @classmethod
     async def get_instance(cls):
@@ -15,21 +148,40 @@ class AsyncRedisClient:
             cls._instance = await cls.create_redis_client()
         return cls._instance
 
+    @classmethod
+    async def get_pubsub_instance(cls):
+        """
+        Client of the pub/sub subscriptions, to the same server as the main client but with a pool of its own.
+        """
+        if cls._pubsub_instance is None:
+            pool = (await cls.get_instance()).connection_pool
+            cls._pubsub_instance = aioredis.StrictRedis.from_pool(BlockingConnectionPool(
+                connection_class=pool.connection_class, max_connections=REDIS_PUBSUB_MAX_CONNECTIONS,
+                timeout=REDIS_POOL_TIMEOUT, **pool.connection_kwargs))
+        return cls._pubsub_instance
+
     @staticmethod
     async def create_redis_client():
         """
-        Asynchronously create a Redis client. Tries to connect to localhost, redis, and 0.0.0.0.
+        Asynchronously create a Redis client from REDIS_URL, or the first of localhost, redis and 0.0.0.0
+        answering without a URL.
         """
-        hosts = ['localhost', 'redis', '0.0.0.0']
-        for host in hosts:
+        urls = [REDIS_URL] if REDIS_URL else [f"redis://{host}:6379/0" for host in REDIS_FALLBACK_HOSTS]
+        for url in urls:
+            pool = create_connection_pool(url)
+            client = InstrumentedRedis.from_pool(pool)
+            address = "{host}:{port}/{db}".format(**{"host": "", "port": 6379, "db": 0, **pool.connection_kwargs})
             try:
-                client = aioredis.StrictRedis(host=host, port=6379, db=0, decode_responses=True)
                 # The ping command is now an awaitable coroutine
                 if await client.ping():
-                    logger.info(f"Successfully connected to Redis server at {host}")
+                    logger.info("Successfully connected to Redis server at %s (pool of %s connections, %s)",
+                                address, pool.max_connections,
+                                pool.connection_kwargs.get("parser_class", DefaultParser).__name__)
+                    track_redis_pool(pool.stats)
                     return client
-            except aioredis.ConnectionError as e:
-                logger.error(f"Could not connect to Redis server at {host}: {e}.")
+            except (aioredis.ConnectionError, aioredis.TimeoutError) as e:
+                logger.error("Could not connect to Redis server at %s: %s", address, e)
+            await client.aclose()
         raise Exception("Could not connect to any Redis server.")
 
 # # An Redis Lock Example for Future Implementations When Running Multiple Workers
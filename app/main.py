@@ -1,25 +1,43 @@
 import asyncio  # Provides infrastructure for writing single-threaded concurrent code using coroutines
 import logging  # Enables logging events for your application, essential for debugging and monitoring
+import os  # Access to the file system and the environment variables
+from contextlib import asynccontextmanager  # Turns the startup and shutdown into the lifespan of the app
 from typing import Any  # Facilitates type hints, allowing for more readable and maintainable code
 
 import uvicorn  # ASGI server for running your FastAPI application, handling asynchronous requests
-from fastapi import FastAPI, Depends  # Core FastAPI functionality for creating API and managing dependencies
+from fastapi import FastAPI, Depends, Query, Request  # Core FastAPI functionality for the API and its dependencies
 from fastapi.middleware.cors import \
     CORSMiddleware  # Middleware for handling CORS (Cross-Origin Resource Sharing) settings
 from fastapi.security import HTTPBasicCredentials  # Security utility for basic HTTP authentication
 from starlette.config import Config  # Configuration management, often used for environment variables
+from starlette.responses import PlainTextResponse
 
 # Local imports for authentication components and initial settings setup
 from app.components.auth.fastapi_auth import verify_credentials, get_secret_key
 from app.components.auth.jwt_token_handler import get_jwt_secret_key
+from app.components.chat_gpt.chatgpt_service import create_http_client, ChatGptService
+from app.components.chat_gpt.conversations import ConversationStore
+from app.components.chat_gpt.quotas import ChatLimiter
+from app.components.chat_gpt.response_cache import ChatResponseCache
+from app.components.chat_gpt.single_flight import SingleFlight
+from app.components.log_archive import log_archiver
 from app.components.initial_settings import create_owner, initialize_message_settings, create_indexes
+from app.components.message_dispatcher.dispatcher import MessageDispatcher
+from app.components.message_dispatcher.email_history import email_history, email_history_archiver
+from app.components.message_dispatcher.mail import SmtpChannel
+from app.components.message_dispatcher.twilio import WhatsappChannel, SmsChannel
+from app.components.metrics import MetricsMiddleware, loop_lag_monitor, metrics_response, remove_worker_metrics
+from app.components.profiler import PROFILE_INTERVAL, PROFILE_MAX_SECONDS, ProfileMiddleware, get_profile, profile
+from app.components.request_context import RequestContextMiddleware
+from app.components.server_timing import ServerTimingMiddleware
+from app.components.startup import Step, bootstrap, run_steps
 
 #Database clients
-from app.db.mongoClient import async_mdb_client, validate_mongodb_connection
+from app.db.mongoClient import async_mdb_client, validate_mongodb_connection, warm_mongodb_pool
 from app.db.redisClient import AsyncRedisClient
 
 # Routers
-from app.routers import auth, users, chatgpt, register
+from app.routers import auth, users, chatgpt, register, senders
 from app.routers.settings import messages
 
 
@@ -32,6 +50,11 @@ class State:
     or any other resources that need to be globally accessible throughout the application.
     """
     redis: Any = None  # Use a more specific type if possible
+    redis_pubsub: Any = None  # Redis client of the pub/sub subscriptions, on a connection pool of its own
+    dispatcher: Any = None  # MessageDispatcher sending email, WhatsApp and SMS messages
+    http_client: Any = None  # httpx.AsyncClient shared by all ChatGPT calls
+    chatgpt: Any = None  # ChatGptService answering the chat routes
+    chat_limiter: Any = None  # ChatLimiter holding the concurrency limits and token quotas of the chat routes
 
 class CustomFastAPI(FastAPI):
     """
@@ -50,11 +73,21 @@ class CustomFastAPI(FastAPI):
         self.state: State = State()
 
 
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    """Startup before the first request, shutdown after the last one, or after a failed startup."""
+    try:
+        await startup_event()  # a failure still closes what was started before it
+        yield
+    finally:
+        await shutdown_event()
+
+
 # loading the FastAPI app
-app = CustomFastAPI(docs_url=None, redoc_url=None, openapi_url=None)
+app = CustomFastAPI(docs_url=None, redoc_url=None, openapi_url=None, lifespan=lifespan)
 
-# Read the configuration
-config = Config(".env")
+# Read the configuration, the settings can also come from the environment alone (containers, benchmarks)
+config = Config(".env" if os.path.exists(".env") else None)
 
 # Configure CORS settings
 origins = [
@@ -89,9 +122,24 @@ app.add_middleware(
     # expose_headers: This allows the server to whitelist headers that browsers are allowed to access.
     # For example, including "Content-Disposition" enables accessing this header in the response
     # to handle file downloads or attachments in the client application.
-    expose_headers=["Content-Disposition"]
+    expose_headers=["Content-Disposition", "X-Request-ID", "Server-Timing", "X-Profile-Id"]
 )
 
+# Samples the stacks of the event loop while a request with `X-Profile: <profile_token>` runs
+app.add_middleware(ProfileMiddleware)  # type: ignore
+
+# Time per phase (dependencies, handler, serialization) and per Redis/MongoDB call of every request, sent in
+# the Server-Timing header and logged for slow requests. Inside the request context, so its logs carry the id.
+app.add_middleware(ServerTimingMiddleware)  # type: ignore
+
+# Gives every request an id and a log context (user, route, duration), added to all its log records.
+# Middlewares added later wrap the earlier ones: this one also times the CORS handling.
+app.add_middleware(RequestContextMiddleware)  # type: ignore
+
+# Request count, latency per route and status, and requests in flight, served by /metrics.
+# Added last, so it is the outermost middleware and also counts the time of the request context.
+app.add_middleware(MetricsMiddleware)  # type: ignore
+
 # API default path
 prefix_path = '/api/v1'
 
@@ -127,6 +175,11 @@ app.include_router(register.router, prefix=prefix_path, dependencies=[Depends(ge
 # interact with message services.
 app.include_router(messages.router, prefix=prefix_path, dependencies=[Depends(get_jwt_secret_key)], tags=["messages"])
 
+# Sender Routes
+# Sends messages through the multi-channel dispatcher (email, WhatsApp, SMS). Every channel has its own
+# connection pool, rate limit and batching, the routes only queue the messages and wait for the result.
+app.include_router(senders.router, prefix=prefix_path, dependencies=[Depends(get_jwt_secret_key)], tags=["messages"])
+
 
 @app.get("/openapi.json", include_in_schema=False)
 async def get_open_api_endpoint(credentials: HTTPBasicCredentials = Depends(verify_credentials)):  # noqa
@@ -183,49 +236,87 @@ async def custom_redoc_url(credentials: HTTPBasicCredentials = Depends(verify_cr
     from fastapi.openapi.docs import get_redoc_html
     return get_redoc_html(openapi_url="/openapi.json", title=app.title)  # noqa
 
-@app.on_event("startup")
-async def startup_event():
+@app.get("/metrics", include_in_schema=False)
+async def metrics(credentials: HTTPBasicCredentials = Depends(verify_credentials)):  # noqa
+    """
+    Prometheus metrics: request latency per route and status, requests in flight, Redis and MongoDB
+    command latency and event loop lag. Protected like the docs, scrape it with basic auth.
     """
-    Initializes critical components upon FastAPI application startup.
+    return metrics_response()
 
-    This function is called automatically when the FastAPI server is started. It serves multiple
-    important purposes:
 
-    1. Initializes an asynchronous Redis client and assigns it to the application state, making it
-       globally accessible throughout the application. This is essential for operations that require
-       caching, message queuing, or any other Redis-powered features.
+@app.get("/debug/profile", include_in_schema=False, response_class=PlainTextResponse)
+async def debug_profile(seconds: float = Query(10, gt=0, le=PROFILE_MAX_SECONDS),
+                        interval_ms: float = Query(PROFILE_INTERVAL * 1000, ge=1, le=1000),
+                        all_threads: bool = False, idle: bool = False,
+                        credentials: HTTPBasicCredentials = Depends(verify_credentials)):  # noqa
+    """
+    Sampling profile of this worker for `seconds`, as folded stacks for flamegraph.pl or speedscope.
+    Only the event loop is sampled unless `all_threads` is set; `idle` keeps the time spent waiting for I/O.
+    """
+    return await profile(seconds, interval_ms / 1000, all_threads, idle)
 
-    2. Calls the `create_owner` function to ensure that an owner account is present in the database.
-       This step is crucial for administrative access and managing the application.
 
-    3. Calls the `initialize_message_settings` function to set up initial messaging settings (like
-       SMTP for emails, WhatsApp, or SMS configurations). This ensures that the application can
-       send notifications or perform communication tasks right from the start.
+@app.get("/debug/profile/{profile_id}", include_in_schema=False, response_class=PlainTextResponse)
+async def debug_request_profile(profile_id: str, request: Request,
+                                credentials: HTTPBasicCredentials = Depends(verify_credentials)):  # noqa
+    """Folded stacks of a request profiled with the X-Profile header, by the X-Profile-Id of its response."""
+    return await get_profile(request.app.state.redis, profile_id)
 
-    If any exceptions occur during these initialization steps, they are caught and logged. This
-    catch-all exception handling ensures that the application can still run even if there are issues
-    with non-critical initializations. However, it's important to monitor these exceptions and
-    address them as needed to ensure all features work as expected.
 
-    Note: The use of 'noqa' in the exception handling implies that we're intentionally ignoring
-    specific linting warnings. This is typically done to bypass warnings about bare excepts or
-    unused variables (like 'e' for the exception). It's a good practice to log these exceptions
-    to understand what went wrong.
+async def startup_event():
     """
+    Initializes critical components upon FastAPI application startup, in two phases:
 
-    await validate_mongodb_connection()  # Validate MongoDB connection
-    await create_indexes()
+    1. The steps every worker needs, run concurrently: the MongoDB and Redis connections, the MongoDB pool
+       warm-up to its minimum size, the message dispatcher, the sent-email history buffer and the
+       background monitors. The Redis client is assigned to the application state, making it globally
+       accessible throughout the application.
 
-    app.state.redis = await AsyncRedisClient.get_instance()
+    2. The one-time bootstrap, by a single worker elected through a lock in Redis: the indexes, the owner
+       account (`create_owner`) and the initial messaging settings (`initialize_message_settings`).
+       The other workers skip it and wait for its outcome, so none serves requests before the indexes exist.
 
-    try:
-        await create_owner()
-        await initialize_message_settings()
-    except Exception as e:  # noqa
-        pass
+    Every failed step is logged with its name. A failure of the MongoDB or Redis connection, the dispatcher,
+    the email history or the indexes stops the startup with a `StartupError` naming the failed steps; the
+    other steps are not needed to serve requests and the worker starts anyway. After a failed startup the
+    lifespan still runs `shutdown_event`, closing the connections and tasks started before the failure.
+    """
+
+    # One pooled HTTP client for the ChatGPT API, keeping its connections alive between requests
+    app.state.http_client = create_http_client()
+    app.state.dispatcher = MessageDispatcher([SmtpChannel(), WhatsappChannel(), SmsChannel()])
+
+    async def connect_redis():
+        app.state.redis = await AsyncRedisClient.get_instance()
+        app.state.redis_pubsub = await AsyncRedisClient.get_pubsub_instance()
+
+    await run_steps(
+        Step("mongodb", validate_mongodb_connection),
+        Step("mongodb_pool", warm_mongodb_pool, critical=False),  # opens the mongodb_min_pool_size connections
+        Step("redis", connect_redis),
+        Step("dispatcher", app.state.dispatcher.start),
+        Step("email_history", email_history.start),  # background writer for the sent-email history
+        # moves old history records away when retention mode is "archive"
+        Step("email_history_archiver", email_history_archiver.start, critical=False),
+        # compresses closed log days and removes the ones beyond the retention
+        Step("log_archiver", log_archiver.start, critical=False),
+        Step("loop_lag_monitor", loop_lag_monitor.start, critical=False),  # event_loop_lag_seconds of /metrics
+    )
+
+    app.state.chatgpt = ChatGptService(app.state.http_client, ChatResponseCache(app.state.redis),
+                                       SingleFlight(app.state.redis, pubsub_client=app.state.redis_pubsub),
+                                       ConversationStore(app.state.redis))
+    app.state.chat_limiter = ChatLimiter(app.state.redis)
+
+    await bootstrap(
+        app.state.redis,
+        Step("indexes", create_indexes),
+        Step("owner", create_owner, critical=False),
+        Step("message_settings", initialize_message_settings, critical=False),
+    )
 
 
-@app.on_event("shutdown")
 async def shutdown_event():
     """
        Handle the FastAPI application shutdown.
@@ -235,7 +326,8 @@ async def shutdown_event():
        like MongoDB and Redis. Specifically, it:
 
        - Logs the shutdown initiation,
-       - Closes the asynchronous Redis client connection, if it exists and is open,
+       - Flushes the sent-email history buffer and reports records that could not be saved,
+       - Closes the Redis clients (commands and pub/sub) and their connection pools, if they exist,
        - Closes the asynchronous MongoDB client connection, if it has been initialized and supports
          an asynchronous close operation.
 
@@ -245,9 +337,27 @@ async def shutdown_event():
 
     logging.info("Shutdown the application and close the MongoDB, Redis connections")
 
-    # Ensure Redis client is closed properly if it's async
-    if app.state.redis and hasattr(app.state.redis, "close"):
-        await app.state.redis.close()  # This presumes close is an async method
+    # Stop the message channels first, emails they send still end up in the history buffer
+    if app.state.dispatcher:
+        await app.state.dispatcher.stop()
+
+    if app.state.chatgpt:
+        await app.state.chatgpt.aclose()  # lets running chat session summaries finish
+
+    if app.state.http_client:
+        await app.state.http_client.aclose()
+
+    # Write the buffered email history before the MongoDB client goes away
+    await email_history_archiver.stop()
+    await email_history.stop()
+    await log_archiver.stop()
+    await loop_lag_monitor.stop()
+
+    # Close the Redis clients and their connection pools
+    if app.state.redis:
+        await app.state.redis.aclose()
+    if app.state.redis_pubsub:
+        await app.state.redis_pubsub.aclose()
 
     # Close the MongoDB client if it's initialized and the close method is awaitable
     if async_mdb_client and hasattr(async_mdb_client, "close"):
@@ -255,6 +365,8 @@ async def shutdown_event():
         if asyncio.iscoroutinefunction(async_mdb_client.close) or asyncio.iscoroutine(close_method):
             await close_method
 
+    remove_worker_metrics()
+
 
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
@@ -8,9 +8,10 @@ from passlib.context import CryptContext
 from app.classes.Auth import SimpleAuthForm
 from app.components.auth.jwt_token_handler import create_jwt_access_token
 from app.components.logger import logger
+from app.components.server_timing import TimedAPIRoute
 from app.db.mongoClient import async_database
 
-router = APIRouter()
+router = APIRouter(route_class=TimedAPIRoute)
 
 user_collection = async_database.users  # Get the collection from the database
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")  # setup password hashing context
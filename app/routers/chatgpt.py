@@ -1,17 +1,315 @@
-from fastapi import APIRouter, Depends
-from starlette.responses import JSONResponse
+import asyncio
+import json
+from contextlib import aclosing
+from typing import AsyncIterator, List, Optional, Tuple
 
-from app.classes.Chatgpt import ChatGptModelEnum
-from app.components.auth.check_permissions import check_permissions
-from app.components.chat_gpt.chatgpt_service import ask_chatgpt_with_context
+import httpx
+from fastapi import APIRouter, Depends, HTTPException, Path, Query, Request, Header
+from starlette.background import BackgroundTask
+from starlette.responses import JSONResponse, StreamingResponse
 
-router = APIRouter()  # loading the FastAPI app
+from app.classes.Chatgpt import ChatBatchRequest, ChatBatchResult, ChatGptModelEnum, ChatSession
+from app.components.auth.check_permissions import check_permissions, require_role
+from app.components.auth.jwt_token_handler import get_jwt_username
+from app.components.chat_gpt.batch import CHATGPT_BATCH_CONCURRENCY, CHATGPT_BATCH_MAX_ITEMS, run_batch
+from app.components.chat_gpt.conversations import count_tokens
+from app.components.logger import logger
+from app.components.server_timing import TimedAPIRoute
+from app.db.mongoClient import async_database
+
+router = APIRouter(route_class=TimedAPIRoute)  # loading the FastAPI app
+
+SESSION_ID_PATTERN = r"^[A-Za-z0-9_-]{1,64}$"
+
+
+def sse_event(data: dict, event: str = None) -> str:
+    """Format a Server-Sent Event."""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+class ChatLease:
+    """
+    Concurrency slot and token accounting of one chat request, see `ChatLimiter`. `acquire` runs before
+    the upstream call and raises a 429 when the user is over a limit. `release` may be called more than once,
+    streamed responses also call it as their background task, in case their body is never iterated.
+    """
+
+    def __init__(self, request: Request):
+        self.limiter = request.app.state.chat_limiter
+        self.user = getattr(request.state, "user", None)  # set by check_permissions
+        self.lease = None
+
+    async def acquire(self):
+        if self.limiter and self.user:
+            self.lease = await self.limiter.acquire(self.user)
+
+    async def release(self):
+        if self.limiter and self.user:
+            await self.limiter.release(self.user["username"], self.lease)
+            self.lease = None
+
+    async def record(self, usage: Optional[dict], model: str, *texts: str):
+        """Add the tokens reported by the API, or an estimate from the texts when the API did not report them."""
+        if not (self.limiter and self.user):
+            return
+        tokens = (usage or {}).get("total_tokens") or sum(count_tokens(text, model) for text in texts)
+        await self.limiter.record(self.user["username"], tokens)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.release()
+
+
+async def open_stream(upstream: AsyncIterator[str], lease: ChatLease) -> List[str]:
+    """
+    Read the first token of an upstream stream before the response starts, so an upstream that fails is
+    answered with its status code instead of a 200 stream ending in an error event.
+    """
+    try:
+        return [await anext(upstream)]
+    except StopAsyncIteration:
+        return []
+    except BaseException:
+        await upstream.aclose()
+        await lease.release()
+        raise
+
+
+def cache_mode(cache: bool, cache_control: str = None) -> Tuple[bool, bool]:
+    """
+    Decide whether the response cache may be read and written.
+    `Cache-Control: no-cache` fetches a fresh answer but stores it, `no-store` (or cache=false) skips the cache.
+    """
+    directives = {directive.strip().lower() for directive in (cache_control or "").split(",")}
+    if not cache or "no-store" in directives:
+        return False, False
+    if "no-cache" in directives:
+        return False, True
+    return True, True
 
 
 @router.get("/chat/", dependencies=[Depends(check_permissions)])
-async def chat_with_gpt(question: str, model: ChatGptModelEnum):
+async def chat_with_gpt(question: str, model: ChatGptModelEnum, request: Request, stream: bool = False,
+                        cache: bool = True, cache_control: str = Header(None),
+                        session_id: str = Query(None, pattern=SESSION_ID_PATTERN),
+                        username: str = Depends(get_jwt_username)):
     """
     Chat with ChatGPT
+
+    With `stream=true` (or an `Accept: text/event-stream` header) the answer is sent as Server-Sent Events
+    while it is generated: one `data: {"token": ...}` event per token, then an `event: done` event with the
+    full text. Otherwise the full answer is returned as JSON once it is complete.
+
+    Answers are cached per model and normalized question. `cache=false` or `Cache-Control: no-store`
+    bypasses the cache, `Cache-Control: no-cache` forces a fresh answer. The `X-Cache` response header
+    tells whether the answer was a HIT or a MISS, or SHARED when it came from a concurrent identical request.
+
+    With a `session_id` (any id chosen by the client) the question continues that conversation: earlier turns
+    are sent along, trimmed or summarized to fit the token budget of the model, and the cache is not used.
+
+    Requests count against the concurrency limit and the rolling token quota of the user; a request over
+    either is answered with 429 before anything is sent upstream.
+
+    When ChatGPT fails, the status code tells why: 429 when it is rate limited, 502 when it returns an error
+    or can't be reached, 503 while its circuit is open and 504 when it does not answer in time.
+    """
+    service = request.app.state.chatgpt
+    read_cache, write_cache = cache_mode(cache, cache_control)
+    wants_stream = stream or "text/event-stream" in request.headers.get("accept", "")
+    lease = ChatLease(request)
+
+    if session_id:
+        return await chat_in_session(service, lease, username, session_id, question, model, wants_stream)
+
+    if not wants_stream:
+        async with lease:
+            answer = await service.ask(question, model, read_cache=read_cache, write_cache=write_cache)
+        if not (answer.cached or answer.shared):
+            await lease.record(answer.usage, model.value, question, answer.message)
+        return JSONResponse(content={"message": answer.message},
+                            headers={"X-Cache": "HIT" if answer.cached else "SHARED" if answer.shared else "MISS"})
+
+    cached_answer = None
+    if service.cache and read_cache:
+        cached_answer, _ = await service.cache.get(model.value, question)
+    usage, upstream, tokens = {}, None, []
+    if cached_answer is None:
+        await lease.acquire()  # released by the stream, or by the background task if the stream never starts
+        upstream = service.stream(question, model, usage)
+        tokens = await open_stream(upstream, lease)
+
+    async def events():
+        if cached_answer is not None:
+            yield sse_event({"token": cached_answer})
+            yield sse_event({"message": cached_answer}, event="done")
+            return
+
+        try:
+            for token in tokens:
+                yield sse_event({"token": token})
+            # aclosing closes the upstream stream as soon as this generator stops, whatever the reason
+            async with aclosing(upstream):
+                async for token in upstream:
+                    tokens.append(token)
+                    yield sse_event({"token": token})
+            message = "".join(tokens)
+            if service.cache and write_cache:
+                await service.cache.set(model.value, question, message)
+            yield sse_event({"message": message}, event="done")
+        except asyncio.CancelledError:
+            # The client went away; leaving the generator closes the upstream stream as well
+            logger.info(f"Chat stream cancelled by the client after {len(tokens)} tokens.")
+            raise
+        except (httpx.HTTPError, HTTPException) as e:
+            logger.error(f"Chat stream failed: {e}")
+            yield sse_event({"message": "Error: Unable to fetch response."}, event="error")
+        finally:
+            await lease.release()
+            await lease.record(usage, model.value, question, *tokens)
+
+    return StreamingResponse(events(), media_type="text/event-stream", background=BackgroundTask(lease.release),
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no",
+                                      "X-Cache": "HIT" if cached_answer is not None else "MISS"})
+
+
+async def chat_in_session(service, lease: ChatLease, username: str, session_id: str, question: str,
+                          model: ChatGptModelEnum, stream: bool):
+    await lease.acquire()
+    if not stream:
+        try:
+            answer = await service.converse(username, session_id, question, model)
+        finally:
+            await lease.release()
+        await lease.record(answer.usage, model.value, question, answer.message)
+        return JSONResponse(content={"message": answer.message, "session_id": session_id})
+
+    usage = {}
+    upstream = service.stream_conversation(username, session_id, question, model, usage)
+    tokens = await open_stream(upstream, lease)
+
+    async def events():
+        try:
+            for token in tokens:
+                yield sse_event({"token": token})
+            async with aclosing(upstream):
+                async for token in upstream:
+                    tokens.append(token)
+                    yield sse_event({"token": token})
+            yield sse_event({"message": "".join(tokens), "session_id": session_id}, event="done")
+        except asyncio.CancelledError:
+            logger.info(f"Chat session stream cancelled by the client after {len(tokens)} tokens.")
+            raise
+        except (httpx.HTTPError, HTTPException) as e:
+            logger.error(f"Chat session stream failed: {e}")
+            yield sse_event({"message": "Error: Unable to fetch response."}, event="error")
+        finally:
+            await lease.release()
+            await lease.record(usage, model.value, question, *tokens)
+
+    return StreamingResponse(events(), media_type="text/event-stream", background=BackgroundTask(lease.release),
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@router.post("/chat/batch/", response_model=List[ChatBatchResult], dependencies=[Depends(check_permissions)])
+async def chat_batch(batch: ChatBatchRequest, request: Request, stream: bool = False):
+    """
+    Answer a list of questions with a bounded number of concurrent upstream calls.
+
+    Each question is sent like a question of `/chat/`, with its retries and circuit breaker, and shares the
+    response cache with it. Results are returned in the order of the questions. With `stream=true` they are
+    sent as newline-delimited JSON as soon as each one is ready, in completion order, with the `index` of
+    their question.
+    """
+    if len(batch.questions) > CHATGPT_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"A batch holds at most {CHATGPT_BATCH_MAX_ITEMS} questions.")
+
+    # A batch takes one concurrency slot of the user, its token use is recorded per answer
+    lease = ChatLease(request)
+    await lease.acquire()
+    results = run_batch(request.app.state.chatgpt, batch.questions, batch.model.value,
+                        batch.concurrency or CHATGPT_BATCH_CONCURRENCY, read_cache=batch.cache)
+
+    async def collect():
+        try:
+            async with aclosing(results):
+                async for result in results:
+                    if result.usage:
+                        await lease.record(result.usage, batch.model.value)
+                    yield result
+        finally:
+            await lease.release()
+
+    if stream:
+        async def lines():
+            async with aclosing(collect()) as collected:
+                async for result in collected:
+                    yield result.model_dump_json() + "\n"
+
+        return StreamingResponse(lines(), media_type="application/x-ndjson", background=BackgroundTask(lease.release))
+
+    ordered: List[ChatBatchResult] = [None] * len(batch.questions)  # type: ignore
+    async with aclosing(collect()) as collected:
+        async for result in collected:
+            ordered[result.index] = result
+    return ordered
+
+
+@router.get("/chat/sessions/{session_id}", response_model=ChatSession, dependencies=[Depends(check_permissions)])
+async def get_chat_session(request: Request, session_id: str = Path(..., pattern=SESSION_ID_PATTERN),
+                           username: str = Depends(get_jwt_username)):
+    """
+    Turns, summary and token count of one of your conversation sessions.
+    """
+    session = await request.app.state.chatgpt.conversations.get(username, session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Chat session not found.")
+    return session
+
+
+@router.delete("/chat/sessions/{session_id}", status_code=204)
+async def delete_chat_session(request: Request, session_id: str = Path(..., pattern=SESSION_ID_PATTERN),
+                              username: str = Depends(get_jwt_username)):
+    """
+    Delete one of your conversation sessions. Sessions belong to their user, so no role permission is needed.
+    """
+    if not await request.app.state.chatgpt.conversations.delete(username, session_id):
+        raise HTTPException(status_code=404, detail="Chat session not found.")
+
+
+@router.get("/chat/usage/", dependencies=[Depends(require_role("owner", "admin"))])
+async def chat_usage_report(request: Request, top: int = Query(50, ge=1, le=1000)):
+    """
+    The users with the highest chat token use within the rolling quota window.
+    """
+    limiter = request.app.state.chat_limiter
+    return {"window_seconds": limiter.window, "users": await limiter.usage_report(top)}
+
+
+@router.get("/chat/usage/{username}", dependencies=[Depends(require_role("owner", "admin"))])
+async def chat_user_usage(username: str, request: Request):
+    """
+    Chat token use, running requests and limits of one user.
+    """
+    user = await async_database.users.find_one({"username": username})
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found.")
+
+    limiter = request.app.state.chat_limiter
+    concurrency_limit, token_quota = limiter.limits(user)
+    return {**await limiter.usage(username), "in_flight": await limiter.in_flight(username),
+            "concurrency_limit": concurrency_limit, "token_quota": token_quota, "window_seconds": limiter.window}
+
+
+@router.get("/chat/cache/stats", dependencies=[Depends(check_permissions)])
+async def chat_cache_stats(request: Request):
+    """
+    Hit rate and counters of the ChatGPT response cache, of request coalescing and of the upstream
+    retries and circuit breakers in this worker.
     """
-    answer = ask_chatgpt_with_context(question, model)
-    return JSONResponse(content={"message": answer})
+    service = request.app.state.chatgpt
+    stats = service.cache.stats() if service.cache else {"enabled": False}
+    return {**stats, "single_flight": service.single_flight.stats(), "upstream": service.guard.stats()}
@@ -8,10 +8,11 @@ from app.classes.User import User, Role, UserRegistration
 from app.components.hash_password import hash_password
 from app.components.logger import logger
 from app.components.message_dispatcher.mail import send_email_and_save
+from app.components.server_timing import TimedAPIRoute
 from app.db.mongoClient import async_database
 from app.routers.users import user_exists
 
-router = APIRouter()  # router instance
+router = APIRouter(route_class=TimedAPIRoute)  # router instance
 user_collection = async_database.users  # Get the collection from the database
 
 
@@ -1,8 +1,34 @@
 from typing import List
-from fastapi import APIRouter, UploadFile, File, Form
-from app.components.message_dispatcher.mail import send_email_and_save
 
-router = APIRouter()
+from fastapi import APIRouter, Depends, Request
 
+from app.classes.Messages import OutgoingMessage, DispatchResult
+from app.components.auth.check_permissions import check_permissions
+from app.components.server_timing import TimedAPIRoute
 
+router = APIRouter(route_class=TimedAPIRoute)
 
+
+@router.post("/send-message/", response_model=DispatchResult, dependencies=[Depends(check_permissions)])
+async def send_message(message: OutgoingMessage, request: Request):
+    """Sends a message over the email, WhatsApp or SMS channel.
+
+       The message is queued by the dispatcher and delivered in a batch together with other pending
+       messages of the same channel, subject to the rate limit of the channel.
+    """
+    return await request.app.state.dispatcher.send(message)
+
+
+@router.post("/send-messages/", response_model=List[DispatchResult], dependencies=[Depends(check_permissions)])
+async def send_messages(messages: List[OutgoingMessage], request: Request):
+    """Sends several messages at once, possibly over different channels.
+
+       One result is returned per message, in the order of the request.
+    """
+    return await request.app.state.dispatcher.send_many(messages)
+
+
+@router.get("/send-message/stats", dependencies=[Depends(check_permissions)])
+async def dispatcher_stats(request: Request):
+    """Queue length and delivery counters of each channel."""
+    return request.app.state.dispatcher.stats()
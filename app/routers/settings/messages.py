@@ -1,17 +1,24 @@
-from typing import List
+import re
+from datetime import datetime, timezone
+from typing import List, Optional
 
 from bson import ObjectId
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException
+from bson.errors import InvalidId
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Depends, Query
+from pymongo import DESCENDING
 
-from app.classes.Messages import MessagesConfigModel
+from app.classes.Messages import MessagesConfigModel, EmailSentModel, EmailHistoryPage
+from app.components.auth.check_permissions import check_permissions
 from app.components.message_dispatcher.mail import send_email_and_save, test_email_connection
-from app.db.mongoClient import async_mdb_client, async_database
+from app.components.server_timing import TimedAPIRoute
+from app.db.mongoClient import async_mdb_client, async_database, secondary_reads
 
-router = APIRouter()
+router = APIRouter(route_class=TimedAPIRoute)
 
 # mongo connection
 config_collection = async_database.settings
 emails_collection = async_mdb_client.messages.emails_sent
+emails_history = secondary_reads(emails_collection)  # The history pages are read from a secondary
 
 
 @router.get("/config", response_model=MessagesConfigModel)
@@ -76,3 +83,72 @@ async def send_email(
     """
     return await send_email_and_save(subject, body, to_emails, files)
 
+
+def encode_history_cursor(record: dict) -> str:
+    """Encode the position of the last record of a page as `<sent_at in ms>_<_id>`."""
+    sent_at = record.get("sent_at")
+    # MongoDB returns naive UTC datetimes with millisecond precision
+    timestamp = str(int(sent_at.replace(tzinfo=timezone.utc).timestamp() * 1000)) if sent_at else ""
+    return f"{timestamp}_{record['_id']}"
+
+
+def decode_history_cursor(cursor: str) -> dict:
+    """Build the query that selects the records after the given cursor, in (sent_at, _id) descending order."""
+    try:
+        timestamp, record_id = cursor.split("_", 1)
+        record_id = ObjectId(record_id)
+        # Naive UTC like the datetimes MongoDB returns
+        sent_at = datetime.fromtimestamp(int(timestamp) / 1000, timezone.utc).replace(tzinfo=None) \
+            if timestamp else None
+    except (ValueError, InvalidId):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    if sent_at is None:
+        # Records without sent_at sort last, only the rest of them remain
+        return {"sent_at": None, "_id": {"$lt": record_id}}
+    return {"$or": [
+        {"sent_at": {"$lt": sent_at}},
+        {"sent_at": sent_at, "_id": {"$lt": record_id}},
+        {"sent_at": None},
+    ]}
+
+
+@router.get("/emails-sent/", response_model=EmailHistoryPage, dependencies=[Depends(check_permissions)])
+async def get_emails_sent(
+        recipient: Optional[str] = Query(None, description="Only emails sent to this address"),
+        subject_prefix: Optional[str] = Query(None, description="Only emails whose subject starts with this text"),
+        sent_from: Optional[datetime] = Query(None, description="Only emails sent at or after this time (UTC)"),
+        sent_to: Optional[datetime] = Query(None, description="Only emails sent before this time (UTC)"),
+        limit: int = Query(20, ge=1, le=100),
+        cursor: Optional[str] = Query(None, description="The next_cursor of the previous page"),
+):
+    """Returns the sent-email history, newest first.
+
+       Pages are fetched with a cursor instead of an offset, so every page is an index range scan
+       no matter how deep into the history it is.
+    """
+    conditions = []
+    if recipient:
+        conditions.append({"to_emails": recipient})
+    if subject_prefix:
+        # An anchored, case-sensitive regex can use the subject index as a range scan
+        conditions.append({"subject": {"$regex": f"^{re.escape(subject_prefix)}"}})
+    if sent_from or sent_to:
+        sent_range = {}
+        if sent_from:
+            sent_range["$gte"] = sent_from
+        if sent_to:
+            sent_range["$lt"] = sent_to
+        conditions.append({"sent_at": sent_range})
+    if cursor:
+        conditions.append(decode_history_cursor(cursor))
+
+    query = {"$and": conditions} if conditions else {}
+    records = await emails_history.find(query) \
+        .sort([("sent_at", DESCENDING), ("_id", DESCENDING)]) \
+        .limit(limit + 1) \
+        .to_list(length=limit + 1)  # one extra record tells whether another page exists
+
+    next_cursor = encode_history_cursor(records[limit - 1]) if len(records) > limit else None
+    return EmailHistoryPage(items=[EmailSentModel.from_mongo(record) for record in records[:limit]],
+                            next_cursor=next_cursor)
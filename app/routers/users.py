@@ -9,10 +9,12 @@ from app.components.auth.check_permissions import check_permissions
 from app.components.auth.jwt_token_handler import get_jwt_username
 from app.components.hash_password import hash_password
 from app.components.logger import logger
-from app.db.mongoClient import async_database
+from app.components.server_timing import TimedAPIRoute
+from app.db.mongoClient import async_database, secondary_reads
 
-router = APIRouter()  # router instance
+router = APIRouter(route_class=TimedAPIRoute)  # router instance
 user_collection = async_database.users  # Get the collection from the database
+user_listing = secondary_reads(user_collection)  # The full user list is read from a secondary
 
 
 async def user_exists(email: str = None, username: str = None) -> bool:
@@ -29,12 +31,12 @@ async def user_exists(email: str = None, username: str = None) -> bool:
 async def get_users(username: str = Depends(get_jwt_username)):
     try:
         users = []
-        async for user in user_collection.find({}):
+        async for user in user_listing.find({}):
             users.append(User.from_mongo(user))
-        logger.info(f"User list requested by {username} - Success")
+        logger.info("User list requested by %s - Success", username, extra={"event": "user_list", "count": len(users)})
         return users
     except Exception as e:
-        logger.error(f"User list requested by {username} - Failed: {str(e)}")
+        logger.error("User list requested by %s - Failed: %s", username, e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="An error occurred while fetching users."
@@ -46,13 +48,13 @@ async def get_profile(current_username: str = Depends(get_jwt_username)):
         # Find the current user based on the username obtained from the JWT token
         user = await user_collection.find_one({"username": current_username})
         if not user:
-            logger.warning(f"Profile not found for {current_username}")
+            logger.warning("Profile not found for %s", current_username)
             raise HTTPException(status_code=404, detail="Profile not found")
         user["_id"] = str(user["_id"])
-        logger.info(f"Profile fetched for user {current_username} successfully.")
+        logger.info("Profile fetched for user %s successfully.", current_username)
         return user
     except Exception as e:
-        logger.error(f"Error fetching profile for {current_username}: {str(e)}")
+        logger.error("Error fetching profile for %s: %s", current_username, e)
         raise HTTPException(status_code=500, detail="An error occurred while fetching the profile.")
 
 
@@ -61,13 +63,13 @@ async def get_user(id: str, username: str = Depends(get_jwt_username)):  # noqa
     try:
         user = await user_collection.find_one({"_id": ObjectId(id)})
         if not user:
-            logger.warning(f"User with ID {id} not found by {username}")
+            logger.warning("User with ID %s not found by %s", id, username)
             raise HTTPException(status_code=404, detail="User with ID {id} not found")
         user["_id"] = str(user["_id"])
-        logger.info(f"User {username} fetched user {id} successfully.")
+        logger.info("User %s fetched user %s successfully.", username, id)
         return user
     except Exception as e:
-        logger.error(f"Error fetching user by {username}: {str(e)}")
+        logger.error("Error fetching user by %s: %s", username, e)
         raise HTTPException(status_code=500, detail="An error occurred while fetching the user.")
 
 
@@ -92,7 +94,7 @@ async def create_user(user: UserCreate, username: str = Depends(get_jwt_username
         # Check if the email or username already exists
         if await user_exists(email=user.email, username=user.username):
             detail_msg = "The email or username is already in use."
-            logger.warning(f"Attempt to create a user with an existing email or username by {username}")
+            logger.warning("Attempt to create a user with an existing email or username by %s", username)
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail=detail_msg
@@ -110,10 +112,10 @@ async def create_user(user: UserCreate, username: str = Depends(get_jwt_username
         created_user['_id'] = str(created_user['_id'])
         del created_user["hashed_password"]
 
-        logger.info(f"User {username} created new user {user.username} successfully.")
+        logger.info("User %s created new user %s successfully.", username, user.username)
         return created_user
     except Exception as e:
-        logger.error(f"Error creating user by {username}: {str(e)}")
+        logger.error("Error creating user by %s: %s", username, e)
         raise HTTPException(status_code=500, detail="An error occurred while creating the user.")
 
 @router.put("/users/{id}", dependencies=[Depends(check_permissions)])
@@ -129,16 +131,16 @@ async def update_user(id: str, update_data: UpdateUser, username: str = Depends(
             return_document=True
         )
         if not updated_user:
-            logger.warning(f"User with ID {id} not found by {username}")
+            logger.warning("User with ID %s not found by %s", id, username)
             raise HTTPException(status_code=404, detail="User with ID {id} not found")
 
         updated_user['_id'] = str(updated_user['_id'])
         del updated_user["hashed_password"]
 
-        logger.info(f"User {username} updated user {id} successfully.")
+        logger.info("User %s updated user %s successfully.", username, id)
         return updated_user
     except Exception as e:
-        logger.error(f"Error updating user by {username}: {str(e)}")
+        logger.error("Error updating user by %s: %s", username, e)
         raise HTTPException(status_code=500, detail="An error occurred while updating the user.")
 
 
@@ -153,7 +155,7 @@ async def delete_user(id: str, username: str = Depends(get_jwt_username)):  # no
 
         # Check if user data is found
         if not user_data:
-            logger.warning(f"Attempt to delete non-existing user with ID {id} by {username}")
+            logger.warning("Attempt to delete non-existing user with ID %s by %s", id, username)
             raise HTTPException(status_code=404, detail=f"User with ID {id} not found")
 
         # Assuming user data includes a field for the user's role, such as 'role'
@@ -161,22 +163,22 @@ async def delete_user(id: str, username: str = Depends(get_jwt_username)):  # no
 
         # Check if the user is an owner (or has the permission to delete)
         if user_role == "owner":
-            logger.warning(f"Attempt to delete user with ID {id} who is an owner by {username}")
+            logger.warning("Attempt to delete user with ID %s who is an owner by %s", id, username)
             raise HTTPException(status_code=403, detail="Owners are not allowed to be deleted.")
 
         # Proceed with user deletion if the user is not an owner
         delete_result = await user_collection.delete_one({"_id": ObjectId(id)})
 
         if delete_result.deleted_count == 0:
-            logger.warning(f"Attempt to delete non-existing user with ID {id} by {username}")
+            logger.warning("Attempt to delete non-existing user with ID %s by %s", id, username)
             raise HTTPException(status_code=404, detail=f"User with ID {id} not found")
 
-        logger.info(f"User {username} deleted user {id} successfully.")
+        logger.info("User %s deleted user %s successfully.", username, id)
         return {"message": "User deleted successfully."}
 
     except HTTPException:
         raise  # Re-raise HTTPException to let FastAPI handle it
 
     except Exception as e:
-        logger.error(f"Error deleting user by {username}: {str(e)}")
+        logger.error("Error deleting user by %s: %s", username, e)
         raise HTTPException(status_code=500, detail="An error occurred while deleting the user.")
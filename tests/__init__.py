@@ -0,0 +1,18 @@
+import os
+
+# The app reads its settings from the environment (.env) at import time; these defaults let the
+# tests and benchmarks import it without one. Nothing is contacted at import time, the clients
+# connect lazily.
+for key, value in {
+    "mongodb_server": "localhost",
+    "mongodb_port": "27017",
+    "mongodb_username": "test",
+    "mongodb_password": "test",
+    "fastapi_ui_username": "test",
+    "fastapi_ui_password": "test",
+    "static_bearer_secret_key": "test",
+    "jwt_secret_key": "test",
+    "algorithm": "HS256",
+    "open_ai_secret_key": "test",
+}.items():
+    os.environ.setdefault(key, value)
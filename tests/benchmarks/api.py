@@ -0,0 +1,208 @@
+"""
+End-to-end benchmark of the key API flows, against local stand-ins for MongoDB and Redis.
+
+    python -m tests.benchmarks.api --requests 200 --concurrency 1,10,50 --output api.json
+    python -m tests.benchmarks.api --requests 200 --concurrency 1,10,50 --baseline api.json
+
+`app.main:app` is served by uvicorn on its own event loop and thread, with its startup and shutdown, the
+whole middleware stack and the real routes. MongoDB is an in-memory mongomock-motor client and Redis a
+fakeredis client (`pip install mongomock-motor fakeredis`), seeded with `--users` users. Nothing leaves the
+process, so runs on the same machine are comparable; the stand-ins are not as fast as the real servers,
+compare runs with each other, not with production.
+
+Flows, each run at every concurrency level:
+- token: `POST /token`, a bcrypt check and two Redis writes
+- profile: `GET /users/profile`
+- users: `GET /users/`, every seeded user
+- check_user_exists: `GET /check_user_exists`
+- register: `POST /register/`, a bcrypt hash and two MongoDB calls
+
+The JSON report has throughput and p50/p95/p99 latency per flow and concurrency. With `--baseline`, the run
+is compared with an earlier report and the exit code is 1 when a scenario regressed, see
+tests/benchmarks/stats.py (`python -m tests.benchmarks.stats baseline.json current.json` compares two reports).
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import platform
+import sys
+import uuid
+from datetime import datetime
+from typing import Dict, List
+
+import httpx
+import uvicorn
+
+from tests.benchmarks.chat import BackgroundLoop
+from tests.benchmarks.stats import (compare_reports, format_comparison, format_table, measure, read_report,
+                                    write_report)
+from tests.mocks.mongo import use_mongo_stand_in
+
+FLOWS = ("token", "profile", "users", "check_user_exists", "register")
+PASSWORD = "benchmark-password"
+PREFIX = "/api/v1"
+
+
+class AppServer:
+    """uvicorn serving `app.main:app` with its startup, against the stand-ins."""
+
+    def __init__(self, app, mongo_client, users: int):
+        self.app = app
+        self.mongo_client = mongo_client
+        self.users = users
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=0, log_level="warning",
+                                                    lifespan="on", access_log=False))
+        self._task = None
+
+    async def _seed(self):
+        from app.components.hash_password import hash_password
+
+        hashed_password = hash_password(PASSWORD)  # bcrypt is slow on purpose, one hash for everybody
+        await self.mongo_client.fastapi_db.users.insert_many([
+            {"username": f"bench{index}", "email": f"bench{index}@example.com", "full_name": f"Bench User {index}",
+             "hashed_password": hashed_password, "role": "user", "disabled": False}
+            for index in range(self.users)
+        ])
+
+    async def start(self) -> str:
+        import fakeredis.aioredis
+        from app.db.redisClient import AsyncRedisClient
+
+        # Created on the server loop, the startup takes it instead of connecting to a Redis server
+        AsyncRedisClient._instance = fakeredis.aioredis.FakeRedis(decode_responses=True)  # noqa
+        await self._seed()
+        self._task = asyncio.create_task(self.server.serve())
+        while not self.server.started:
+            if self._task.done():
+                self._task.result()  # the startup failed
+            await asyncio.sleep(0.01)
+        port = self.server.servers[0].sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        from app.db.redisClient import AsyncRedisClient
+
+        self.server.should_exit = True
+        await self._task
+        AsyncRedisClient._instance = AsyncRedisClient._pubsub_instance = None  # noqa
+
+
+class Flows:
+    """The requests of every flow; `sessions` users are logged in once for the authenticated flows."""
+
+    def __init__(self, client: httpx.AsyncClient, users: int, sessions: int):
+        self.client = client
+        self.user_count = users  # `users` is a flow
+        self.sessions = sessions
+        self.tokens: List[str] = []
+        self.run_id = uuid.uuid4().hex[:8]
+        self._registered = itertools.count()  # the same index comes again at every concurrency level
+        self.bearer = {"Authorization": f"Bearer {os.environ['static_bearer_secret_key']}"}
+
+    async def login(self, username: str) -> httpx.Response:
+        return await self.client.post(f"{PREFIX}/token", params={"username": username, "password": PASSWORD})
+
+    async def open_sessions(self):
+        for index in range(self.sessions):
+            response = await self.login(f"bench{index}")
+            response.raise_for_status()
+            self.tokens.append(response.json()["access_token"])
+
+    def _api_key(self, index: int) -> Dict[str, str]:
+        return {"api-key": self.tokens[index % len(self.tokens)]}
+
+    async def token(self, index: int) -> httpx.Response:
+        # Other users than the sessions, a new login invalidates the previous token of the user
+        return await self.login(f"bench{self.sessions + index % (self.user_count - self.sessions)}")
+
+    async def profile(self, index: int) -> httpx.Response:
+        return await self.client.get(f"{PREFIX}/users/profile", headers=self._api_key(index))
+
+    async def users(self, index: int) -> httpx.Response:
+        return await self.client.get(f"{PREFIX}/users/", headers=self._api_key(index))
+
+    async def check_user_exists(self, index: int) -> httpx.Response:
+        return await self.client.get(f"{PREFIX}/check_user_exists", headers=self._api_key(index),
+                                     params={"username": f"bench{index % self.user_count}"})
+
+    async def register(self, index: int) -> httpx.Response:
+        username = f"new{self.run_id}{next(self._registered)}"
+        return await self.client.post(f"{PREFIX}/register/", headers=self.bearer, json={
+            "username": username, "email": f"{username}@example.com", "full_name": "New User", "password": PASSWORD,
+        })
+
+
+async def _measure(flow: str, send, requests: int, concurrency: int) -> Dict:
+    async def request(index: int) -> bool:
+        return (await send(index)).status_code == 200
+
+    return await measure(f"{flow} c={concurrency}", request, requests, concurrency, errors=(httpx.HTTPError,),
+                         flow=flow, requests=requests)
+
+
+async def run_api_benchmark(requests: int, concurrencies: List[int], flows=FLOWS, users: int = 1000,
+                            sessions: int = 20, warmup: int = 5) -> List[Dict]:
+    from app.main import app
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)  # a line per request
+    users = max(users, sessions + 1)
+    server_loop = BackgroundLoop("api-server")
+    results = []
+    with use_mongo_stand_in() as mongo_client:
+        server = AppServer(app, mongo_client, users)
+        base_url = await server_loop.run(server.start())
+        try:
+            limits = httpx.Limits(max_connections=max(concurrencies), max_keepalive_connections=max(concurrencies))
+            async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=300) as client:
+                runner = Flows(client, users, sessions)
+                await runner.open_sessions()
+                for flow in flows:
+                    send = getattr(runner, flow)
+                    for index in range(warmup):
+                        await send(requests + index)
+                    for concurrency in concurrencies:
+                        results.append(await _measure(flow, send, requests, concurrency))
+        finally:
+            await server_loop.run(server.stop())
+            server_loop.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the key API flows")
+    parser.add_argument("--requests", type=int, default=200, help="requests per flow and concurrency level")
+    parser.add_argument("--concurrency", default="1,10,50", help="comma separated concurrency levels")
+    parser.add_argument("--flows", default=",".join(FLOWS), help=f"comma separated, out of {', '.join(FLOWS)}")
+    parser.add_argument("--users", type=int, default=1000, help="users in the database")
+    parser.add_argument("--sessions", type=int, default=20, help="logged in users of the authenticated flows")
+    parser.add_argument("--warmup", type=int, default=5, help="requests per flow before measuring")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="compare with this earlier report, exit code 1 on a regression")
+    parser.add_argument("--threshold", type=float, default=10.0, help="allowed change in percent")
+    args = parser.parse_args()
+
+    flows = [flow for flow in args.flows.split(",") if flow]
+    unknown = set(flows) - set(FLOWS)
+    if unknown:
+        parser.error(f"unknown flows: {', '.join(sorted(unknown))}")
+    concurrencies = [int(value) for value in args.concurrency.split(",")]
+    results = asyncio.run(run_api_benchmark(args.requests, concurrencies, flows, args.users, args.sessions,
+                                            args.warmup))
+
+    print(format_table(results))
+    if args.output:
+        write_report(results, args.output, meta={
+            "benchmark": "api", "date": datetime.utcnow().isoformat(timespec="seconds"),
+            "python": platform.python_version(), "platform": platform.platform(), "users": args.users,
+            "sessions": args.sessions, "stand_ins": {"mongodb": "mongomock-motor", "redis": "fakeredis"},
+        })
+    if args.baseline:
+        rows = compare_reports(read_report(args.baseline), results, args.threshold)
+        print(format_comparison(rows))
+        sys.exit(1 if any(row["regression"] for row in rows) else 0)
+
+
+if __name__ == "__main__":
+    main()
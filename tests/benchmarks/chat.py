@@ -0,0 +1,194 @@
+"""
+Throughput of `/chat/` and responsiveness of the event loop while many long completions are running.
+
+    python -m tests.benchmarks.chat --requests 200 --concurrency 10,50,200 --tokens 50 --token-delay-ms 20 --output chat.json
+
+The chat router is served by uvicorn on its own event loop and thread, against the mock API of
+tests/mocks/openai.py running on another one, so the numbers of the server loop aren't mixed up with
+the load generator. Every scenario reports requests per second and latency percentiles, the time to
+the first token for streamed requests, and the event loop lag of the server: how late a timer firing
+every 10ms runs while the requests are in flight. A lag of more than a few milliseconds means something
+blocks the loop.
+"""
+import argparse
+import asyncio
+import threading
+import time
+from typing import Dict, List
+
+import httpx
+import uvicorn
+from fastapi import FastAPI
+
+from tests.benchmarks.stats import format_table, measure, percentile, write_report
+from tests.mocks.openai import MockOpenAIServer
+
+LAG_INTERVAL = 0.01  # seconds between two lag samples
+
+
+class BackgroundLoop:
+    """An event loop running in its own thread."""
+
+    def __init__(self, name: str):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name=name, daemon=True)
+        self.thread.start()
+
+    async def run(self, coro):
+        """Run a coroutine on this loop and wait for it from another loop."""
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.loop))
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+class LoopLagMonitor:
+    """Measures how late a periodic timer fires on the loop it runs on."""
+
+    def __init__(self, interval: float = LAG_INTERVAL):
+        self.interval = interval
+        self.lags: List[float] = []
+        self._task = None
+
+    async def _sample(self):
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.perf_counter() - expected))
+
+    async def start(self):
+        self.lags.clear()
+        self._task = asyncio.create_task(self._sample())
+
+    async def stop(self) -> Dict:
+        self._task.cancel()
+        return {
+            "p50": round(percentile(self.lags, 50) * 1000, 3),
+            "p99": round(percentile(self.lags, 99) * 1000, 3),
+            "max": round(max(self.lags, default=0) * 1000, 3),
+            "samples": len(self.lags),
+        }
+
+
+def create_chat_app(upstream_url: str) -> FastAPI:
+    """The chat router with authentication switched off, answering every request from the upstream."""
+    from app.components.auth.check_permissions import check_permissions
+    from app.components.auth.jwt_token_handler import get_jwt_username
+    from app.components.chat_gpt.chatgpt_service import ChatGptService, create_http_client
+    from app.components.chat_gpt.resilience import UpstreamGuard
+    from app.routers import chatgpt
+
+    app = FastAPI()
+    app.include_router(chatgpt.router, prefix="/api/v1")
+    app.dependency_overrides[check_permissions] = lambda: None
+    app.dependency_overrides[get_jwt_username] = lambda: "benchmark"
+    # No response cache and no coalescing, so every request is a completion
+    app.state.chatgpt = ChatGptService(create_http_client(upstream_url), guard=UpstreamGuard(max_retries=0))
+    app.state.chat_limiter = None
+    return app
+
+
+class ChatServer:
+    """uvicorn serving the chat app, with a lag monitor on the same loop."""
+
+    def __init__(self, app: FastAPI):
+        self.app = app
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=0, log_level="warning",
+                                                    lifespan="off", access_log=False))
+        self.monitor = LoopLagMonitor()
+        self._task = None
+
+    async def start(self) -> str:
+        self._task = asyncio.create_task(self.server.serve())
+        while not self.server.started:
+            await asyncio.sleep(0.01)
+        port = self.server.servers[0].sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        self.server.should_exit = True
+        await self._task
+        await self.app.state.chatgpt.http_client.aclose()
+
+
+async def _measure(client: httpx.AsyncClient, requests: int, concurrency: int, stream: bool) -> Dict:
+    first_tokens: List[float] = []
+
+    async def request(index: int) -> bool:
+        params = {"question": f"Benchmark question {index}", "model": "gpt-3.5-turbo", "stream": stream}
+        started = time.perf_counter()
+        first_chunk = None
+        async with client.stream("GET", "/api/v1/chat/", params=params) as response:
+            if response.status_code != 200:
+                return False
+            async for _ in response.aiter_bytes():
+                if first_chunk is None:
+                    first_chunk = time.perf_counter() - started
+        first_tokens.append(first_chunk or time.perf_counter() - started)
+        return True
+
+    result = await measure(f"/chat/ {'stream' if stream else 'json'} c={concurrency}", request, requests,
+                           concurrency, errors=(httpx.HTTPError,), requests=requests, stream=stream)
+    if stream:
+        result["first_token_ms"] = {"p50": round(percentile(first_tokens, 50) * 1000, 3),
+                                    "p95": round(percentile(first_tokens, 95) * 1000, 3)}
+    return result
+
+
+async def run_chat_benchmark(requests: int, concurrencies: List[int], latency: float = 0.1, tokens: int = 20,
+                             token_delay: float = 0.01, modes=(False, True)) -> List[Dict]:
+    upstream_loop, server_loop = BackgroundLoop("mock-openai"), BackgroundLoop("chat-server")
+    mock = MockOpenAIServer(latency=latency, tokens=tokens, token_delay=token_delay)
+    upstream_url = await upstream_loop.run(mock.start())
+    server = ChatServer(create_chat_app(upstream_url))
+    base_url = await server_loop.run(server.start())
+
+    results = []
+    try:
+        limits = httpx.Limits(max_connections=max(concurrencies), max_keepalive_connections=max(concurrencies))
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=300) as client:
+            for stream in modes:
+                for concurrency in concurrencies:
+                    await server_loop.run(server.monitor.start())
+                    result = await _measure(client, requests, concurrency, stream)
+                    result["loop_lag_ms"] = await server_loop.run(server.monitor.stop())
+                    result["upstream_max_concurrency"] = mock.max_concurrency
+                    mock.max_concurrency = 0
+                    results.append(result)
+    finally:
+        await server_loop.run(server.stop())
+        await upstream_loop.run(mock.stop())
+        server_loop.close()
+        upstream_loop.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat route load test against a mock OpenAI API")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", default="10,50,200", help="comma separated concurrency levels")
+    parser.add_argument("--latency-ms", type=float, default=100, help="upstream delay before the first token")
+    parser.add_argument("--tokens", type=int, default=20, help="tokens per answer")
+    parser.add_argument("--token-delay-ms", type=float, default=10, help="upstream delay between tokens")
+    parser.add_argument("--mode", choices=["json", "stream", "both"], default="both")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    modes = {"json": (False,), "stream": (True,), "both": (False, True)}[args.mode]
+    results = asyncio.run(run_chat_benchmark(
+        args.requests, [int(value) for value in args.concurrency.split(",")],
+        latency=args.latency_ms / 1000, tokens=args.tokens, token_delay=args.token_delay_ms / 1000, modes=modes,
+    ))
+
+    print(format_table(results))
+    for result in results:
+        lag = result["loop_lag_ms"]
+        print(f"{result['name']:<40} loop lag p50 {lag['p50']:.2f}ms p99 {lag['p99']:.2f}ms max {lag['max']:.2f}ms")
+    if args.output:
+        write_report(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Cost of a log call on the request path, for the ways the app can write its log file.
+
+    python -m tests.benchmarks.logs --records 20000 --output logs.json
+
+- direct: `DailyRotatingFileHandler` attached to the logger, every call formats and writes the file.
+- stdlib-queue: `QueueHandler` and `QueueListener`, every call still formats the record before queueing it.
+- deferred-queue: the app's `DeferredQueueHandler` and `BatchingQueueListener`, the call only queues the record.
+
+Like in the app, every record also goes to a console handler (writing to os.devnull here).
+
+Every scenario reports log calls per second and the latency of a single call, plus the time the
+background writer needed to get every record into the file.
+"""
+import argparse
+import logging
+import os
+import queue
+import tempfile
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, List
+
+from app.components.logger import BatchingQueueListener, DailyRotatingFileHandler, DeferredQueueHandler
+from tests.benchmarks.stats import format_table, percentile, summarize, write_report
+
+FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+
+def _file_handler(directory: str, buffered: bool) -> DailyRotatingFileHandler:
+    handler = DailyRotatingFileHandler(directory, "benchmark", encoding="utf-8", buffered=buffered)
+    handler.setFormatter(logging.Formatter(FORMAT))
+    return handler
+
+
+def _handlers(directory: str, buffered: bool) -> List[logging.Handler]:
+    console = logging.StreamHandler(open(os.devnull, "w"))
+    console.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    return [console, _file_handler(directory, buffered)]
+
+
+def _close(handlers: List[logging.Handler]):
+    for handler in handlers:
+        handler.close()
+    handlers[0].stream.close()
+
+
+def _measure(name: str, log: logging.Logger, records: int, drain) -> Dict:
+    latencies: List[float] = []
+    started = time.perf_counter()
+    for index in range(records):
+        call_started = time.perf_counter()
+        log.info("Permission granted: %s accessed %s with method %s", f"user{index}", "/api/v1/chat/", "GET")
+        latencies.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+    drain_started = time.perf_counter()
+    drain()
+    result = summarize(name, latencies, elapsed, records=records)
+    result["drain_s"] = round(time.perf_counter() - drain_started, 4)
+    # A log call takes microseconds, finer than the millisecond figures of the summary
+    result["latency_us"] = {"mean": round(sum(latencies) / len(latencies) * 1e6, 2),
+                            "p50": round(percentile(latencies, 50) * 1e6, 2),
+                            "p99": round(percentile(latencies, 99) * 1e6, 2)}
+    return result
+
+
+def _logger(name: str, *handlers: logging.Handler) -> logging.Logger:
+    log = logging.getLogger(f"benchmark.logs.{name}")
+    log.handlers = list(handlers)
+    log.setLevel(logging.INFO)
+    log.propagate = False
+    return log
+
+
+def bench_direct(directory: str, records: int) -> Dict:
+    handlers = _handlers(directory, buffered=False)
+    try:
+        return _measure("direct", _logger("direct", *handlers), records, lambda: None)
+    finally:
+        _close(handlers)
+
+
+def bench_stdlib_queue(directory: str, records: int) -> Dict:
+    handlers = _handlers(directory, buffered=False)
+    log_queue = queue.Queue()
+    listener = QueueListener(log_queue, *handlers)
+    listener.start()
+    try:
+        return _measure("stdlib-queue", _logger("stdlib", QueueHandler(log_queue)), records, listener.stop)
+    finally:
+        _close(handlers)
+
+
+def bench_deferred_queue(directory: str, records: int) -> Dict:
+    handlers = _handlers(directory, buffered=True)
+    log_queue = queue.SimpleQueue()
+    listener = BatchingQueueListener(log_queue, *handlers)
+    listener.start()
+    try:
+        return _measure("deferred-queue", _logger("deferred", DeferredQueueHandler(log_queue)), records,
+                        listener.stop)
+    finally:
+        _close(handlers)
+
+
+def run_logs_benchmark(records: int) -> List[Dict]:
+    results = []
+    for bench in (bench_direct, bench_stdlib_queue, bench_deferred_queue):
+        with tempfile.TemporaryDirectory() as directory:
+            results.append(bench(directory, records))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Log call cost of the app's log handlers")
+    parser.add_argument("--records", type=int, default=20000, help="log calls per scenario")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = run_logs_benchmark(args.records)
+    print(format_table(results))
+    for result in results:
+        latency = result["latency_us"]
+        print(f"{result['name']:<40} per call mean {latency['mean']:.2f}us p99 {latency['p99']:.2f}us, "
+              f"writer drained in {result['drain_s']:.3f}s")
+    if args.output:
+        write_report(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
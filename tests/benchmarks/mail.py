@@ -0,0 +1,90 @@
+"""
+Throughput and latency of `send_email_and_save` against a local SMTP server.
+
+    python -m tests.benchmarks.mail --messages 500 --concurrency 1,10,50 --attachment-kb 0,256 --output mail.json
+
+Every scenario reports messages per second and latency percentiles. The pooled `SmtpChannel` of the
+message dispatcher is measured the same way, so both email paths can be compared between changes.
+"""
+import argparse
+import asyncio
+import io
+import os
+from typing import Dict, List
+
+from fastapi import UploadFile
+
+from tests.benchmarks.stats import format_table, measure, write_report
+from tests.mocks.smtp import LocalSmtpServer, use_local_smtp
+
+
+async def bench_send_email_and_save(messages: int, concurrency: int, attachment_kb: int) -> Dict:
+    from app.components.message_dispatcher.mail import send_email_and_save
+
+    attachment = os.urandom(attachment_kb * 1024)
+
+    async def send(index: int):
+        files = [UploadFile(file=io.BytesIO(attachment), filename="attachment.bin")] if attachment_kb else []
+        await send_email_and_save(f"Benchmark {index}", "Benchmark body", [f"user{index}@example.com"], files)
+
+    name = f"send_email_and_save c={concurrency} att={attachment_kb}KB"
+    return await measure(name, send, messages, concurrency, messages=messages, attachment_kb=attachment_kb)
+
+
+async def bench_smtp_channel(config: dict, messages: int, concurrency: int) -> Dict:
+    from app.classes.Messages import ChannelEnum, OutgoingMessage
+    from app.components.message_dispatcher.mail import SmtpChannel
+
+    class LocalSmtpChannel(SmtpChannel):
+        async def get_config(self) -> dict:
+            return config
+
+    channel = LocalSmtpChannel(rate_limit=0)
+    await channel.start()
+
+    async def send(index: int):
+        result = await channel.send(OutgoingMessage(channel=ChannelEnum.email, to=[f"user{index}@example.com"],
+                                                    subject=f"Benchmark {index}", body="Benchmark body"))
+        if not result.success:
+            raise RuntimeError(result.error)
+
+    try:
+        return await measure(f"SmtpChannel c={concurrency}", send, messages, concurrency, messages=messages)
+    finally:
+        await channel.stop()
+
+
+async def run_mail_benchmark(server: LocalSmtpServer, messages: int, concurrencies: List[int],
+                             attachment_sizes: List[int]) -> List[Dict]:
+    results = []
+    with use_local_smtp(server):
+        for attachment_kb in attachment_sizes:
+            for concurrency in concurrencies:
+                results.append(await bench_send_email_and_save(messages, concurrency, attachment_kb))
+        for concurrency in concurrencies:
+            results.append(await bench_smtp_channel(server.smtp_config(), messages, concurrency))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mail dispatcher benchmark against a local SMTP server")
+    parser.add_argument("--messages", type=int, default=200, help="messages per scenario")
+    parser.add_argument("--concurrency", default="1,10,50", help="comma separated concurrency levels")
+    parser.add_argument("--attachment-kb", default="0,256", help="comma separated attachment sizes in KB")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    with LocalSmtpServer() as server:
+        results = asyncio.run(run_mail_benchmark(
+            server, args.messages,
+            [int(value) for value in args.concurrency.split(",")],
+            [int(value) for value in args.attachment_kb.split(",")],
+        ))
+
+    print(format_table(results))
+    if args.output:
+        write_report(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
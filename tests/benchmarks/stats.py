@@ -0,0 +1,158 @@
+"""
+Helpers shared by the benchmarks, and the comparison of two of their JSON reports:
+
+    python -m tests.benchmarks.stats baseline.json current.json --threshold 10
+
+Scenarios are matched by name. A scenario regressed when its throughput dropped, or its p95 latency grew,
+by more than the threshold (in percent), or when it has more errors. The exit code is 1 when any did.
+"""
+import argparse
+import asyncio
+import json
+import math
+import sys
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Type
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Percentile with linear interpolation between the closest ranks."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(name: str, latencies: List[float], elapsed: float, errors: int = 0, **params) -> Dict:
+    """
+    Machine-readable result of one benchmark scenario.
+    :param latencies: Latency of every successful operation, in seconds.
+    :param elapsed: Wall time of the whole scenario, in seconds.
+    """
+    return {
+        "name": name,
+        "params": params,
+        "count": len(latencies),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 4),
+        "throughput_per_s": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p95": round(percentile(latencies, 95) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+            "max": round(max(latencies, default=0) * 1000, 3),
+        },
+    }
+
+
+async def measure(name: str, operation: Callable[[int], Awaitable], count: int, concurrency: int,
+                  errors: Tuple[Type[BaseException], ...] = (Exception,), **params) -> Dict:
+    """
+    Run `operation(index)` `count` times, at most `concurrency` at a time, and summarize their latencies.
+    An operation failed when it raises one of `errors` or returns False; failures are counted, not timed.
+    :param params: Parameters of the scenario for its report, `concurrency` is added.
+    """
+    latencies: List[float] = []
+    failed = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(index: int):
+        nonlocal failed
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                succeeded = await operation(index)
+            except errors:
+                succeeded = False
+            if succeeded is False:
+                failed += 1
+                return
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(index) for index in range(count)))
+    return summarize(name, latencies, time.perf_counter() - started, failed, concurrency=concurrency, **params)
+
+
+def format_table(results: List[Dict]) -> str:
+    lines = [f"{'scenario':<40} {'ops/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}"]
+    for result in results:
+        latency = result["latency_ms"]
+        lines.append(f"{result['name']:<40} {result['throughput_per_s']:>10.1f} {latency['p50']:>9.2f} "
+                     f"{latency['p95']:>9.2f} {latency['p99']:>9.2f} {result['errors']:>7}")
+    return "\n".join(lines)
+
+
+def write_report(results: List[Dict], path: str, meta: Optional[Dict] = None):
+    with open(path, "w") as file:
+        json.dump({"meta": meta or {}, "results": results}, file, indent=2)
+
+
+def read_report(path: str) -> List[Dict]:
+    with open(path) as file:
+        return json.load(file)["results"]
+
+
+def _change(baseline: float, current: float) -> float:
+    """Change from baseline to current, in percent."""
+    if not baseline:
+        return 0.0
+    return round((current - baseline) / baseline * 100, 1)
+
+
+def compare_reports(baseline: List[Dict], current: List[Dict], threshold: float = 10.0) -> List[Dict]:
+    """
+    Compare the scenarios of two reports by name.
+    :param threshold: Allowed throughput drop and p95 latency growth, in percent.
+    :return: One row per scenario of the current report, with the changes and whether it regressed.
+    """
+    previous = {result["name"]: result for result in baseline}
+    rows = []
+    for result in current:
+        before = previous.get(result["name"])
+        if before is None:
+            rows.append({"name": result["name"], "new": True, "regression": False})
+            continue
+        row = {
+            "name": result["name"],
+            "throughput_change_pct": _change(before["throughput_per_s"], result["throughput_per_s"]),
+            "p50_change_pct": _change(before["latency_ms"]["p50"], result["latency_ms"]["p50"]),
+            "p95_change_pct": _change(before["latency_ms"]["p95"], result["latency_ms"]["p95"]),
+            "p99_change_pct": _change(before["latency_ms"]["p99"], result["latency_ms"]["p99"]),
+            "errors_change": result["errors"] - before["errors"],
+        }
+        row["regression"] = (row["throughput_change_pct"] < -threshold or row["p95_change_pct"] > threshold
+                             or row["errors_change"] > 0)
+        rows.append(row)
+    return rows
+
+
+def format_comparison(rows: List[Dict]) -> str:
+    lines = [f"{'scenario':<40} {'ops/s':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'errors':>7}"]
+    for row in rows:
+        if row.get("new"):
+            lines.append(f"{row['name']:<40} {'new':>9}")
+            continue
+        lines.append(f"{row['name']:<40} {row['throughput_change_pct']:>+8.1f}% {row['p50_change_pct']:>+8.1f}% "
+                     f"{row['p95_change_pct']:>+8.1f}% {row['p99_change_pct']:>+8.1f}% {row['errors_change']:>+7d}"
+                     f"{'  REGRESSION' if row['regression'] else ''}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark reports")
+    parser.add_argument("baseline", help="report of the reference run")
+    parser.add_argument("current", help="report of the run to check")
+    parser.add_argument("--threshold", type=float, default=10.0, help="allowed change in percent")
+    args = parser.parse_args()
+
+    rows = compare_reports(read_report(args.baseline), read_report(args.current), args.threshold)
+    print(format_comparison(rows))
+    sys.exit(1 if any(row["regression"] for row in rows) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+# Logs of the test run go to a temporary directory instead of ./logs, set before the app logger is imported
+os.environ.setdefault("log_dir", tempfile.mkdtemp(prefix="fastapi-test-logs-"))
+atexit.register(shutil.rmtree, os.environ["log_dir"], True)  # registered first, so it runs after the log writer stops
+
+import pytest  # noqa: E402
+
+from tests.mocks.smtp import LocalSmtpServer, use_local_smtp  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def smtp_server():
+    """A local SMTP server shared by the tests, see tests/mocks/smtp.py."""
+    with LocalSmtpServer() as server:
+        yield server
+
+
+@pytest.fixture
+def local_smtp(smtp_server):
+    """Sends the mail module's emails to the local server; yields the in-memory email history."""
+    smtp_server.clear()
+    with use_local_smtp(smtp_server) as history:
+        yield history
@@ -0,0 +1,64 @@
+import sys
+from contextlib import contextmanager
+
+
+class RecordingCollection:
+    """Minimal stand-in for a Motor collection that only needs to accept inserts."""
+
+    def __init__(self):
+        self.documents = []
+
+    async def insert_one(self, document: dict):
+        self.documents.append(document)
+
+    async def insert_many(self, documents: list, ordered: bool = True):  # noqa
+        self.documents.extend(documents)
+
+        class Result:
+            inserted_ids = list(range(len(documents)))
+
+        return Result()
+
+
+def _stand_in(value, client):
+    """The stand-in of a Motor client, database or collection, None for anything else."""
+    from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection, AsyncIOMotorDatabase
+
+    if isinstance(value, AsyncIOMotorClient):
+        return client
+    if isinstance(value, AsyncIOMotorDatabase):
+        return client[value.name]
+    if isinstance(value, AsyncIOMotorCollection):
+        return client[value.database.name][value.name]
+    return None
+
+
+@contextmanager
+def use_mongo_stand_in(client=None):
+    """
+    Point the Motor clients, databases and collections held by the app modules (and by the objects defined
+    in them, like the email history buffer) to an in-memory mongomock-motor client, and back afterwards.
+    Works whatever was imported before, the app modules bind their collections at import time.
+    Needs `pip install mongomock-motor`.
+    """
+    from mongomock_motor import AsyncMongoMockClient
+
+    client = client or AsyncMongoMockClient()
+    replaced = []
+    for module in list(sys.modules.values()):
+        if not getattr(module, "__name__", "").startswith("app."):
+            continue
+        for name, value in list(vars(module).items()):
+            targets = [(module, name, value)]
+            if type(value).__module__.startswith("app."):  # module-level objects holding a collection
+                targets += [(value, attribute, item) for attribute, item in list(vars(value).items())]
+            for owner, attribute, item in targets:
+                stand_in = _stand_in(item, client)
+                if stand_in is not None:
+                    replaced.append((owner, attribute, item))
+                    setattr(owner, attribute, stand_in)
+    try:
+        yield client
+    finally:
+        for owner, attribute, item in reversed(replaced):
+            setattr(owner, attribute, item)
@@ -0,0 +1,141 @@
+"""
+Local stand-in for the OpenAI chat completions API used by the chat routes.
+
+Run it on its own and point `open_ai_base_url` to it to chat offline:
+
+    python -m tests.mocks.openai --port 8098 --latency-ms 200 --tokens 50 --token-delay-ms 20 --rate-limit 100
+
+Answers are `--tokens` words long. Plain requests are answered after the full generation time, streamed
+requests (`"stream": true`) get one SSE chunk per token, every `--token-delay-ms`.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+from aiohttp import web
+
+
+class MockOpenAIServer:
+    def __init__(self, latency: float = 0.0, tokens: int = 20, token_delay: float = 0.0, error_rate: float = 0.0,
+                 rate_limit: float = 0.0):
+        self.latency = latency  # seconds before the first token
+        self.tokens = tokens  # tokens of every answer
+        self.token_delay = token_delay  # seconds between two tokens
+        self.error_rate = error_rate  # share of requests answered with a 500
+        self.rate_limit = rate_limit  # requests per second before answering 429, 0 is unlimited
+        self.requests = []  # received request bodies
+        self.max_concurrency = 0  # highest number of requests handled at the same time
+        self.rate_limited = 0  # requests answered with 429
+        self._in_flight = 0
+        self._allowance = rate_limit
+        self._last_check = time.monotonic()
+        self._runner = None
+        self.port = None
+
+    def _over_rate_limit(self) -> bool:
+        if not self.rate_limit:
+            return False
+        now = time.monotonic()
+        self._allowance = min(self.rate_limit, self._allowance + (now - self._last_check) * self.rate_limit)
+        self._last_check = now
+        if self._allowance < 1:
+            return True
+        self._allowance -= 1
+        return False
+
+    def usage(self, body: dict) -> dict:
+        prompt = sum(len(message.get("content", "").split()) for message in body.get("messages", []))
+        return {"prompt_tokens": prompt, "completion_tokens": self.tokens, "total_tokens": prompt + self.tokens}
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        if request.headers.get("Authorization") is None:
+            return web.json_response({"error": {"message": "Authentication required"}}, status=401)
+        if self._over_rate_limit():
+            self.rate_limited += 1
+            return web.json_response({"error": {"message": "Rate limit reached"}}, status=429,
+                                     headers={"Retry-After": "1"})
+
+        body = await request.json()
+        self.requests.append(body)
+        self._in_flight += 1
+        self.max_concurrency = max(self.max_concurrency, self._in_flight)
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if self.error_rate and random.random() < self.error_rate:
+                return web.json_response({"error": {"message": "Internal error"}}, status=500)
+            words = [f"word{index} " for index in range(self.tokens)]
+            if body.get("stream"):
+                return await self._stream(request, body, words)
+
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay * self.tokens)
+            return web.json_response({
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(words)},
+                             "finish_reason": "stop"}],
+                "usage": self.usage(body),
+            })
+        finally:
+            self._in_flight -= 1
+
+    async def _stream(self, request: web.Request, body: dict, words) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+        for word in words:
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay)
+            chunk = {"id": chunk_id, "object": "chat.completion.chunk", "model": body.get("model"),
+                     "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        if body.get("stream_options", {}).get("include_usage"):
+            chunk = {"id": chunk_id, "object": "chat.completion.chunk", "choices": [], "usage": self.usage(body)}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    def app(self) -> web.Application:
+        application = web.Application()
+        application.router.add_post("/v1/chat/completions", self.chat_completions)
+        return application
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]  # noqa
+        return f"http://{host}:{self.port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI chat completions API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8098)
+    parser.add_argument("--latency-ms", type=float, default=0, help="delay before the first token")
+    parser.add_argument("--tokens", type=int, default=20, help="tokens per answer")
+    parser.add_argument("--token-delay-ms", type=float, default=0, help="delay between tokens")
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--rate-limit", type=float, default=0, help="requests per second, 0 is unlimited")
+    args = parser.parse_args()
+
+    server = MockOpenAIServer(latency=args.latency_ms / 1000, tokens=args.tokens,
+                              token_delay=args.token_delay_ms / 1000, error_rate=args.error_rate,
+                              rate_limit=args.rate_limit)
+    web.run_app(server.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
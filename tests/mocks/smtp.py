@@ -0,0 +1,108 @@
+"""
+Local SMTP stand-in based on aiosmtpd, accepting every message without TLS or authentication.
+
+It runs in a thread with its own event loop, so the server does not compete with the client under test:
+
+    with LocalSmtpServer() as server:
+        config = server.smtp_config()  # settings for send_email_and_save / SmtpChannel
+"""
+import socket
+import threading
+from contextlib import contextmanager
+from typing import List
+
+from aiosmtpd.controller import Controller
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class RecordingHandler:
+    """aiosmtpd handler keeping the envelopes of the received messages and the clients they came from."""
+
+    def __init__(self):
+        self.envelopes = []
+        self.peers = set()  # (host, port) of the connections messages were sent over
+        self._lock = threading.Lock()
+
+    async def handle_DATA(self, server, session, envelope):  # noqa
+        with self._lock:
+            self.envelopes.append(envelope)
+            self.peers.add(session.peer)
+        return "250 Message accepted for delivery"
+
+
+class LocalSmtpServer:
+    def __init__(self, hostname: str = "127.0.0.1", port: int = None):
+        self.handler = RecordingHandler()
+        self.hostname = hostname
+        self.port = port or free_port()
+        self.controller = Controller(self.handler, hostname=self.hostname, port=self.port,
+                                     data_size_limit=50 * 1024 * 1024)
+
+    @property
+    def envelopes(self) -> List:
+        return self.handler.envelopes
+
+    @property
+    def connections(self) -> int:
+        """Number of client connections messages were received on."""
+        return len(self.handler.peers)
+
+    def clear(self):
+        with self.handler._lock:  # noqa
+            self.handler.envelopes.clear()
+            self.handler.peers.clear()
+
+    def smtp_config(self, **overrides) -> dict:
+        """Settings in the shape of the `smtp` entry of the settings document."""
+        return {
+            "active": True,
+            "server": self.hostname,
+            "port": self.port,
+            "user": "",
+            "password": "",
+            "system_email": "system@example.com",
+            "security": "none",
+            **overrides,
+        }
+
+    def start(self):
+        self.controller.start()
+        return self
+
+    def stop(self):
+        self.controller.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+@contextmanager
+def use_local_smtp(server: LocalSmtpServer, **config_overrides):
+    """
+    Point the mail module to the local server and keep the email history in memory.
+    Yields the in-memory history collection.
+    """
+    from app.components.message_dispatcher import mail
+    from app.components.message_dispatcher.email_history import EmailHistoryBuffer
+    from tests.mocks.mongo import RecordingCollection
+
+    config = server.smtp_config(**config_overrides)
+    history = RecordingCollection()
+
+    async def get_config_data(config_key: str):
+        return config if config_key == "smtp" else None
+
+    original = mail.get_config_data, mail.email_history
+    mail.get_config_data, mail.email_history = get_config_data, EmailHistoryBuffer(history)
+    try:
+        yield history
+    finally:
+        mail.get_config_data, mail.email_history = original
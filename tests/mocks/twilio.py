@@ -0,0 +1,76 @@
+"""
+Local stand-in for the Twilio Messages API used by the WhatsApp and SMS channels.
+
+Run it on its own and point `twilio_api_base_url` (or `whatsapp_api_base_url` / `sms_api_base_url`)
+to it to send messages offline:
+
+    python -m tests.mocks.twilio --port 8099 --latency-ms 50 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import random
+import uuid
+
+from aiohttp import web
+
+
+class MockTwilioServer:
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency  # seconds added to every response
+        self.error_rate = error_rate  # share of requests answered with a 500
+        self.messages = []  # received messages as (account_sid, form data)
+        self.max_concurrency = 0  # highest number of requests handled at the same time
+        self._in_flight = 0
+        self._runner = None
+        self.port = None
+
+    async def create_message(self, request: web.Request) -> web.Response:
+        self._in_flight += 1
+        self.max_concurrency = max(self.max_concurrency, self._in_flight)
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if request.headers.get("Authorization") is None:
+                return web.json_response({"message": "Authentication required"}, status=401)
+            if self.error_rate and random.random() < self.error_rate:
+                return web.json_response({"message": "Internal error"}, status=500)
+
+            data = dict(await request.post())
+            self.messages.append((request.match_info["account_sid"], data))
+            return web.json_response({"sid": f"SM{uuid.uuid4().hex}", "status": "queued", **data}, status=201)
+        finally:
+            self._in_flight -= 1
+
+    def app(self) -> web.Application:
+        application = web.Application()
+        application.router.add_post("/2010-04-01/Accounts/{account_sid}/Messages.json", self.create_message)
+        return application
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]  # noqa
+        return f"http://{host}:{self.port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Twilio Messages API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    args = parser.parse_args()
+
+    server = MockTwilioServer(latency=args.latency_ms / 1000, error_rate=args.error_rate)
+    web.run_app(server.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
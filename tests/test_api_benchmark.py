@@ -0,0 +1,29 @@
+import asyncio
+
+import pytest
+
+from tests.benchmarks.api import FLOWS, run_api_benchmark
+from tests.benchmarks.stats import compare_reports, summarize
+
+
+def test_api_benchmark():
+    pytest.importorskip("mongomock_motor")
+    pytest.importorskip("fakeredis")
+    results = asyncio.run(run_api_benchmark(requests=4, concurrencies=[2], users=30, sessions=3, warmup=1))
+
+    assert [result["params"]["flow"] for result in results] == list(FLOWS)
+    for result in results:
+        assert result["errors"] == 0, result["name"]
+        assert result["count"] == 4
+
+
+def test_reports_are_compared_by_scenario():
+    baseline = [summarize("profile c=10", [0.01] * 10, 0.1), summarize("users c=10", [0.02] * 10, 0.2)]
+    current = [summarize("profile c=10", [0.0105] * 10, 0.105), summarize("users c=10", [0.03] * 10, 0.3),
+               summarize("token c=10", [0.3] * 10, 3)]
+
+    rows = {row["name"]: row for row in compare_reports(baseline, current, threshold=10)}
+
+    assert not rows["profile c=10"]["regression"] and rows["profile c=10"]["p95_change_pct"] == 5.0
+    assert rows["users c=10"]["regression"] and rows["users c=10"]["throughput_change_pct"] < -10
+    assert rows["token c=10"]["new"] and not rows["token c=10"]["regression"]
@@ -0,0 +1,115 @@
+import asyncio
+import json
+from contextlib import aclosing
+
+import httpx
+import pytest
+
+from app.classes.Chatgpt import CachePolicy
+from app.components.chat_gpt import resilience
+from app.components.chat_gpt.batch import run_batch
+from app.components.chat_gpt.chatgpt_service import ChatGptService
+from app.components.chat_gpt.resilience import UpstreamGuard
+from app.components.chat_gpt.response_cache import ChatResponseCache
+
+fakeredis = pytest.importorskip("fakeredis.aioredis")
+
+
+class BatchUpstream:
+    """
+    Answers every question after `delay` seconds; "bad" questions are rejected, "flaky" ones fail once and
+    "down" ones always fail.
+    """
+
+    def __init__(self, delay: float = 0.02):
+        self.delay = delay
+        self.calls = []
+        self.in_flight = 0
+        self.max_concurrency = 0
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        question = json.loads(request.content)["messages"][-1]["content"]
+        self.calls.append(question)
+        self.in_flight += 1
+        self.max_concurrency = max(self.max_concurrency, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.in_flight -= 1
+        if question.startswith("bad"):
+            return httpx.Response(400, json={"error": {"message": "invalid"}})
+        if question.startswith("down") or question.startswith("flaky") and self.calls.count(question) == 1:
+            return httpx.Response(503, json={"error": {"message": "overloaded"}})
+        return httpx.Response(200, json={"choices": [{"message": {"content": f"answer to {question}"}}],
+                                         "usage": {"total_tokens": 7}})
+
+
+def service(upstream: BatchUpstream, cache: ChatResponseCache = None) -> ChatGptService:
+    client = httpx.AsyncClient(transport=httpx.MockTransport(upstream), base_url="https://api.test")
+    return ChatGptService(client, cache=cache, guard=UpstreamGuard(max_retries=1))
+
+
+async def collect(chat: ChatGptService, questions, concurrency: int, stop_after: int = None):
+    results = []
+    async with aclosing(run_batch(chat, questions, "gpt-4", concurrency)) as batch:
+        async for result in batch:
+            results.append(result)
+            if len(results) == stop_after:
+                break
+    return results
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(resilience, "OPEN_AI_RETRY_BACKOFF", 0.01)
+
+
+def test_batches_fan_out_and_report_failures_per_question():
+    upstream = BatchUpstream()
+    questions = [f"question {index}" for index in range(10)] + ["bad 1", "flaky 1", "down 1"]
+
+    results = asyncio.run(collect(service(upstream), questions, concurrency=4))
+
+    assert sorted(result.index for result in results) == list(range(13))
+    by_question = {questions[result.index]: result for result in results}
+    assert all(by_question[f"question {index}"].message == f"answer to question {index}" for index in range(10))
+    assert not by_question["bad 1"].success and by_question["bad 1"].error == "ChatGPT rejected the request."
+    assert by_question["flaky 1"].success  # a server error is retried
+    assert upstream.calls.count("bad 1") == 1  # a rejected question is not
+    assert not by_question["down 1"].success and by_question["down 1"].error == "ChatGPT returned an error."
+    assert upstream.calls.count("down 1") == 2  # only the retry of the guard, the batch does not add its own
+    assert upstream.max_concurrency == 4
+
+
+def test_batches_share_the_response_cache():
+    upstream = BatchUpstream()
+    cache = ChatResponseCache(fakeredis.FakeRedis(decode_responses=True),
+                              policies={"gpt-4": CachePolicy(ttl=60, local_ttl=60)})
+
+    chat = service(upstream, cache)
+
+    async def run():
+        return await collect(chat, ["question 1", "question 2"], concurrency=2), \
+            await collect(chat, ["Question 1", "question 3"], concurrency=2)
+
+    first, second = asyncio.run(run())
+
+    assert not any(result.cached for result in first)
+    assert [result.cached for result in sorted(second, key=lambda result: result.index)] == [True, False]
+    assert sorted(upstream.calls) == ["question 1", "question 2", "question 3"]
+
+
+def test_closing_a_batch_stops_the_remaining_questions():
+    upstream = BatchUpstream()
+
+    async def run():
+        results = await collect(service(upstream), [f"question {index}" for index in range(20)], concurrency=2,
+                                stop_after=3)
+        calls_at_close = len(upstream.calls)
+        await asyncio.sleep(0.1)
+        return results, calls_at_close
+
+    results, calls_at_close = asyncio.run(run())
+
+    assert len(results) == 3
+    assert calls_at_close < 10 and len(upstream.calls) == calls_at_close  # nothing is sent after closing
@@ -0,0 +1,46 @@
+import asyncio
+
+from app.components.chat_gpt.chatgpt_service import ChatGptService, create_http_client
+from app.components.chat_gpt.resilience import UpstreamGuard
+from tests.benchmarks.chat import run_chat_benchmark
+from tests.mocks.openai import MockOpenAIServer
+
+
+def test_chat_benchmark():
+    results = asyncio.run(run_chat_benchmark(requests=20, concurrencies=[10], latency=0.05, tokens=5,
+                                             token_delay=0.005))
+
+    completion = 0.05 + 5 * 0.005  # seconds of the mock for every answer
+    for result in results:
+        assert result["errors"] == 0
+        assert result["count"] == 20
+        assert result["upstream_max_concurrency"] > 1
+        assert result["latency_ms"]["p50"] >= completion * 1000
+        # 10 completions at a time; one at a time would be 13 requests/s
+        assert result["throughput_per_s"] > 2 / completion
+        # A call blocking the server loop for a completion would show up as a lag of 75ms
+        assert result["loop_lag_ms"]["samples"] > 0
+        assert result["loop_lag_ms"]["p50"] < 25
+    assert results[1]["first_token_ms"]["p50"] < results[1]["latency_ms"]["p50"]
+
+
+def test_rate_limited_requests_are_retried():
+    async def run():
+        mock = MockOpenAIServer(rate_limit=2)
+        url = await mock.start()
+        try:
+            async with create_http_client(url) as client:
+                service = ChatGptService(client, guard=UpstreamGuard(max_retries=2))
+                answers = await asyncio.gather(*(service.ask(f"Question {i}", "gpt-4") for i in range(3)))
+                usage = {}
+                tokens = [token async for token in service.stream("Streamed", "gpt-4", usage)]
+            return answers, tokens, usage, mock
+        finally:
+            await mock.stop()
+
+    answers, tokens, usage, mock = asyncio.run(run())
+
+    assert all(answer.message.startswith("word0") for answer in answers)
+    assert mock.rate_limited >= 1
+    assert len(tokens) == mock.tokens
+    assert usage["completion_tokens"] == mock.tokens
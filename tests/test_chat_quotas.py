@@ -0,0 +1,119 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+from fastapi import FastAPI, HTTPException, Request
+
+from app.components.auth.check_permissions import check_permissions
+from app.components.auth.jwt_token_handler import get_jwt_username
+from app.components.chat_gpt.chatgpt_service import ChatGptService
+from app.components.chat_gpt.quotas import ChatLimiter
+from app.components.chat_gpt.resilience import UpstreamGuard
+from app.routers import chatgpt
+
+fakeredis = pytest.importorskip("fakeredis.aioredis")
+
+USER = {"username": "alice", "role": "user"}
+
+
+def limiter(**kwargs) -> ChatLimiter:
+    return ChatLimiter(fakeredis.FakeRedis(decode_responses=True), concurrency_limits={"user": 2},
+                       token_quotas={"user": 100}, **kwargs)
+
+
+def test_concurrent_requests_over_the_limit_are_rejected():
+    limits = limiter()
+
+    async def run():
+        leases = [await limits.acquire(USER), await limits.acquire(USER)]
+        with pytest.raises(HTTPException) as error:
+            await limits.acquire(USER)
+        rejected_in_flight = await limits.in_flight("alice")
+        await limits.release("alice", leases[0])
+        third = await limits.acquire({**USER, "chat_concurrency_limit": 2})
+        return error.value, rejected_in_flight, third, await limits.in_flight("alice")
+
+    error, rejected_in_flight, third, in_flight = asyncio.run(run())
+
+    assert error.status_code == 429 and error.headers["Retry-After"] == "1"
+    assert rejected_in_flight == 2  # the rejected request did not keep a slot
+    assert third is not None and in_flight == 2
+
+
+def test_token_quota_is_exhausted_within_the_window():
+    limits = limiter()
+
+    async def run():
+        await limits.record("alice", 60)
+        await limits.release("alice", await limits.acquire(USER))  # 60 of 100 tokens
+        await limits.record("alice", 40)
+        with pytest.raises(HTTPException) as error:
+            await limits.acquire(USER)
+        unlimited = await limits.acquire({**USER, "chat_token_quota": 0})
+        return error.value, unlimited, await limits.usage("alice"), await limits.usage_report()
+
+    error, unlimited, usage, report = asyncio.run(run())
+
+    assert error.status_code == 429 and error.detail == "Chat token quota exceeded."
+    assert 0 < int(error.headers["Retry-After"]) <= limits.bucket
+    assert unlimited is not None
+    assert usage == {"username": "alice", "tokens": 100, "requests": 2}
+    assert report == [usage]
+
+
+def chat_app(limits: ChatLimiter) -> FastAPI:
+    def upstream(request: httpx.Request) -> httpx.Response:
+        chunks = [f'data: {json.dumps({"choices": [{"delta": {"content": word}}]})}\n\n' for word in ("Hi ", "there")]
+        return httpx.Response(200, content="".join(chunks + ["data: [DONE]\n\n"]).encode(),
+                              headers={"content-type": "text/event-stream"})
+
+    async def permissions(request: Request):
+        request.state.user = USER
+
+    app = FastAPI()
+    app.include_router(chatgpt.router)
+    app.dependency_overrides[check_permissions] = permissions
+    app.dependency_overrides[get_jwt_username] = lambda: "alice"
+    app.state.chatgpt = ChatGptService(httpx.AsyncClient(transport=httpx.MockTransport(upstream),
+                                                         base_url="https://api.test"), guard=UpstreamGuard())
+    app.state.chat_limiter = limits
+    return app
+
+
+async def stream_chat(app: FastAPI, disconnect: bool = False) -> bytes:
+    """Call the streamed chat route as ASGI; with `disconnect` the client is gone before the body is sent."""
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+             "path": "/chat/", "raw_path": b"/chat/", "root_path": "", "headers": [],
+             "query_string": b"question=Hello&model=gpt-4&stream=true", "server": ("test", 80),
+             "client": ("test", 1234)}
+    body = []
+
+    async def receive():
+        if disconnect:
+            return {"type": "http.disconnect"}
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        body.append(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return b"".join(body)
+
+
+def test_streams_release_their_lease():
+    limits = limiter()
+    app = chat_app(limits)
+
+    async def run():
+        body = await stream_chat(app)
+        after_stream = await limits.in_flight("alice")
+        await stream_chat(app, disconnect=True)
+        return body, after_stream, await limits.in_flight("alice"), await limits.usage("alice")
+
+    body, after_stream, after_disconnect, usage = asyncio.run(run())
+
+    assert b'"message": "Hi there"' in body
+    assert after_stream == 0
+    assert after_disconnect == 0  # released although the body was never sent
+    assert usage["requests"] >= 1
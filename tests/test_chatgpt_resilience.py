@@ -0,0 +1,205 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from app.components.chat_gpt import resilience
+from app.components.chat_gpt.chatgpt_service import ChatGptService
+from app.components.chat_gpt.resilience import CircuitBreaker, RetryBudget, UpstreamError, UpstreamGuard
+
+
+class MockUpstream:
+    """Chat completions API answering with the given statuses in turn, then with 200."""
+
+    def __init__(self, statuses=(), delays=(), headers=None):
+        self.statuses = list(statuses)
+        self.delays = list(delays)
+        self.headers = headers or {}
+        self.calls = 0
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.calls += 1
+        if self.delays:
+            await asyncio.sleep(self.delays.pop(0))
+        status = self.statuses.pop(0) if self.statuses else 200
+        if status == "timeout":
+            raise httpx.ReadTimeout("timed out", request=request)
+        if status == "not_json":
+            return httpx.Response(200, content=b"<html>Bad gateway</html>")
+        if status == "no_choices":
+            return httpx.Response(200, json={"error": "overloaded"})
+        if status != 200:
+            return httpx.Response(status, headers=self.headers, json={"error": {"message": "failed"}})
+        if json.loads(request.content).get("stream"):
+            body = f'data: {json.dumps({"choices": [{"delta": {"content": "Hi"}}]})}\n\ndata: [DONE]\n\n'
+            return httpx.Response(200, content=body.encode(), headers={"content-type": "text/event-stream"})
+        return httpx.Response(200, json={"choices": [{"message": {"content": f"answer {self.calls}"}}]})
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(resilience, "OPEN_AI_RETRY_BACKOFF", 0.01)
+    monkeypatch.setattr(resilience, "OPEN_AI_HEDGE_MIN_DELAY", 0.01)
+
+
+def ask(upstream: MockUpstream, guard: UpstreamGuard, question: str = "Hello?"):
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(upstream), base_url="https://api.test") as client:
+            return await ChatGptService(client, guard=guard).ask(question, "gpt-4")
+
+    return asyncio.run(run())
+
+
+def test_retries_server_errors_and_rate_limits():
+    upstream = MockUpstream(statuses=[503, 429])
+
+    answer = ask(upstream, UpstreamGuard(max_retries=2))
+
+    assert answer.message == "answer 3"
+    assert upstream.calls == 3
+
+
+@pytest.mark.parametrize("status, expected", [(500, 502), (429, 429), ("timeout", 504), (400, 502),
+                                              ("not_json", 502), ("no_choices", 502)])
+def test_errors_are_mapped_to_status_codes(status, expected):
+    upstream = MockUpstream(statuses=[status] * 5, headers={"retry-after": "1"})
+    guard = UpstreamGuard(max_retries=1)
+
+    with pytest.raises(UpstreamError) as error:
+        ask(upstream, guard)
+
+    assert error.value.status_code == expected
+    # A rejected request (400) is not retried, nor counted as a failure of the API
+    assert upstream.calls == (1 if status == 400 else 2)
+    assert guard.breaker("gpt-4").failures == (0 if status == 400 else 2)
+
+
+def test_retry_budget_limits_retries():
+    guard = UpstreamGuard(max_retries=5, budget=RetryBudget(ratio=0, minimum=2, window=60))
+    upstream = MockUpstream(statuses=[502] * 10)
+
+    with pytest.raises(UpstreamError):
+        ask(upstream, guard)
+
+    assert upstream.calls == 3  # the first attempt and the two retries of the budget
+
+
+class FakeClock:
+    """Time of the circuit breakers, moved by the tests."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_circuit_opens_and_recovers():
+    clock = FakeClock()
+    guard = UpstreamGuard(max_retries=0,
+                          breaker_factory=lambda: CircuitBreaker(failures=3, reset_timeout=30, clock=clock))
+    upstream = MockUpstream(statuses=[500] * 3)
+
+    for _ in range(3):
+        with pytest.raises(UpstreamError):
+            ask(upstream, guard)
+    clock.now += 29
+    with pytest.raises(UpstreamError) as error:
+        ask(upstream, guard)
+
+    assert error.value.status_code == 503
+    assert error.value.headers["Retry-After"] == "2"
+    assert upstream.calls == 3  # the open circuit did not call upstream
+    assert guard.breaker("gpt-4").state == "open"
+
+    clock.now += 1
+    assert ask(upstream, guard).message == "answer 4"  # the probe succeeded
+    assert guard.breaker("gpt-4").state == "closed"
+
+
+def test_cancelled_probe_does_not_keep_the_circuit_open():
+    clock = FakeClock()
+    guard = UpstreamGuard(max_retries=0,
+                          breaker_factory=lambda: CircuitBreaker(failures=1, reset_timeout=30, clock=clock))
+    upstream = MockUpstream(statuses=[500], delays=[0, 60])
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(upstream), base_url="https://api.test") as client:
+            service = ChatGptService(client, guard=guard)
+            with pytest.raises(UpstreamError):
+                await service.ask("Hello?", "gpt-4")
+            clock.now += 30
+            probe = asyncio.create_task(service.ask("Hello?", "gpt-4"))
+            while upstream.calls < 2:  # the probe is waiting for upstream
+                await asyncio.sleep(0)
+            probe.cancel()  # e.g. the client of the probe disconnected
+            with pytest.raises(asyncio.CancelledError):
+                await probe
+            return guard.breaker("gpt-4").state, await service.ask("Hello?", "gpt-4")
+
+    state, answer = asyncio.run(run())
+
+    assert state == "half_open"
+    assert answer.message == "answer 3"  # the next call probed and closed the circuit
+    assert guard.breaker("gpt-4").state == "closed"
+
+
+def test_hedged_request_wins_over_slow_attempt():
+    guard = UpstreamGuard(max_retries=0, hedge=True)
+    for _ in range(resilience.LATENCY_MIN_SAMPLES):
+        guard.latencies.setdefault("gpt-4", resilience.LatencyTracker()).add(0.02)
+    upstream = MockUpstream(delays=[1.0, 0.0])
+
+    answer = ask(upstream, guard)
+
+    assert answer.message == "answer 2"
+    assert guard.counters["hedges"] == 1
+    assert guard.counters["hedge_wins"] == 1
+
+
+def test_stream_opening_is_retried():
+    upstream = MockUpstream(statuses=[503])
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(upstream), base_url="https://api.test") as client:
+            service = ChatGptService(client, guard=UpstreamGuard(max_retries=1))
+            return [token async for token in service.stream("Hello?", "gpt-4")]
+
+    assert asyncio.run(run()) == ["Hi"]
+    assert upstream.calls == 2
+
+
+def test_malformed_stream_chunks_end_with_an_error_event():
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+
+    from app.components.auth.check_permissions import check_permissions
+    from app.components.auth.jwt_token_handler import get_jwt_username
+    from app.routers import chatgpt
+
+    bodies = []
+
+    def upstream(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, content=bodies.pop(0).encode(), headers={"content-type": "text/event-stream"})
+
+    app = FastAPI()
+    app.include_router(chatgpt.router)
+    app.dependency_overrides[check_permissions] = lambda: None
+    app.dependency_overrides[get_jwt_username] = lambda: "tester"
+    app.state.chatgpt = ChatGptService(httpx.AsyncClient(transport=httpx.MockTransport(upstream),
+                                                         base_url="https://api.test"), guard=UpstreamGuard())
+    app.state.chat_limiter = None
+    first_chunk = f'data: {json.dumps({"choices": [{"delta": {"content": "Hi"}}]})}\n\n'
+    bodies.extend([first_chunk + 'data: {"choices": [{"delta"\n\ndata: [DONE]\n\n', "data: not json\n\n"])
+
+    with TestClient(app) as client:
+        response = client.get("/chat/", params={"question": "Hello?", "model": "gpt-4", "stream": True})
+        rejected = client.get("/chat/", params={"question": "Hello?", "model": "gpt-4", "stream": True})
+
+    # Once tokens were sent, like an upstream that fails while streaming
+    assert response.status_code == 200
+    assert response.text == chatgpt.sse_event({"token": "Hi"}) \
+        + chatgpt.sse_event({"message": "Error: Unable to fetch response."}, event="error")
+    # Before the first token, like an upstream that fails to answer
+    assert rejected.status_code == 502
@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+from app.components.chat_gpt.conversations import ConversationStore, count_tokens
+
+fakeredis = pytest.importorskip("fakeredis.aioredis")
+
+MODEL = "gpt-4"
+TURN = "word " * 40  # about 50 tokens without tiktoken
+
+
+def store(budget: int = 200) -> ConversationStore:
+    return ConversationStore(fakeredis.FakeRedis(decode_responses=True), budgets={MODEL: budget})
+
+
+async def fill(conversations: ConversationStore, turns: int) -> int:
+    tokens = 0
+    for index in range(turns):
+        tokens = await conversations.append("alice", "s1", MODEL, f"Question {index} {TURN}", f"Answer {index} {TURN}")
+    return tokens
+
+
+def test_compaction_folds_dropped_turns_into_the_summary():
+    conversations = store()
+    transcripts = []
+
+    async def summarize(transcript: str) -> str:
+        transcripts.append(transcript)
+        return "They talked about words."
+
+    async def run():
+        tokens = await fill(conversations, 3)
+        assert conversations.needs_compaction(tokens, MODEL)
+        await conversations.compact("alice", "s1", MODEL, summarize)
+        session = await conversations.get("alice", "s1")
+        # The session total returned by append counts the summary as well
+        tokens = await conversations.append("alice", "s1", MODEL, "Next?", "Yes.")
+        return session, tokens, await conversations.redis.exists("chatgpt:session:alice:s1:compacting")
+
+    session, tokens, locked = asyncio.run(run())
+
+    summary_tokens = count_tokens("They talked about words.", MODEL)
+    assert session.summary == "They talked about words."
+    assert [turn.role for turn in session.turns] == ["user", "assistant"]
+    assert session.tokens == sum(turn.tokens for turn in session.turns) + summary_tokens
+    assert "Question 0" in transcripts[0] and "Question 2" not in transcripts[0]
+    assert tokens == session.tokens + count_tokens("Next?", MODEL) + count_tokens("Yes.", MODEL)
+    assert not locked
+
+
+def test_a_failed_summary_keeps_the_previous_one():
+    conversations = store()
+
+    async def summarize(transcript: str) -> str:
+        return "First summary."
+
+    async def failing_summarize(transcript: str) -> str:
+        raise RuntimeError("upstream down")
+
+    async def run():
+        await fill(conversations, 3)
+        await conversations.compact("alice", "s1", MODEL, summarize)
+        await fill(conversations, 2)
+        await conversations.compact("alice", "s1", MODEL, failing_summarize)
+        return await conversations.get("alice", "s1")
+
+    session = asyncio.run(run())
+
+    assert session.summary == "First summary."
+    assert session.tokens == sum(turn.tokens for turn in session.turns) + count_tokens("First summary.", MODEL)
+
+
+def test_compaction_releases_only_its_own_lock():
+    conversations = store()
+    lock_key = "chatgpt:session:alice:s1:compacting"
+
+    async def slow_summarize(transcript: str) -> str:
+        # The lock expired meanwhile and another compaction took it
+        await conversations.redis.set(lock_key, "other")
+        return "Summary."
+
+    async def run():
+        await fill(conversations, 3)
+        await conversations.compact("alice", "s1", MODEL, slow_summarize)
+        return await conversations.redis.get(lock_key)
+
+    assert asyncio.run(run()) == "other"
@@ -0,0 +1,200 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from bson.errors import InvalidDocument
+from pymongo.errors import AutoReconnect
+
+from app.components.message_dispatcher import email_history
+from app.components.message_dispatcher.email_history import EmailHistoryBuffer, archive_email_history
+from app.routers.settings import messages
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+
+class FlakyCollection:
+    """Collection whose next `failures` insert_many calls fail as a whole."""
+
+    def __init__(self, collection, failures: int):
+        self.collection = collection
+        self.failures = failures
+        self.calls = 0
+
+    async def insert_many(self, records, ordered=True):
+        self.calls += 1
+        if self.failures:
+            self.failures -= 1
+            raise AutoReconnect("connection lost")
+        return await self.collection.insert_many(records, ordered=ordered)
+
+
+def test_records_are_written_in_batches_and_flushed_on_stop():
+    async def run():
+        collection = mongomock_motor.AsyncMongoMockClient().messages.emails_sent
+        flaky = FlakyCollection(collection, failures=0)
+        buffer = EmailHistoryBuffer(flaky, batch_size=3, flush_interval=60)
+        await buffer.start()
+        for index in range(3):
+            await buffer.add({"subject": f"email {index}"})
+        await asyncio.sleep(0.01)  # a full batch wakes the writer up
+        after_full_batch = await collection.count_documents({})
+        await buffer.add({"subject": "email 3"})
+        await asyncio.sleep(0.01)
+        before_stop = await collection.count_documents({})  # waits for the flush interval
+        summary = await buffer.stop()
+        return after_full_batch, before_stop, summary, await collection.count_documents({}), flaky.calls
+
+    after_full_batch, before_stop, summary, stored, calls = asyncio.run(run())
+
+    assert after_full_batch == 3 and before_stop == 3
+    assert summary == {"written": 4, "failed": 0} and stored == 4
+    assert calls == 2
+
+
+def test_failed_batches_are_retried_once():
+    async def run():
+        collection = mongomock_motor.AsyncMongoMockClient().messages.emails_sent
+        buffer = EmailHistoryBuffer(FlakyCollection(collection, failures=1), batch_size=10, retry_delay=0)
+        buffer._pending.extend({"subject": f"email {index}"} for index in range(4))  # noqa
+        recovered = await buffer.flush()
+
+        buffer.collection = FlakyCollection(collection, failures=2)
+        buffer._pending.extend({"subject": f"lost {index}"} for index in range(2))  # noqa
+        lost = await buffer.flush()
+        return recovered, lost, buffer, await collection.count_documents({})
+
+    recovered, lost, buffer, stored = asyncio.run(run())
+
+    assert recovered == 0 and lost == 2
+    assert buffer.written == 4 and buffer.failed == 2 and stored == 4
+
+
+def test_a_full_buffer_drops_the_oldest_record():
+    async def run():
+        collection = mongomock_motor.AsyncMongoMockClient().messages.emails_sent
+        buffer = EmailHistoryBuffer(collection, batch_size=100, flush_interval=60, max_pending=3)
+        await buffer.start()
+        for index in range(5):
+            await buffer.add({"subject": f"email {index}"})
+        summary = await buffer.stop()
+        return summary, [record["subject"] for record in await collection.find({}).to_list(None)]
+
+    summary, subjects = asyncio.run(run())
+
+    assert summary == {"written": 3, "failed": 2}
+    assert subjects == ["email 2", "email 3", "email 4"]
+
+
+def test_unexpected_errors_do_not_stop_the_writer_or_the_archiver(monkeypatch):
+    class UnencodableCollection:
+        def __init__(self, collection):
+            self.collection = collection
+
+        async def insert_many(self, records, ordered=True):
+            if any("bad" in record for record in records):
+                raise InvalidDocument("cannot encode object")
+            return await self.collection.insert_many(records, ordered=ordered)
+
+    archive_runs = []
+
+    async def failing_archive(older_than):
+        archive_runs.append(older_than)
+        raise RuntimeError("unexpected")
+
+    monkeypatch.setattr(email_history, "archive_email_history", failing_archive)
+
+    async def run():
+        collection = mongomock_motor.AsyncMongoMockClient().messages.emails_sent
+        buffer = EmailHistoryBuffer(UnencodableCollection(collection), batch_size=1, flush_interval=60)
+        await buffer.start()
+        await buffer.add({"subject": "unencodable", "bad": object()})
+        await asyncio.sleep(0.01)
+        await buffer.add({"subject": "next"})
+        await asyncio.sleep(0.01)
+        writer_running = not buffer._task.done()  # noqa
+
+        archiver = email_history.EmailHistoryArchiver(interval=0.01)
+        archiver._task = asyncio.create_task(archiver._run())  # noqa
+        for _ in range(500):
+            if len(archive_runs) > 1:
+                break
+            await asyncio.sleep(0.01)
+        archiver_running = not archiver._task.done()  # noqa
+        await archiver.stop()
+        summary = await buffer.stop()
+        return writer_running, archiver_running, summary, await collection.count_documents({})
+
+    writer_running, archiver_running, summary, stored = asyncio.run(run())
+
+    assert writer_running and archiver_running
+    assert summary == {"written": 1, "failed": 1} and stored == 1
+    assert len(archive_runs) > 1
+
+
+def test_history_is_paged_newest_first(monkeypatch):
+    collection = mongomock_motor.AsyncMongoMockClient().messages.emails_sent
+    monkeypatch.setattr(messages, "emails_history", collection)
+    start = datetime(2024, 5, 1)
+
+    async def run():
+        # Two records per second, so pages end in the middle of a timestamp
+        await collection.insert_many([
+            {"subject": f"email {index}", "to_emails": ["a@example.com" if index % 2 else "b@example.com"],
+             "sent_at": start + timedelta(seconds=index // 2)} for index in range(9)
+        ] + [{"subject": "legacy", "to_emails": ["a@example.com"]}])
+        pages, cursor = [], None
+        while True:
+            page = await messages.get_emails_sent(recipient=None, subject_prefix=None, sent_from=None, sent_to=None,
+                                                  limit=4, cursor=cursor)
+            pages.append([item.subject for item in page.items])
+            cursor = page.next_cursor
+            if cursor is None:
+                break
+        filtered = await messages.get_emails_sent(recipient="a@example.com", subject_prefix="email",
+                                                  sent_from=start + timedelta(seconds=1), sent_to=None, limit=10,
+                                                  cursor=None)
+        return pages, [item.subject for item in filtered.items]
+
+    pages, filtered = asyncio.run(run())
+
+    subjects = [subject for page in pages for subject in page]
+    assert [len(page) for page in pages] == [4, 4, 2]
+    assert subjects[-1] == "legacy"  # records without sent_at come last
+    assert sorted(subjects[:-1]) == sorted(f"email {index}" for index in range(9))  # each record once
+    assert pages[0] == ["email 8", "email 7", "email 6", "email 5"]  # equal sent_at, the newer _id first
+    assert filtered == ["email 7", "email 5", "email 3"]
+
+
+def test_invalid_cursors_are_rejected():
+    with pytest.raises(messages.HTTPException) as error:
+        messages.decode_history_cursor("not-a-cursor")
+    assert error.value.status_code == 400
+
+
+def test_retention_ttl_index_and_archival(monkeypatch):
+    client = mongomock_motor.AsyncMongoMockClient()
+    monkeypatch.setattr(email_history, "emails_collection", client.messages.emails_sent)
+    monkeypatch.setattr(email_history, "archive_collection", client.messages.emails_sent_archive)
+    now = datetime(2024, 5, 1)
+
+    async def run():
+        monkeypatch.setattr(email_history, "EMAIL_HISTORY_RETENTION_MODE", "ttl")
+        await email_history.apply_email_history_ttl()
+        ttl_index = (await client.messages.emails_sent.index_information()).get(email_history.TTL_INDEX_NAME)
+        monkeypatch.setattr(email_history, "EMAIL_HISTORY_RETENTION_MODE", "archive")
+        await email_history.apply_email_history_ttl()
+        ttl_dropped = email_history.TTL_INDEX_NAME not in await client.messages.emails_sent.index_information()
+
+        await client.messages.emails_sent.insert_many(
+            [{"subject": f"old {index}", "sent_at": now - timedelta(days=100 + index)} for index in range(5)]
+            + [{"subject": "recent", "sent_at": now - timedelta(days=1)}])
+        archived = await archive_email_history(now - timedelta(days=90), batch_size=2)
+        remaining = [record["subject"] for record in await client.messages.emails_sent.find({}).to_list(None)]
+        return ttl_index, ttl_dropped, archived, remaining, \
+            await client.messages.emails_sent_archive.count_documents({})
+
+    ttl_index, ttl_dropped, archived, remaining, in_archive = asyncio.run(run())
+
+    assert ttl_index["expireAfterSeconds"] == email_history.EMAIL_HISTORY_RETENTION_DAYS * 24 * 60 * 60
+    assert ttl_dropped
+    assert archived == 5 and in_archive == 5 and remaining == ["recent"]
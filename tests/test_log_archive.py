@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import date, timedelta
+
+from app.components import log_archive
+from app.components.log_archive import LOG_ARCHIVE_LOCK, LogArchiver, archive_logs, grep_logs, log_files, zstandard
+
+TODAY = date(2024, 5, 10)
+
+
+def _write_day(directory, day: date, lines):
+    path = os.path.join(directory, f"{day:%Y-%m}", f"app_{day:%Y-%m-%d}.log")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as log_file:
+        log_file.write("".join(f"{line}\n" for line in lines))
+    os.utime(path, (0, 0))  # closed long ago
+    return path
+
+
+def test_closed_days_are_compressed_and_old_ones_removed(tmp_path):
+    directory = str(tmp_path)
+    for offset in range(12):
+        day = TODAY - timedelta(days=offset)
+        _write_day(directory, day, [f"{day} request {index}" for index in range(200)])
+
+    result = archive_logs(directory, "app", compression="gzip", retention_days=7, max_total_bytes=0, today=TODAY)
+
+    files = log_files(directory, "app")
+    assert [log_file.day for log_file in files] == [TODAY - timedelta(days=offset) for offset in range(6, -1, -1)]
+    assert all(log_file.path.endswith(".log.gz") for log_file in files[:-1])
+    assert files[-1].path.endswith(".log")  # today is still being written
+    assert len(result.removed) == 5 and result.bytes_saved > 0
+    assert not os.path.exists(os.path.join(directory, "2024-04"))  # the emptied month is gone
+
+
+def test_size_budget_removes_the_oldest_days(tmp_path):
+    directory = str(tmp_path)
+    for offset in range(5):
+        _write_day(directory, TODAY - timedelta(days=offset), ["x" * 1000])
+
+    archive_logs(directory, "app", compression=None, retention_days=0, max_total_bytes=2500, today=TODAY)
+
+    assert [log_file.day for log_file in log_files(directory, "app")] == [TODAY - timedelta(days=1), TODAY]
+
+
+def test_grep_streams_plain_and_compressed_days(tmp_path):
+    directory = str(tmp_path)
+    zstd = "zstd" if zstandard is not None else "gzip"  # zstandard is optional
+    for offset, method in ((3, "gzip"), (2, zstd), (1, "gzip")):
+        day = TODAY - timedelta(days=offset)
+        _write_day(directory, day, [f"Permission granted: alice {day}", f"Permission denied: bob {day}"])
+        archive_logs(directory, "app", compression=method, retention_days=0, max_total_bytes=0, today=TODAY)
+    _write_day(directory, TODAY, [f"Permission denied: carol {TODAY}"])
+
+    matches = list(grep_logs("permission DENIED", ignore_case=True, dir_name=directory, base_filename="app"))
+    assert [line.split()[2] for _, line in matches] == ["bob", "bob", "bob", "carol"]
+    extensions = {log_file.path.rsplit(".", 1)[-1] for log_file in log_files(directory, "app")}
+    assert extensions == ({"gz", "zst", "log"} if zstandard is not None else {"gz", "log"})
+
+    since = TODAY - timedelta(days=2)
+    assert [day for day, _ in grep_logs("denied", since=since, limit=2, dir_name=directory, base_filename="app")] \
+        == [since, since + timedelta(days=1)]
+
+
+def test_one_process_archives_at_a_time(tmp_path):
+    directory = str(tmp_path)
+    path = _write_day(directory, TODAY - timedelta(days=1), ["line"])
+    lock = os.path.join(directory, LOG_ARCHIVE_LOCK)
+    open(lock, "w").close()  # another worker is archiving
+
+    skipped = archive_logs(directory, "app", compression="gzip", retention_days=0, max_total_bytes=0, today=TODAY)
+    assert not skipped.compressed and os.path.exists(path)
+
+    os.utime(lock, (time.time() - 7200, time.time() - 7200))  # that worker died during its run
+    result = archive_logs(directory, "app", compression="gzip", retention_days=0, max_total_bytes=0, today=TODAY)
+    assert result.compressed == [f"{path}.gz"]
+    assert not os.path.exists(lock)
+
+
+def test_archiver_keeps_running_after_errors(monkeypatch, caplog):
+    runs = []
+
+    def failing_archive(**kwargs):
+        runs.append(kwargs)
+        raise ValueError("unexpected")
+
+    monkeypatch.setattr(log_archive, "archive_logs", failing_archive)
+
+    async def run():
+        archiver = LogArchiver(interval=0.01)
+        archiver._task = asyncio.create_task(archiver._run())  # noqa
+        for _ in range(500):  # the runs are in a thread, slower when the machine is busy
+            if len(runs) > 1:
+                break
+            await asyncio.sleep(0.01)
+        running = not archiver._task.done()  # noqa
+        await archiver.stop()
+        return running
+
+    with caplog.at_level(logging.ERROR):
+        assert asyncio.run(run())
+    assert len(runs) > 1
+    assert "Log archive failed" in caplog.text
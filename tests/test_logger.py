@@ -0,0 +1,109 @@
+import json
+import logging
+import os
+import queue
+from datetime import datetime
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.components.logger import (BatchingQueueListener, DailyRotatingFileHandler, DeferredQueueHandler,
+                                   JsonFormatter, RequestContextFilter, SamplingFilter, bind_log_context)
+from app.components.request_context import RequestContextMiddleware
+
+
+def _record(message: str, created: float) -> logging.LogRecord:
+    record = logging.LogRecord("test", logging.INFO, __file__, 1, message, None, None)
+    record.created = created
+    return record
+
+
+def test_daily_file_rolls_over_at_midnight(tmp_path):
+    handler = DailyRotatingFileHandler(str(tmp_path), "app", encoding="utf-8")
+    today = datetime.now().timestamp()
+    handler.emit(_record("today", today))
+    handler.emit(_record("tomorrow", handler.rollover_at + 1))
+    handler.close()
+
+    tomorrow = datetime.fromtimestamp(handler.rollover_at - 1)
+    assert handler.baseFilename.endswith(f"app_{tomorrow:%Y-%m-%d}.log")
+    files = sorted(os.path.join(root, name) for root, _, names in os.walk(tmp_path) for name in names)
+    assert len(files) == 2
+    assert [open(path).read().strip() for path in files] == ["today", "tomorrow"]
+
+
+def test_queued_records_are_written_by_the_listener(tmp_path):
+    log_queue = queue.SimpleQueue()
+    handler = DailyRotatingFileHandler(str(tmp_path), "app", encoding="utf-8", buffered=True)
+    listener = BatchingQueueListener(log_queue, handler, batch_size=16)
+    log = logging.getLogger("tests.logger.queued")
+    log.handlers = [DeferredQueueHandler(log_queue, max_size=1000)]
+    log.propagate = False
+    listener.start()
+    for index in range(100):
+        log.info("record %s", index)
+    listener.stop()
+    handler.close()
+
+    lines = open(handler.baseFilename).read().splitlines()
+    assert lines == [f"record {index}" for index in range(100)]
+
+
+def test_full_queue_drops_records():
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue, max_size=2)
+    for index in range(5):
+        queue_handler.handle(_record(f"record {index}", 0))
+
+    assert log_queue.qsize() == 2
+    assert queue_handler.dropped == 3
+
+
+def test_json_records_carry_the_request_context():
+    records = []
+    capture = logging.Handler()
+    capture.emit = records.append
+    capture.addFilter(RequestContextFilter())
+    log = logging.getLogger("tests.logger.context")
+    log.handlers = [capture]
+    log.propagate = False
+
+    app = FastAPI()
+    app.add_middleware(RequestContextMiddleware)
+
+    @app.get("/items/{item_id}")
+    async def item(item_id: str):
+        bind_log_context(user="alice")
+        log.info("Item %s fetched", item_id, extra={"event": "item", "count": 1})
+        return {}
+
+    with TestClient(app) as client:
+        response = client.get("/items/7", headers={"X-Request-ID": "abc123"})
+
+    assert response.headers["X-Request-ID"] == "abc123"
+    entry = json.loads(JsonFormatter().format(records[0]))
+    assert entry["message"] == "Item 7 fetched"
+    assert entry["level"] == "INFO"
+    assert entry["event"] == "item" and entry["count"] == 1
+    assert entry["request_id"] == "abc123"
+    assert entry["user"] == "alice"
+    assert entry["route"] == "/items/{item_id}"
+    assert entry["method"] == "GET"
+    assert entry["duration_ms"] >= 0
+
+
+def test_sampling_keeps_whole_requests_and_all_warnings():
+    sampling = SamplingFilter({"permission_granted": 0.25})
+
+    def record(level, event, request_id):
+        entry = logging.LogRecord("test", level, __file__, 1, "message", None, None)
+        entry.event = event
+        entry.request_id = request_id
+        return entry
+
+    kept = [sampling.filter(record(logging.INFO, "permission_granted", f"request{i}")) for i in range(2000)]
+    assert 300 < sum(kept) < 700
+    # The decision only depends on the request id
+    assert kept == [sampling.filter(record(logging.INFO, "permission_granted", f"request{i}")) for i in range(2000)]
+    assert all(sampling.filter(record(logging.WARNING, "permission_granted", f"request{i}")) for i in range(100))
+    assert all(sampling.filter(record(logging.INFO, "other", f"request{i}")) for i in range(100))
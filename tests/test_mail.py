@@ -0,0 +1,91 @@
+import asyncio
+import io
+
+from aiosmtplib import SMTPServerDisconnected
+from fastapi import UploadFile
+
+from app.classes.Messages import ChannelEnum, OutgoingMessage
+from app.components.message_dispatcher.mail import SmtpChannel, send_email_and_save
+from tests.benchmarks.mail import run_mail_benchmark
+
+
+def test_send_email_and_save(smtp_server, local_smtp):
+    attachment = UploadFile(file=io.BytesIO(b"report"), filename="report.txt")
+
+    result = asyncio.run(send_email_and_save("Hello", "Body", ["user@example.com"], [attachment]))
+
+    assert result == {"message": "Email sent and saved successfully"}
+    assert len(smtp_server.envelopes) == 1
+    assert smtp_server.envelopes[0].rcpt_tos == ["user@example.com"]
+    assert b"attachment; filename=report.txt" in smtp_server.envelopes[0].content
+    assert local_smtp.documents[0]["attachments"] == ["report.txt"]
+    assert local_smtp.documents[0]["sent_at"] is not None
+
+
+def test_smtp_channel_reuses_connections(smtp_server, local_smtp):
+    config = smtp_server.smtp_config()
+
+    class LocalSmtpChannel(SmtpChannel):
+        async def get_config(self) -> dict:
+            return config
+
+    async def send_all():
+        channel = LocalSmtpChannel(rate_limit=0, pool_size=2, batch_size=10)
+        await channel.start()
+        try:
+            return await asyncio.gather(*(
+                channel.send(OutgoingMessage(channel=ChannelEnum.email, to=[f"user{i}@example.com"],
+                                             subject="Hi", body="Body"))
+                for i in range(30)
+            ))
+        finally:
+            await channel.stop()
+
+    results = asyncio.run(send_all())
+
+    assert all(result.success for result in results)
+    assert len(smtp_server.envelopes) == 30
+    assert len(local_smtp.documents) == 30
+    # 30 messages over the pooled connections of the 2 workers, not a connection per message
+    assert 1 <= smtp_server.connections <= 2
+
+
+def test_mail_benchmark_reports_every_scenario(smtp_server):
+    results = asyncio.run(run_mail_benchmark(smtp_server, messages=20, concurrencies=[1, 5], attachment_sizes=[0, 16]))
+
+    assert len(results) == 6  # 2 attachment sizes x 2 concurrency levels + 2 SmtpChannel runs
+    for result in results:
+        assert result["errors"] == 0
+        assert result["count"] == 20
+        assert result["latency_ms"]["p50"] <= result["latency_ms"]["p99"]
+
+
+def test_a_dropped_pooled_connection_is_closed_before_reconnecting(smtp_server, local_smtp):
+    class DroppedConnection:
+        """Pooled connection the server closed while it was idle."""
+        is_connected = True
+        closed = False
+
+        async def send_message(self, msg):
+            raise SMTPServerDisconnected("Server not connected")
+
+        async def quit(self):
+            raise SMTPServerDisconnected("Server not connected")
+
+        def close(self):
+            self.closed = True
+            self.is_connected = False
+
+    async def send():
+        channel = SmtpChannel(rate_limit=0)
+        dropped = DroppedConnection()
+        channel._idle.append(dropped)  # noqa
+        results = await channel.deliver_batch(smtp_server.smtp_config(), [
+            OutgoingMessage(channel=ChannelEnum.email, to=["user@example.com"], subject="Hi", body="Body")])
+        await channel.close_pool()
+        return results, dropped
+
+    results, dropped = asyncio.run(send())
+
+    assert results[0].success and len(smtp_server.envelopes) == 1
+    assert dropped.closed
@@ -0,0 +1,175 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from app.classes.Messages import ChannelEnum, OutgoingMessage
+from app.components.message_dispatcher import dispatcher
+from app.components.message_dispatcher.dispatcher import MessageDispatcher, RateLimiter
+from app.components.message_dispatcher.twilio import SmsChannel, TwilioChannel, WhatsappChannel
+from tests.mocks.twilio import MockTwilioServer
+
+WHATSAPP_CONFIG = {"active": True, "account_sid": "AC123", "auth_token": "token", "from_number": "+1000"}
+SMS_CONFIG = {"active": True, "provider": "Twilio", "api_key": "AC123:token", "from_number": "+2000"}
+
+
+def configured(channel_cls, config: dict, **kwargs):
+    """A channel using the given settings instead of the settings document in MongoDB."""
+
+    class ConfiguredChannel(channel_cls):
+        async def get_config(self) -> dict:
+            return config
+
+    return ConfiguredChannel(**kwargs)
+
+
+async def run_dispatcher(channels, messages, latency: float = 0.0):
+    server = MockTwilioServer(latency=latency)
+    base_url = await server.start()
+    for channel in channels:
+        channel.base_url = base_url
+    message_dispatcher = MessageDispatcher(channels)
+    await message_dispatcher.start()
+    try:
+        return await message_dispatcher.send_many(messages), server
+    finally:
+        await message_dispatcher.stop()
+        await server.stop()
+
+
+def test_whatsapp_and_sms_throughput():
+    channels = [
+        configured(WhatsappChannel, WHATSAPP_CONFIG, rate_limit=0, pool_size=4, batch_size=25),
+        configured(SmsChannel, SMS_CONFIG, rate_limit=0, pool_size=4, batch_size=25),
+    ]
+    messages = [OutgoingMessage(channel=channel, to=[f"+1555{i:04d}"], body=f"Message {i}")
+                for i in range(200) for channel in (ChannelEnum.whatsapp, ChannelEnum.sms)]
+
+    results, server = asyncio.run(run_dispatcher(channels, messages, latency=0.005))
+
+    assert all(result.success for result in results)
+    assert [result.to for result in results] == [message.to for message in messages]
+    assert len(server.messages) == 400
+    assert sum(data["To"].startswith("whatsapp:") for _, data in server.messages) == 200
+    # 8 workers in all, more requests than that at once means the requests of a batch run concurrently
+    assert server.max_concurrency > 8
+
+
+class FakeClock:
+    """Time that only moves when the rate limiter sleeps."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.slept = 0.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    async def sleep(self, seconds: float):
+        self.now += seconds
+        self.slept += seconds
+
+
+def test_rate_limit_is_applied(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(dispatcher.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(dispatcher.asyncio, "sleep", clock.sleep)
+    limiter = RateLimiter(rate=50)
+
+    async def send():
+        for _ in range(7):
+            await limiter.acquire(10)  # batches of 10 messages
+        unlimited = RateLimiter(rate=0)
+        for _ in range(10):
+            await unlimited.acquire(10)
+
+    asyncio.run(send())
+
+    # A burst of 50 goes out at once, the remaining 20 take another 0.4s at 50 messages/s
+    assert clock.slept == pytest.approx(0.4)
+
+
+def test_invalid_settings_are_reported_per_message():
+    channel = configured(SmsChannel, {**SMS_CONFIG, "api_key": "missing-token"}, rate_limit=0)
+    messages = [OutgoingMessage(channel=ChannelEnum.sms, to=["+15550000"], body="hi")]
+
+    results, server = asyncio.run(run_dispatcher([channel], messages))
+
+    assert not results[0].success
+    assert "account_sid" in results[0].error
+    assert server.messages == []
+
+
+def test_inactive_channel_is_rejected():
+    channel = configured(WhatsappChannel, {**WHATSAPP_CONFIG, "active": False})
+    message = OutgoingMessage(channel=ChannelEnum.whatsapp, to=["+15550000"], body="hi")
+
+    async def send():
+        await channel.start()
+        try:
+            await channel.send(message)
+        finally:
+            await channel.stop()
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(send())
+    assert error.value.status_code == 400
+
+
+def test_channels_must_implement_delivery():
+    class IncompleteChannel(dispatcher.MessageChannel):
+        channel = ChannelEnum.sms
+        config_key = "sms"
+
+    with pytest.raises(TypeError):
+        IncompleteChannel()
+    with pytest.raises(TypeError):
+        TwilioChannel()
+
+
+def test_stopping_releases_the_batches_being_collected_or_rate_limited():
+    holding = asyncio.Event()
+
+    async def hold(tokens: int = 1):
+        holding.set()
+        await asyncio.Event().wait()  # a rate limit that would keep the batch for a long time
+
+    async def run():
+        channel = configured(WhatsappChannel, WHATSAPP_CONFIG, pool_size=1, batch_size=2, batch_window=60)
+        channel.rate_limiter.acquire = hold
+        await channel.start()
+        message = OutgoingMessage(channel=ChannelEnum.whatsapp, to=["+15550000"], body="hi")
+        sending = [asyncio.create_task(channel.send(message)) for _ in range(3)]
+        await holding.wait()  # a full batch of 2 is rate limited
+        await asyncio.sleep(0)
+        await channel.stop()
+        return await asyncio.wait_for(asyncio.gather(*sending), 1)
+
+    results = asyncio.run(run())
+
+    assert [result.error for result in results] == ["Dispatcher stopped"] * 3
+
+
+def test_changed_settings_let_the_running_batches_finish():
+    async def run():
+        server = MockTwilioServer(latency=0.05)
+        channel = configured(WhatsappChannel, WHATSAPP_CONFIG, rate_limit=0, pool_size=2, batch_size=5, batch_window=0,
+                             base_url=await server.start())
+        await channel.start()
+        try:
+            message = OutgoingMessage(channel=ChannelEnum.whatsapp, to=["+15550000"], body="hi")
+            sending = asyncio.gather(*(channel.send(message) for _ in range(5)))
+            await asyncio.sleep(0.02)  # the batch is waiting for the provider
+            old_client = channel._client  # noqa
+            await channel.close_pool()  # as get_config does when the settings change
+            closed_while_running = old_client.is_closed
+            results = await sending
+            return results, closed_while_running, old_client.is_closed
+        finally:
+            await channel.stop()
+            await server.stop()
+
+    results, closed_while_running, closed = asyncio.run(run())
+
+    assert all(result.success for result in results)
+    assert not closed_while_running and closed
@@ -0,0 +1,260 @@
+import asyncio
+import os
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+import pytest
+from redis.asyncio import ConnectionPool
+from redis.asyncio.retry import Retry
+from redis.backoff import NoBackoff
+from redis.exceptions import TimeoutError as RedisTimeoutError
+
+from app.components.metrics import MetricsMiddleware, MongoCommandMetrics, MongoPoolMetrics, track_redis_pool
+from app.db import redisClient
+from app.db.redisClient import AsyncRedisClient, InstrumentedConnectionPool, InstrumentedRedis
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+def _value(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def test_requests_are_timed_per_route_and_status():
+    app = FastAPI()
+    app.add_middleware(MetricsMiddleware)
+
+    @app.get("/items/{item_id}")
+    async def item(item_id: int):
+        return {"id": item_id}
+
+    labels = {"method": "GET", "route": "/items/{item_id}"}
+    before_ok = _value("http_request_duration_seconds_count", status="200", **labels)
+    before_invalid = _value("http_request_duration_seconds_count", status="422", **labels)
+    before_unmatched = _value("http_request_duration_seconds_count", method="GET", route="unmatched", status="404")
+    with TestClient(app) as client:
+        for item_id in range(3):
+            client.get(f"/items/{item_id}")
+        client.get("/items/not-a-number")
+        client.get("/unknown/path")
+
+    assert _value("http_request_duration_seconds_count", status="200", **labels) == before_ok + 3
+    assert _value("http_request_duration_seconds_count", status="422", **labels) == before_invalid + 1
+    assert _value("http_request_duration_seconds_count", method="GET", route="unmatched",
+                  status="404") == before_unmatched + 1
+    assert _value("http_requests_in_flight") == 0
+
+
+def test_redis_commands_and_pipelines_are_timed():
+    async def run():
+        pool = ConnectionPool(connection_class=fakeredis.aioredis.FakeConnection, server=fakeredis.FakeServer(),
+                              decode_responses=True)
+        client = InstrumentedRedis(connection_pool=pool)
+        await client.set("key", "1")
+        await client.get("key")
+        async with client.pipeline() as pipeline:
+            pipeline.incr("counter").get("key")
+            return await pipeline.execute()
+
+    before = {command: _value("redis_command_duration_seconds_count", command=command)
+              for command in ("SET", "GET", "INCR", "PIPELINE")}
+    assert asyncio.run(run()) == [1, "1"]
+
+    assert _value("redis_command_duration_seconds_count", command="SET") == before["SET"] + 1
+    assert _value("redis_command_duration_seconds_count", command="GET") == before["GET"] + 1
+    assert _value("redis_command_duration_seconds_count", command="PIPELINE") == before["PIPELINE"] + 1
+    assert _value("redis_command_duration_seconds_count", command="INCR") == before["INCR"]  # part of the pipeline
+
+
+def test_redis_pool_is_bounded_and_tracked():
+    async def run():
+        pool = InstrumentedConnectionPool(max_connections=2, timeout=1,
+                                          connection_class=fakeredis.aioredis.FakeConnection,
+                                          server=fakeredis.FakeServer(), decode_responses=True)
+        client = InstrumentedRedis.from_pool(pool)
+        track_redis_pool(pool.stats)
+        in_use = []
+
+        async def command(index: int):
+            await client.set(f"key{index}", index)
+            in_use.append(pool.stats()["in_use"])
+
+        await asyncio.gather(*(command(index) for index in range(6)))  # more commands than connections
+        stats = pool.stats()
+        await client.aclose()
+        return in_use, stats
+
+    before = _value("redis_pool_checkout_seconds_count")
+    in_use, stats = asyncio.run(run())
+
+    assert max(in_use) <= 2
+    assert stats == {"in_use": 0, "idle": 2, "max": 2}
+    assert _value("redis_pool_checkout_seconds_count") == before + 6
+    assert _value("redis_pool_connections", state="max") == 2
+
+
+def test_writes_that_must_not_run_twice_are_not_retried():
+    class LossyConnection(fakeredis.aioredis.FakeAsyncRedisConnection):
+        """Loses the next `lost_replies` replies, after the server applied their commands."""
+        lost_replies = 0
+
+        async def read_response(self, *args, **kwargs):
+            response = await super().read_response(*args, **kwargs)
+            if LossyConnection.lost_replies:
+                LossyConnection.lost_replies -= 1
+                raise RedisTimeoutError("reply lost")
+            return response
+
+    async def lossy(client, call):
+        await client.ping()  # reconnected, the replies of the connection handshake are not lost
+        LossyConnection.lost_replies = 1
+        try:
+            return await call()
+        except RedisTimeoutError:
+            return "failed"
+
+    async def run():
+        pool = InstrumentedConnectionPool(connection_class=LossyConnection, server=fakeredis.FakeServer(),
+                                          retry=Retry(NoBackoff(), 2), retry_on_timeout=True, decode_responses=True)
+        client = InstrumentedRedis.from_pool(pool)
+
+        def pipeline(*commands):
+            async def execute():
+                async with client.pipeline(transaction=False) as pipe:
+                    for command, *args in commands:
+                        getattr(pipe, command)(*args)
+                    return await pipe.execute()
+            return execute
+
+        outcomes = {
+            "set": await lossy(client, lambda: client.set("key", "value")),
+            "get": await lossy(client, lambda: client.get("key")),
+            "set_nx": await lossy(client, lambda: client.set("lock", "token", nx=True)),
+            "incr": await lossy(client, lambda: client.incr("counter")),
+            "read_pipeline": await lossy(client, pipeline(("get", "key"), ("exists", "lock"))),
+            "counter_pipeline": await lossy(client, pipeline(("hincrby", "usage", "tokens", 10), ("expire", "usage", 60))),
+        }
+        stored = await client.get("lock"), await client.get("counter"), await client.hget("usage", "tokens")
+        await client.aclose()
+        return outcomes, stored
+
+    outcomes, stored = asyncio.run(run())
+
+    assert outcomes == {"set": True, "get": "value", "set_nx": "failed", "incr": "failed",
+                        "read_pipeline": ["value", 1], "counter_pipeline": "failed"}
+    assert stored == ("token", "1", "10")  # applied once
+
+
+def test_pubsub_has_its_own_pool(monkeypatch):
+    async def run():
+        monkeypatch.setattr(AsyncRedisClient, "_instance", InstrumentedRedis.from_pool(InstrumentedConnectionPool(
+            max_connections=2, timeout=0.1, connection_class=fakeredis.aioredis.FakeAsyncRedisConnection,
+            server=fakeredis.FakeServer(), decode_responses=True)))
+        monkeypatch.setattr(AsyncRedisClient, "_pubsub_instance", None)
+        client, pubsub_client = await AsyncRedisClient.get_instance(), await AsyncRedisClient.get_pubsub_instance()
+        subscribers = [pubsub_client.pubsub() for _ in range(3)]  # more than the connections of the client
+        for index, subscriber in enumerate(subscribers):
+            await subscriber.subscribe(f"channel{index}")
+        await client.set("key", "value")
+        received = await client.publish("channel0", "hello"), await client.get("key")
+        for subscriber in subscribers:
+            await subscriber.aclose()
+        await pubsub_client.aclose()
+        await client.aclose()
+        return received, pubsub_client.connection_pool.max_connections
+
+    received, pubsub_max = asyncio.run(run())
+
+    assert received == (1, "value")
+    assert pubsub_max == redisClient.REDIS_PUBSUB_MAX_CONNECTIONS
+
+
+def test_unreachable_redis_fails_fast(monkeypatch):
+    monkeypatch.setattr(redisClient, "REDIS_URL", "redis://127.0.0.1:1/0")  # nothing listens on port 1
+    started = time.perf_counter()
+    with pytest.raises(Exception, match="Could not connect to any Redis server"):
+        asyncio.run(AsyncRedisClient.create_redis_client())
+    assert time.perf_counter() - started < 5
+
+
+def test_mongodb_commands_are_timed_per_collection():
+    listener = MongoCommandMetrics()
+
+    def event(command_name, request_id, command=None, duration_micros=2500):
+        return SimpleNamespace(command_name=command_name, request_id=request_id, connection_id=("db", 27017),
+                               command=command or {}, database_name="fastapi_db", duration_micros=duration_micros)
+
+    labels = {"command": "find", "collection": "users"}
+    before_ok = _value("mongodb_command_duration_seconds_count", status="ok", **labels)
+    before_error = _value("mongodb_command_duration_seconds_count", status="error", **labels)
+    listener.started(event("find", 1, {"find": "users", "filter": {}}))
+    listener.started(event("find", 2, {"find": "users", "filter": {}}))
+    listener.succeeded(event("find", 1))
+    listener.failed(event("find", 2))
+
+    assert _value("mongodb_command_duration_seconds_count", status="ok", **labels) == before_ok + 1
+    assert _value("mongodb_command_duration_seconds_count", status="error", **labels) == before_error + 1
+    assert not listener._collections  # noqa
+
+
+def test_mongodb_pool_checkouts_are_timed():
+    listener = MongoPoolMetrics()
+    address = ("db", 27017)
+    event = SimpleNamespace(address=address, connection_id=1)
+
+    before_ok = _value("mongodb_pool_checkout_seconds_count", status="ok")
+    before_failed = _value("mongodb_pool_checkout_seconds_count", status="failed")
+    before_open = _value("mongodb_pool_connections", address="db:27017", state="open")
+    listener.connection_check_out_started(event)
+    listener.connection_created(event)
+    time.sleep(0.01)
+    listener.connection_checked_out(event)
+    in_use = _value("mongodb_pool_connections", address="db:27017", state="in_use")
+    listener.connection_checked_in(event)
+    listener.connection_check_out_started(event)
+    listener.connection_check_out_failed(event)
+
+    assert _value("mongodb_pool_checkout_seconds_count", status="ok") == before_ok + 1
+    assert _value("mongodb_pool_checkout_seconds_sum", status="ok") >= 0.01
+    assert _value("mongodb_pool_checkout_seconds_count", status="failed") == before_failed + 1
+    assert _value("mongodb_pool_connections", address="db:27017", state="open") == before_open + 1
+    assert _value("mongodb_pool_connections", address="db:27017", state="in_use") == in_use - 1
+    assert not listener._checkouts  # noqa
+
+
+WORKER = """
+import asyncio, sys
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from app.components.metrics import MetricsMiddleware, metrics_response, remove_worker_metrics
+
+app = FastAPI()
+app.add_middleware(MetricsMiddleware)
+app.get("/ping")(lambda: "pong")
+with TestClient(app) as client:
+    for _ in range(int(sys.argv[1])):
+        client.get("/ping")
+if sys.argv[2] == "scrape":
+    sys.stdout.write(metrics_response().body.decode())
+remove_worker_metrics()
+"""
+
+
+def test_metrics_of_several_workers_are_summed(tmp_path):
+    env = {**os.environ, "PROMETHEUS_MULTIPROC_DIR": str(tmp_path)}
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    def worker(requests: int, mode: str) -> str:
+        return subprocess.run([sys.executable, "-c", WORKER, str(requests), mode], env=env, cwd=root,
+                              capture_output=True, text=True, check=True).stdout
+
+    worker(3, "serve")
+    scraped = worker(2, "scrape")  # a scrape answered by another worker sees the requests of both
+
+    assert 'http_request_duration_seconds_count{method="GET",route="/ping",status="200"} 5.0' in scraped
+    assert "http_requests_in_flight" in scraped
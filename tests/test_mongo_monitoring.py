@@ -0,0 +1,116 @@
+import json
+import logging
+import time
+from types import SimpleNamespace
+
+from app.db import mongoMonitoring
+from app.db.mongoMonitoring import SlowQueryListener, command_shape, filter_shape, plan_summary
+
+
+def test_filter_shapes_hide_the_values():
+    assert filter_shape({"$or": [{"email": "a@b.c"}, {"username": "alice"}]}) == \
+        {"$or": [{"email": "?"}, {"username": "?"}]}
+    assert filter_shape({"role": {"$in": ["admin", "owner"]}, "age": {"$gt": 3}}) == \
+        {"role": {"$in": ["?"]}, "age": {"$gt": "?"}}
+    assert command_shape("update", {"update": "users", "updates": [{"q": {"_id": 1}, "u": {"$set": {"a": 1}}}]}) == \
+        {"_id": "?"}
+    assert command_shape("aggregate", {"aggregate": "emails", "pipeline": [{"$match": {"status": "sent"}},
+                                                                            {"$sort": {"sent_at": -1}}]}) == \
+        [{"$match": {"status": "?"}}]
+    assert command_shape("find", {"find": "users", "filter": {}}) == {}
+
+
+def test_plan_summary_lists_the_stages():
+    plan = {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "keyPattern": {"username": 1}}}
+    assert plan_summary(plan) == 'FETCH <- IXSCAN {"username": 1}'
+    assert plan_summary({"queryPlan": {"stage": "COLLSCAN"}}) == "COLLSCAN"
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.explained = []
+
+    def command(self, name, command, verbosity):
+        self.explained.append((name, command, verbosity))
+        return {"queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}}}
+
+
+def _event(request_id, command=None, duration_ms=0, reply=None, command_name="find"):
+    return SimpleNamespace(command_name=command_name, request_id=request_id, connection_id=("db", 27017),
+                           database_name="fastapi_db", command=command, duration_micros=duration_ms * 1000,
+                           reply=reply)
+
+
+def test_slow_queries_are_logged_with_their_shape_and_plan(caplog):
+    database = FakeDatabase()
+    listener = SlowQueryListener(threshold_ms=100, explain=True, explain_interval=300)
+    listener.client = {"fastapi_db": database}
+    command = {"find": "users", "filter": {"$or": [{"email": "a@b.c"}, {"username": "alice"}]}, "lsid": {"id": 1},
+               "$db": "fastapi_db"}
+
+    with caplog.at_level(logging.WARNING):
+        listener.started(_event(1, command))
+        listener.succeeded(_event(1, duration_ms=5, reply={"cursor": {"firstBatch": []}}))
+        for request_id in (2, 3):  # the same query twice, explained once
+            listener.started(_event(request_id, command))
+            listener.succeeded(_event(request_id, duration_ms=250, reply={"cursor": {"firstBatch": [{}, {}]}}))
+        listener._executor.shutdown(wait=True)  # noqa
+
+    slow = [record for record in caplog.records if getattr(record, "event", None) == "slow_query"]
+    assert len(slow) == 2 and listener.slow_queries == 2
+    assert slow[0].collection == "users" and slow[0].query_ms == 250 and slow[0].returned == 2
+    assert json.loads(slow[0].filter_shape) == {"$or": [{"email": "?"}, {"username": "?"}]}
+    assert len(database.explained) == 1
+    assert database.explained[0][1] == {"find": "users", "filter": command["filter"]}
+    plans = [record for record in caplog.records if getattr(record, "event", None) == "slow_query_plan"]
+    assert [record.plan for record in plans] == ["COLLSCAN"]
+    assert not listener._commands  # noqa
+
+
+def test_get_more_is_measured_as_the_find_of_its_cursor(caplog):
+    listener = SlowQueryListener(threshold_ms=100, explain=False)
+    command = {"find": "users", "filter": {"role": "admin"}}
+
+    with caplog.at_level(logging.WARNING):
+        listener.started(_event(1, command))
+        listener.succeeded(_event(1, duration_ms=5, reply={"cursor": {"id": 42, "firstBatch": [{}] * 101}}))
+        listener.started(_event(2, {"getMore": 42, "collection": "users"}, command_name="getMore"))
+        listener.succeeded(_event(2, duration_ms=300, reply={"cursor": {"id": 42, "nextBatch": [{}] * 50}},
+                                  command_name="getMore"))
+        listener.started(_event(3, {"getMore": 42, "collection": "users"}, command_name="getMore"))
+        listener.succeeded(_event(3, duration_ms=5, reply={"cursor": {"id": 0, "nextBatch": [{}]}},
+                                  command_name="getMore"))
+        # A cursor closed before its end
+        listener.started(_event(4, command))
+        listener.succeeded(_event(4, duration_ms=5, reply={"cursor": {"id": 43, "firstBatch": []}}))
+        opened = dict(listener._cursors)  # noqa
+        listener.started(_event(5, {"killCursors": "users", "cursors": [43]}, command_name="killCursors"))
+
+    slow = [record for record in caplog.records if getattr(record, "event", None) == "slow_query"]
+    assert [(record.command, record.collection, record.returned) for record in slow] == [("getMore", "users", 50)]
+    assert json.loads(slow[0].filter_shape) == {"role": "?"}
+    assert list(opened) == [(("db", 27017), 43)]
+    assert not listener._cursors and not listener._commands  # noqa
+
+
+def test_old_explains_and_abandoned_cursors_are_pruned(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    listener = SlowQueryListener(threshold_ms=100, explain=True, explain_interval=300)
+    listener.client = {"fastapi_db": FakeDatabase()}
+
+    def find(request_id, collection, cursor_id=0):
+        listener.started(_event(request_id, {"find": collection, "filter": {}}))
+        listener.succeeded(_event(request_id, duration_ms=250, reply={"cursor": {"id": cursor_id, "firstBatch": []}}))
+
+    find(1, "users", cursor_id=42)
+    find(2, "emails")
+    now[0] += 200
+    find(3, "roles")
+    assert len(listener._explained) == 3 and len(listener._cursors) == 1  # noqa
+
+    now[0] += mongoMonitoring.CURSOR_TIMEOUT
+    find(4, "settings")
+    listener._executor.shutdown(wait=True)  # noqa
+    assert [collection for collection, _ in listener._explained] == ["settings"]  # noqa
+    assert not listener._cursors  # noqa
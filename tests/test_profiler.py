@@ -0,0 +1,53 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.components import profiler
+from app.components.profiler import ProfileMiddleware, SamplingProfiler, get_profile
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+def busy_loop(seconds: float):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        sum(range(1000))
+
+
+def test_profiler_samples_the_busy_thread_as_folded_stacks():
+    sampler = SamplingProfiler(interval=0.002, thread_ids=[threading.get_ident()])
+    sampler.start()
+    busy_loop(0.3)
+    sampler.stop()
+
+    assert sampler.samples > 20
+    lines = sampler.folded().splitlines()
+    stack, count = lines[0].rsplit(" ", 1)
+    frames = stack.split(";")
+    assert frames[0] == "MainThread"
+    assert any(frame.startswith("busy_loop (test_profiler.py:") for frame in frames)
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in lines) <= sampler.samples
+
+
+def test_requests_with_the_profile_token_are_profiled(monkeypatch):
+    monkeypatch.setattr(profiler, "PROFILE_TOKEN", "secret")
+    app = FastAPI()
+    app.add_middleware(ProfileMiddleware)
+    app.state.redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+
+    @app.get("/work")
+    async def work():
+        busy_loop(0.1)
+        return {}
+
+    with TestClient(app) as client:
+        profiled = client.get("/work", headers={"X-Profile": "secret"})
+        wrong_token = client.get("/work", headers={"X-Profile": "guess"})
+        folded = client.portal.call(get_profile, app.state.redis, profiled.headers["X-Profile-Id"])
+
+    assert "X-Profile-Id" not in wrong_token.headers
+    assert "busy_loop (test_profiler.py:" in folded
@@ -0,0 +1,52 @@
+"""
+The replica set test needs a local single-host replica set, e.g.
+
+    docker run -d --name mongo-rs -p 27017:27017 mongo --replSet rs0
+    docker exec mongo-rs mongosh --eval "rs.initiate({_id: 'rs0', members: [{_id: 0, host: 'localhost:27017'}]})"
+    mongodb_test_replica_set_url="mongodb://localhost:27017/?replicaSet=rs0" python -m pytest tests/test_read_preference.py
+
+and is skipped without mongodb_test_replica_set_url.
+"""
+import asyncio
+import os
+
+import pytest
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import ServerSelectionTimeoutError
+from pymongo.read_preferences import ReadPreference, SecondaryPreferred
+
+from app.components.auth import check_permissions
+from app.db.mongoClient import read_preference, secondary_reads
+from app.routers import auth, users
+from app.routers.settings import messages
+
+REPLICA_SET_URL = os.getenv("mongodb_test_replica_set_url")
+
+
+def test_listings_read_from_secondaries_and_auth_from_the_primary():
+    assert users.user_listing.read_preference == SecondaryPreferred(max_staleness=90)
+    assert messages.emails_history.read_preference == SecondaryPreferred(max_staleness=90)
+    for collection in (users.user_collection, auth.user_collection, check_permissions.async_database.users):
+        assert collection.read_preference == ReadPreference.PRIMARY
+
+    assert read_preference("primary", 90) == ReadPreference.PRIMARY
+    assert read_preference("nearest", 120).document == {"mode": "nearest", "maxStalenessSeconds": 120}
+
+
+@pytest.mark.skipif(not REPLICA_SET_URL, reason="mongodb_test_replica_set_url is not set")
+def test_reads_are_routed_on_a_replica_set():
+    async def run():
+        client = AsyncIOMotorClient(REPLICA_SET_URL, serverSelectionTimeoutMS=2000)
+        collection = client.test_read_preference.users
+        try:
+            await collection.insert_one({"username": "alice"})
+            # The only member is the primary, secondaryPreferred falls back to it
+            found = await secondary_reads(collection).find_one({"username": "alice"})
+            with pytest.raises(ServerSelectionTimeoutError):
+                await collection.with_options(read_preference=read_preference("secondary", 90)).find_one({})
+            return found
+        finally:
+            await client.drop_database("test_read_preference")
+            client.close()
+
+    assert asyncio.run(run())["username"] == "alice"
@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+from app.classes.Chatgpt import CachePolicy
+from app.components.chat_gpt import response_cache
+from app.components.chat_gpt.response_cache import ChatResponseCache, cache_key
+
+fakeredis = pytest.importorskip("fakeredis.aioredis")
+
+POLICIES = {"gpt-4": CachePolicy(ttl=3600, local_ttl=60), "gpt-3.5-turbo": CachePolicy(enabled=False)}
+
+
+class BrokenRedis:
+    async def get(self, key):
+        raise RedisConnectionError("connection refused")
+
+    async def set(self, key, value, ex=None):
+        raise RedisConnectionError("connection refused")
+
+
+def test_answers_are_found_locally_then_in_redis(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(response_cache.time, "monotonic", lambda: now[0])
+    redis = fakeredis.FakeRedis(decode_responses=True)
+    cache = ChatResponseCache(redis, policies=POLICIES)
+    other_worker = ChatResponseCache(redis, policies=POLICIES)
+
+    async def run():
+        lookups = [await cache.get("gpt-4", "What is Redis?")]
+        await cache.set("gpt-4", "What is Redis?", "A key-value store.")
+        lookups.append(await cache.get("gpt-4", "  what is   REDIS? "))  # same normalized question
+        lookups.append(await other_worker.get("gpt-4", "What is Redis?"))
+        now[0] += 61  # past the local TTL, Redis still has it
+        lookups.append(await cache.get("gpt-4", "What is Redis?"))
+        await redis.delete(cache_key("gpt-4", "What is Redis?"))
+        now[0] += 61
+        lookups.append(await cache.get("gpt-4", "What is Redis?"))
+        return lookups
+
+    lookups = asyncio.run(run())
+
+    assert lookups == [(None, "miss"), ("A key-value store.", "local"), ("A key-value store.", "redis"),
+                       ("A key-value store.", "redis"), (None, "miss")]
+    stats = cache.stats()
+    assert stats["local_hits"] == 1 and stats["redis_hits"] == 1 and stats["misses"] == 2
+    assert stats["hit_rate"] == 0.5
+    assert stats["policies"]["gpt-4"] == {"enabled": True, "ttl": 3600, "local_ttl": 60}
+
+
+def test_redis_entries_expire_with_the_policy_ttl():
+    redis = fakeredis.FakeRedis(decode_responses=True)
+    cache = ChatResponseCache(redis, policies=POLICIES)
+
+    async def run():
+        await cache.set("gpt-4", "Hello?", "Hi")
+        await cache.set("gpt-3.5-turbo", "Hello?", "Hi")  # caching is disabled for this model
+        return await redis.ttl(cache_key("gpt-4", "Hello?")), await redis.exists(cache_key("gpt-3.5-turbo", "Hello?")), \
+            await cache.get("gpt-3.5-turbo", "Hello?")
+
+    ttl, disabled_stored, disabled_lookup = asyncio.run(run())
+
+    assert 3590 < ttl <= 3600
+    assert not disabled_stored
+    assert disabled_lookup == (None, "bypass")
+
+
+def test_redis_errors_are_misses():
+    cache = ChatResponseCache(BrokenRedis(), policies=POLICIES)
+
+    async def run():
+        first = await cache.get("gpt-4", "Hello?")
+        await cache.set("gpt-4", "Hello?", "Hi")  # still kept in the local tier
+        return first, await cache.get("gpt-4", "Hello?")
+
+    assert asyncio.run(run()) == ((None, "miss"), ("Hi", "local"))
+    assert cache.counters["errors"] == 2 and cache.counters["writes"] == 0
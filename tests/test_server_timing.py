@@ -0,0 +1,82 @@
+import asyncio
+import logging
+
+from fastapi import APIRouter, Depends, FastAPI
+from fastapi.testclient import TestClient
+
+from app.components import profiler, server_timing
+from app.components.server_timing import ServerTimingMiddleware, TimedAPIRoute, record, timed
+
+
+def _phases(header: str) -> dict:
+    phases = {}
+    for entry in header.split(", "):
+        name, duration, *desc = entry.split(";")
+        phases[name] = (float(duration.removeprefix("dur=")), desc[0] if desc else None)
+    return phases
+
+
+@timed("auth")
+async def authenticate():
+    await asyncio.sleep(0.02)
+
+
+def _client() -> TestClient:
+    router = APIRouter(route_class=TimedAPIRoute)
+
+    @router.get("/slow", dependencies=[Depends(authenticate)])
+    async def slow():
+        for _ in range(2):
+            record("redis", 0.005)  # what InstrumentedRedis records for each command
+        await asyncio.sleep(0.05)
+        return {"items": list(range(10))}
+
+    @router.get("/sync")
+    def sync():
+        return {}
+
+    app = FastAPI()
+    app.include_router(router)
+    app.add_middleware(ServerTimingMiddleware)
+    return TestClient(app)
+
+
+def test_server_timing_header_splits_the_request_into_phases(monkeypatch):
+    monkeypatch.setattr(server_timing, "SERVER_TIMING", "on")
+    with _client() as client:
+        response = client.get("/slow")
+        sync_response = client.get("/sync")
+
+    phases = _phases(response.headers["Server-Timing"])
+    assert set(phases) == {"auth", "redis", "deps", "handler", "serialize", "total"}
+    assert phases["auth"][0] >= 20 and phases["deps"][0] >= phases["auth"][0]
+    assert phases["handler"][0] >= 50
+    assert phases["redis"] == (10.0, 'desc="2 calls"')
+    assert phases["total"][0] >= phases["deps"][0] + phases["handler"][0]
+    assert set(_phases(sync_response.headers["Server-Timing"])) == {"deps", "handler", "serialize", "total"}
+
+
+def test_slow_requests_are_logged_with_their_phases(monkeypatch, caplog):
+    monkeypatch.setattr(server_timing, "SLOW_REQUEST_MS", 40)
+    with caplog.at_level(logging.WARNING), _client() as client:
+        client.get("/slow")
+        client.get("/sync")
+
+    slow = [record for record in caplog.records if getattr(record, "event", None) == "slow_request"]
+    assert len(slow) == 1
+    assert slow[0].getMessage().startswith("Slow request: GET /slow took")
+    assert slow[0].phases["handler"] >= 50
+
+
+def test_server_timing_header_is_only_sent_when_allowed(monkeypatch):
+    monkeypatch.setattr(profiler, "PROFILE_TOKEN", "secret")
+    with _client() as client:
+        default = client.get("/sync")
+        monkeypatch.setattr(server_timing, "SERVER_TIMING", "token")
+        anonymous = client.get("/sync")
+        wrong_token = client.get("/sync", headers={"X-Profile": "guess"})
+        authorised = client.get("/sync", headers={"X-Profile": "secret"})
+
+    assert "Server-Timing" not in default.headers  # off by default
+    assert "Server-Timing" not in anonymous.headers and "Server-Timing" not in wrong_token.headers
+    assert "total;dur=" in authorised.headers["Server-Timing"]
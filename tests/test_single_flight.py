@@ -0,0 +1,114 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from app.classes.Chatgpt import ChatAnswer
+from app.components.chat_gpt.single_flight import SingleFlight
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+class SlowUpstream:
+    """Answers after `delay` seconds, counting its calls; fails with `error` when given."""
+
+    def __init__(self, delay: float = 0.05, error: Exception = None):
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+
+    async def __call__(self) -> ChatAnswer:
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return ChatAnswer(message=f"answer {self.calls}", model="gpt-4", usage={"total_tokens": 10})
+
+
+def workers(count: int, **kwargs):
+    """Single-flight instances of `count` workers sharing one Redis server, subscribing on clients of their own."""
+    server = fakeredis.FakeServer()
+    return [SingleFlight(fakeredis.aioredis.FakeRedis(server=server, decode_responses=True), mode="redis",
+                         pubsub_client=fakeredis.aioredis.FakeRedis(server=server, decode_responses=True), **kwargs)
+            for _ in range(count)]
+
+
+def test_concurrent_requests_in_a_worker_share_one_call():
+    flight = SingleFlight(mode="local")
+    upstream = SlowUpstream()
+
+    async def run():
+        return await asyncio.gather(*(flight.do("key", upstream) for _ in range(5)))
+
+    answers = asyncio.run(run())
+
+    assert upstream.calls == 1
+    assert {answer.message for answer in answers} == {"answer 1"}
+    assert [answer.shared for answer in answers] == [False, True, True, True, True]
+    assert answers[0].usage == {"total_tokens": 10} and answers[1].usage is None  # tokens are counted once
+    assert flight.stats()["in_flight"] == 0 and flight.counters["local_followers"] == 4
+
+
+def test_followers_in_other_workers_receive_the_leader_answer():
+    leader, follower = workers(2)
+    upstream = SlowUpstream(delay=0.1)
+
+    async def run():
+        first = asyncio.create_task(leader.do("key", upstream))
+        await asyncio.sleep(0.02)  # the leader holds the lock
+        return await asyncio.gather(first, follower.do("key", upstream))
+
+    led, followed = asyncio.run(run())
+
+    assert upstream.calls == 1
+    assert led.message == followed.message == "answer 1"
+    assert followed.shared and followed.usage is None
+    assert follower.counters["remote_followers"] == 1
+
+
+def test_followers_receive_the_leader_error():
+    leader, follower = workers(2)
+    upstream = SlowUpstream(delay=0.1, error=HTTPException(status_code=429, detail="rate limited"))
+
+    async def run():
+        first = asyncio.create_task(leader.do("key", upstream))
+        await asyncio.sleep(0.02)
+        return await asyncio.gather(first, follower.do("key", upstream), return_exceptions=True)
+
+    errors = asyncio.run(run())
+
+    assert upstream.calls == 1
+    assert [error.status_code for error in errors] == [429, 429]
+
+
+def test_followers_call_upstream_when_the_leader_does_not_answer():
+    follower, = workers(1, wait_timeout=0.2)
+    upstream = SlowUpstream(delay=0)
+
+    async def run():
+        # A leader that died while holding the lock
+        await follower.redis.set("chatgpt:flight:lock:key", "gone", px=60_000)
+        return await follower.do("key", upstream)
+
+    answer = asyncio.run(run())
+
+    assert answer.message == "answer 1" and upstream.calls == 1
+    assert follower.counters["fallbacks"] == 1
+
+
+def test_followers_stop_waiting_when_the_leader_lock_is_gone():
+    follower, = workers(1, wait_timeout=60)
+    upstream = SlowUpstream(delay=0)
+
+    async def run():
+        # A leader cancelled before it had an answer releases its lock without publishing anything
+        await follower.redis.set("chatgpt:flight:lock:key", "cancelled", px=60_000)
+        waiting = asyncio.create_task(follower.do("key", upstream))
+        await asyncio.sleep(0.05)
+        await follower.redis.delete("chatgpt:flight:lock:key")
+        return await asyncio.wait_for(waiting, 5)  # not the 60s of wait_timeout
+
+    answer = asyncio.run(run())
+
+    assert answer.message == "answer 1" and upstream.calls == 1
+    assert follower.counters["fallbacks"] == 1
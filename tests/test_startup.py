@@ -0,0 +1,125 @@
+import asyncio
+import json
+import logging
+import time
+
+import pytest
+
+from app.components import startup
+from app.components.startup import (BOOTSTRAP_LOCK_KEY, BOOTSTRAP_STATUS_KEY, Step, StartupError, bootstrap,
+                                    release_leader_lock, run_steps, wait_for_bootstrap)
+
+fakeredis = pytest.importorskip("fakeredis.aioredis")
+
+
+def test_steps_run_concurrently_and_failures_are_named(caplog):
+    async def slow():
+        await asyncio.sleep(0.1)
+
+    async def broken():
+        raise ConnectionError("refused")
+
+    async def run():
+        started = time.perf_counter()
+        results = await run_steps(Step("a", slow), Step("b", slow), Step("optional", broken, critical=False))
+        elapsed = time.perf_counter() - started
+        with pytest.raises(StartupError, match="Critical startup steps failed: redis"):
+            await run_steps(Step("mongodb", slow), Step("redis", broken))
+        return results, elapsed
+
+    with caplog.at_level(logging.INFO):
+        results, elapsed = asyncio.run(run())
+
+    assert elapsed < 0.18
+    assert [result.name for result in results] == ["a", "b", "optional"]
+    assert isinstance(results[2].error, ConnectionError)
+    failed = [record.step for record in caplog.records if getattr(record, "event", None) == "startup_step_failed"]
+    assert failed == ["optional", "redis"]
+
+
+def test_bootstrap_is_done_by_one_worker():
+    calls = []
+
+    async def create_indexes():
+        calls.append("indexes")
+        await asyncio.sleep(0.05)
+
+    async def failing_owner():
+        raise ValueError("owner_password is missing")
+
+    async def run():
+        redis = fakeredis.FakeRedis(decode_responses=True)
+        # Four workers starting together, one of them bootstraps and the others wait for it
+        async def worker():
+            leader = await bootstrap(redis, Step("indexes", create_indexes))
+            return leader, list(calls)
+
+        workers = await asyncio.gather(*(worker() for _ in range(4)))
+        leaders = [leader for leader, _ in workers]
+        assert all(done == ["indexes"] for _, done in workers)
+        status = json.loads(await redis.get(BOOTSTRAP_STATUS_KEY))
+        lock_kept = await redis.exists(BOOTSTRAP_LOCK_KEY)
+
+        # A failed bootstrap releases the lock, the next worker to start tries again
+        await redis.delete(BOOTSTRAP_LOCK_KEY)
+        assert await bootstrap(redis, Step("indexes", create_indexes), Step("owner", failing_owner, critical=False))
+        failed_status = json.loads(await redis.get(BOOTSTRAP_STATUS_KEY))
+        retried = await bootstrap(redis, Step("indexes", create_indexes))
+        assert not await release_leader_lock(redis, "another-worker")
+        return leaders, status, lock_kept, failed_status, retried
+
+    leaders, status, lock_kept, failed_status, retried = asyncio.run(run())
+
+    assert sorted(leaders) == [False, False, False, True]
+    assert status["status"] == "ok" and "indexes" in status["durations_ms"]
+    assert lock_kept
+    assert failed_status["status"] == "failed" and failed_status["failed"] == ["owner"]
+    assert retried and calls == ["indexes"] * 3
+
+
+def test_waiting_workers_fail_with_the_leader(monkeypatch):
+    monkeypatch.setattr(startup, "BOOTSTRAP_POLL_INTERVAL", 0.01)
+
+    async def broken_indexes():
+        await asyncio.sleep(0.05)
+        raise ConnectionError("refused")
+
+    async def run():
+        redis = fakeredis.FakeRedis(decode_responses=True)
+        outcomes = await asyncio.gather(*(bootstrap(redis, Step("indexes", broken_indexes)) for _ in range(3)),
+                                        return_exceptions=True)
+        # A leader that never reports, e.g. crashed in the middle of its bootstrap
+        await redis.set(BOOTSTRAP_LOCK_KEY, "crashed-worker")
+        with pytest.raises(StartupError, match="No bootstrap status from the worker crashed-worker"):
+            await wait_for_bootstrap(redis, "crashed-worker", timeout=0.05)
+        return outcomes, await wait_for_bootstrap(redis, None)
+
+    outcomes, without_leader = asyncio.run(run())
+
+    assert all(isinstance(outcome, StartupError) for outcome in outcomes)
+    assert sorted("Bootstrap failed in the worker" in str(outcome) for outcome in outcomes) == [False, True, True]
+    assert without_leader is None
+
+
+def test_a_failed_startup_closes_what_was_started(monkeypatch):
+    from app import main
+
+    events = []
+
+    async def failing_startup():
+        events.append("startup")
+        raise StartupError("Critical startup steps failed: redis")
+
+    async def shutdown():
+        events.append("shutdown")
+
+    monkeypatch.setattr(main, "startup_event", failing_startup)
+    monkeypatch.setattr(main, "shutdown_event", shutdown)
+
+    async def run():
+        async with main.lifespan(main.app):
+            events.append("serving")
+
+    with pytest.raises(StartupError):
+        asyncio.run(run())
+    assert events == ["startup", "shutdown"]